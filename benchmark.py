@@ -0,0 +1,443 @@
+"""Benchmarks de Monitor de Impresoras.
+
+Uso:
+    python benchmark.py capturar            # guarda PrinterStatus.html de cada modelo
+    python benchmark.py parser [-n 200]     # mide y valida el parseo sobre los fixtures
+    python benchmark.py catalogo            # carga de niveles del catálogo con 100..10000 impresoras
+    python benchmark.py pronostico          # pronóstico de agotamiento de toda la flota
+
+Los fixtures se guardan en fixtures/status/ junto con esperados.json, que registra
+los valores que extrajo BeautifulSoup al momento de la captura. `parser` termina
+con código 1 si algún extractor difiere de esos valores, o si el extractor rápido
+difiere de BeautifulSoup en un fixture o en alguna de las páginas aleatorias.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+
+import numpy as np
+from bs4 import XMLParsedAsHTMLWarning
+
+import impresoras as app
+
+FIXTURES_DIR   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "status")
+ESPERADOS_PATH = os.path.join(FIXTURES_DIR, "esperados.json")
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+def _slug(modelo):
+    return re.sub(r"[^a-z0-9]+", "_", modelo.lower()).strip("_")
+
+
+def _cargar_esperados():
+    try:
+        with open(ESPERADOS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _valores(porcentajes, modelo):
+    """Aplica los índices de MODELOS_CONFIG a una lista de tokens NN%."""
+    def extraer(idx):
+        if idx is None or len(porcentajes) <= idx:
+            return None
+        return float(porcentajes[idx].replace("%", "")) / 100
+    return [extraer(i) for i in app.MODELOS_CONFIG[modelo]]
+
+
+# Piezas con las que se arman las páginas aleatorias: texto con y sin porcentajes,
+# números que quedan partidos entre etiquetas, entidades, y marcado cuyo contenido
+# get_text() omite (comentarios, script/style, declaraciones, atributos con NN%).
+_PIEZAS = [
+    "Tóner ", "Kit ", " ~", "~", "Bandeja 1", "x", " ", "\n", "\t", ".", "5", "12", "7.5",
+    "%", "45%", "100%", "0%", "12.5%", "3.%", "a9%", "9%b", "%%", "1 %",
+    "&nbsp;", "&amp;", "&#37;", "&#x25;", "&percnt;", "&lt;", "&gt;", "&#53;", "&nbsp", "&",
+    "&#53", "&#X25", "&#150;", "&#999999999999;", "&foo;", "&amp", "&nbsp.",
+    "&AMP;", "1 < 2", "a > b",
+    "<b>", "</b>", "<td>", "</td>", "<br/>", "<p class='n'>", "</p>", "<img src=\"a.gif\">",
+    '<td width="37%">', "<div style='width: 50%'>", '<a title="a>b 80%">', "</a>",
+    "<!-- 25% -->", "<!---->", "<!DOCTYPE html>", "<?xml version='1.0'?>",
+    "<script>var p = '60%';</script>", "<style>.b { width: 70% }</style>",
+    "<SCRIPT type='text/javascript'>x = 1 < 2;</SCRIPT>", "<template>15%</template>",
+    "<![CDATA[ 33% ]]>",
+]
+
+
+def _paginas_aleatorias(cantidad, semilla):
+    """Genera `cantidad` páginas reproducibles combinando _PIEZAS al azar."""
+    azar = random.Random(semilla)
+    warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+    for _ in range(cantidad):
+        yield "".join(azar.choice(_PIEZAS) for _ in range(azar.randint(1, 40)))
+
+
+def _medir(fn, repeticiones):
+    """Retorna (mediana en ms, pico de memoria en KiB) de fn()."""
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        fn()
+        tiempos.append((time.perf_counter() - t0) * 1000)
+    tracemalloc.start()
+    fn()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(tiempos), pico / 1024
+
+# ---------------------------------------------------------------------------
+# Captura de fixtures
+# ---------------------------------------------------------------------------
+
+def capturar(args):
+    """Descarga la página de estado de una impresora activa por modelo soportado."""
+    app._inicializar_db_path()
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    esperados = _cargar_esperados()
+    por_modelo = {}
+    for imp in app.db_impresoras_todas(activas_solo=True):
+        if imp["modelo"] in app.MODELOS_CONFIG:
+            por_modelo.setdefault(imp["modelo"], []).append(imp["ip"])
+
+    for modelo in app.MODELOS_CONFIG:
+        ips = por_modelo.get(modelo, [])
+        for ip in ips[:args.intentos]:
+            try:
+                texto = app._motor.ejecutar(app._descargar_status(ip))
+            except Exception as e:
+                print(f"  {modelo:<22} {ip:<15} error: {e}")
+                continue
+            archivo = f"{_slug(modelo)}.html"
+            with open(os.path.join(FIXTURES_DIR, archivo), "w", encoding="utf-8") as f:
+                f.write(texto)
+            porcentajes = app._porcentajes_bs(texto)
+            esperados[archivo] = {
+                "modelo":      modelo,
+                "ip":          ip,
+                "capturado":   datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "porcentajes": porcentajes,
+                "valores":     _valores(porcentajes, modelo),
+            }
+            print(f"  {modelo:<22} {ip:<15} -> {archivo}  {esperados[archivo]['valores']}")
+            break
+        else:
+            print(f"  {modelo:<22} sin impresora activa que responda")
+
+    with open(ESPERADOS_PATH, "w", encoding="utf-8") as f:
+        json.dump(esperados, f, indent=2, ensure_ascii=False)
+    return 0
+
+# ---------------------------------------------------------------------------
+# Benchmark del parser
+# ---------------------------------------------------------------------------
+
+def parser(args):
+    """Mide tiempo y memoria por página de cada extractor y valida sus resultados."""
+    esperados = _cargar_esperados()
+    if not esperados:
+        print(f"No hay fixtures en {FIXTURES_DIR}. Ejecute primero: python benchmark.py capturar")
+        return 1
+
+    faltantes = [m for m in app.MODELOS_CONFIG
+                 if not any(e["modelo"] == m for e in esperados.values())]
+    fallos = 0
+    print(f"{'Archivo':<26}{'KiB':>7}{'BS ms':>9}{'BS KiB':>9}"
+          f"{'Rápido ms':>11}{'Ráp. KiB':>10}{'x':>7}  Valores (tóner, kit, unidad)")
+    for archivo, esp in sorted(esperados.items()):
+        ruta = os.path.join(FIXTURES_DIR, archivo)
+        with open(ruta, "r", encoding="utf-8") as f:
+            texto = f.read()
+        modelo = esp["modelo"]
+
+        ms_bs,  kib_bs  = _medir(lambda: app._porcentajes_bs(texto), args.n)
+        ms_rap, kib_rap = _medir(lambda: app._extraer_consumibles(texto, modelo), args.n)
+
+        valores_bs  = _valores(app._porcentajes_bs(texto), modelo)
+        valores_rap = list(app._extraer_consumibles(texto, modelo))
+        ok = (valores_bs == esp["valores"] and valores_rap == esp["valores"]
+              and app._porcentajes_rapido(texto, sys.maxsize) == app._porcentajes_bs(texto))
+        if not ok:
+            fallos += 1
+        print(f"{archivo:<26}{len(texto.encode('utf-8')) / 1024:>7.1f}{ms_bs:>9.3f}{kib_bs:>9.0f}"
+              f"{ms_rap:>11.3f}{kib_rap:>10.0f}{ms_bs / ms_rap if ms_rap else 0:>7.1f}  "
+              f"{valores_rap}{'' if ok else '  <-- DIFIERE'}")
+        if not ok:
+            print(f"    esperado {esp['valores']}  BeautifulSoup {valores_bs}  rápido {valores_rap}")
+
+    distintas = derivadas = 0
+    for texto in _paginas_aleatorias(args.aleatorias, args.semilla):
+        rapido = app._porcentajes_rapido(texto, sys.maxsize)
+        if rapido is None:
+            derivadas += 1
+            continue
+        bs = app._porcentajes_bs(texto)
+        if rapido != bs:
+            distintas += 1
+            if distintas <= 5:
+                print(f"\n  {texto!r}\n    BeautifulSoup {bs}  rápido {rapido}")
+    print(f"\nPáginas aleatorias (semilla {args.semilla}): {args.aleatorias}, "
+          f"{derivadas} con marcado mal formado derivadas a BeautifulSoup, "
+          f"{distintas} con resultados distintos.")
+
+    if faltantes:
+        print("\nModelos sin fixture: " + ", ".join(faltantes))
+    if fallos or distintas:
+        print(f"\nFALLO: {fallos} fixture(s) con valores distintos a los esperados, "
+              f"{distintas} página(s) aleatoria(s) en que el extractor rápido difiere.")
+        return 1
+    print("\nOK: todos los extractores coinciden con los valores capturados y con BeautifulSoup.")
+    return 1 if (faltantes and args.estricto) else 0
+
+# ---------------------------------------------------------------------------
+# Benchmark del catálogo
+# ---------------------------------------------------------------------------
+
+def _poblar_db(n_impresoras, n_corridas):
+    """Crea impresoras y n_corridas lecturas por impresora (cada décima sin datos)."""
+    ts0 = int(time.time()) - n_corridas * 900
+    with app.db_connect() as conn:
+        conn.executemany(
+            "INSERT INTO impresoras (ip, modelo, sucursal) VALUES (?, 'Lexmark MS811', ?)",
+            [(f"10.{i // 65536}.{i // 256 % 256}.{i % 256}", f"Sucursal {i % 60}")
+             for i in range(n_impresoras)])
+        ids = [r[0] for r in conn.execute("SELECT id FROM impresoras")]
+        for k in range(n_corridas):
+            ts = ts0 + k * 900
+            conn.executemany(
+                "INSERT INTO lecturas (impresora_id, ts, corrida_id, toner, unidad, kit) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(id_, ts, ts * 1000) + ((None, None, None) if (id_ + k) % 10 == 0
+                                         else ((id_ * 7 + k) % 1000, 500, 800))
+                 for id_ in ids])
+
+
+def _ultimo_toner_historial(ip):
+    """db_ultimo_toner tal como era antes de ultima_lectura: busca en todo el historial."""
+    with app.db_connect() as conn:
+        row = conn.execute("""
+            SELECT l.toner FROM lecturas l
+            JOIN impresoras i ON i.id = l.impresora_id
+            WHERE i.ip=? AND l.toner IS NOT NULL
+            ORDER BY l.ts DESC LIMIT 1
+        """, (ip,)).fetchone()
+        return app._de_milesimos(row[0]) if row else None
+
+
+def catalogo(args):
+    """Mide la carga del tóner de cada impresora del catálogo: una consulta por IP sobre
+    el historial, una por IP sobre ultima_lectura (db_ultimo_toner) y la consulta única
+    de db_ultimos_niveles que usa el catálogo."""
+    print(f"{'Impresoras':>10}{'Historial ms':>14}{'Por IP ms':>12}{'Masiva ms':>12}{'x':>8}")
+    with tempfile.TemporaryDirectory() as carpeta:
+        for n in args.impresoras:
+            app.DB_PATH = os.path.join(carpeta, f"catalogo_{n}.db")
+            app.init_db()
+            _poblar_db(n, args.corridas)
+            ips = [imp["ip"] for imp in app.db_impresoras_todas()]
+
+            def historial():
+                return {ip: _ultimo_toner_historial(ip) for ip in ips}
+
+            def por_ip():
+                return {ip: app.db_ultimo_toner(ip) for ip in ips}
+
+            def masiva():
+                return {ip: niveles[0] for ip, niveles in app.db_ultimos_niveles().items()}
+
+            if not historial() == por_ip() == masiva():
+                print(f"{n:>10}  <-- los resultados difieren")
+                return 1
+            ms_hist, _ = _medir(historial, args.n)
+            ms_ip, _   = _medir(por_ip, args.n)
+            ms_bulk, _ = _medir(masiva, args.n)
+            print(f"{n:>10}{ms_hist:>14.1f}{ms_ip:>12.1f}{ms_bulk:>12.1f}"
+                  f"{ms_hist / ms_bulk if ms_bulk else 0:>8.1f}")
+            app._db_descartar_conexion()
+    return 0
+
+# ---------------------------------------------------------------------------
+# Benchmark del pronóstico
+# ---------------------------------------------------------------------------
+
+def _poblar_consumo(n_impresoras, dias, por_dia, historia=0):
+    """Crea impresoras con por_dia lecturas diarias durante `dias` días: el tóner baja
+    a un ritmo propio de cada impresora y la mitad tuvo un recambio a mitad del período.
+    Antes de esas lecturas agrega `historia` días de resumen_diario, que el pronóstico
+    no usa pero tiene que saltear."""
+    paso = 86400 // por_dia
+    ts0  = int(time.time()) - dias * 86400
+    with app.db_connect() as conn:
+        conn.executemany(
+            "INSERT INTO impresoras (ip, modelo, sucursal) VALUES (?, 'Lexmark MS811', ?)",
+            [(f"10.{i // 65536}.{i // 256 % 256}.{i % 256}", f"Sucursal {i % 60}")
+             for i in range(n_impresoras)])
+        ids = [r[0] for r in conn.execute("SELECT id FROM impresoras")]
+        for k in range(dias * por_dia):
+            ts = ts0 + k * paso
+            filas = []
+            for id_ in ids:
+                ritmo = 5 + id_ % 20                    # milésimas por día
+                dia   = k / por_dia
+                if id_ % 2 and dia >= dias / 2:         # recambio
+                    dia -= dias / 2
+                filas.append((id_, ts, ts * 1000, max(0, int(1000 - ritmo * dia)), 600, None))
+            conn.executemany(
+                "INSERT INTO lecturas (impresora_id, ts, corrida_id, toner, unidad, kit) "
+                "VALUES (?, ?, ?, ?, ?, ?)", filas)
+        filas = []
+        for d in range(1, historia + 1):
+            ts      = ts0 - d * 86400
+            periodo = int(datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0,
+                                                             microsecond=0).timestamp())
+            filas += [(id_, periodo, por_dia, ts, 500, 500, 500, 600, 600, 600)
+                      for id_ in ids]
+        conn.executemany(
+            "INSERT INTO resumen_diario (impresora_id, periodo, n, ts_ult, toner_min, "
+            "toner_max, toner_ult, unidad_min, unidad_max, unidad_ult) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", filas)
+
+
+def _pronostico_por_impresora(ids, dias):
+    """Lo que costaría pronosticar de a una impresora: una consulta sobre los mismos
+    datos que db_pronosticos_actualizar (resumen_diario y ultima_lectura) y un polyfit
+    por consumible, con el mismo tramo desde el recambio y los mismos límites.
+    Retorna {impresora_id: [ts de agotamiento o None para tóner, unidad y kit]}."""
+    ahora = int(time.time())
+    desde = ahora - dias * 86400
+    resultado = {}
+    with app.db_connect() as conn:
+        for id_ in ids:
+            filas = conn.execute("""
+                SELECT r.ts_ult, r.toner_ult, r.unidad_ult, r.kit_ult FROM resumen_diario r
+                WHERE r.impresora_id = ? AND r.periodo >= ?
+                UNION ALL
+                SELECT u.ts_ok, u.toner_ok, u.unidad_ok, u.kit_ok FROM ultima_lectura u
+                WHERE u.impresora_id = ? AND u.ts_ok >= ? AND u.ts_ok > (
+                    SELECT r.ts_ult FROM resumen_diario r WHERE r.impresora_id = u.impresora_id
+                    ORDER BY r.periodo DESC LIMIT 1)
+                ORDER BY 1
+            """, (id_, desde, id_, desde)).fetchall()
+            fechas = []
+            for c in range(1, 4):
+                pares = [(f[0], f[c]) for f in filas if f[c] is not None]
+                inicio = 0
+                for i in range(1, len(pares)):
+                    if pares[i][1] - pares[i - 1][1] > app.PRONOSTICO_SALTO:
+                        inicio = i
+                pares = pares[inicio:]
+                fecha = None
+                if len(pares) >= app.PRONOSTICO_MIN_LECTURAS:
+                    x = np.array([(t - ahora) / 86400.0 for t, _ in pares])
+                    pendiente, ordenada = np.polyfit(x, [v for _, v in pares], 1)
+                    if pendiente < 0 and 0 < -ordenada / pendiente <= app.PRONOSTICO_MAX_DIAS:
+                        fecha = ahora - ordenada / pendiente * 86400
+                fechas.append(fecha)
+            resultado[id_] = fechas
+    return resultado
+
+
+def _diferencias_pronostico(por_ip, tolerancia):
+    """Compara el resultado de _pronostico_por_impresora con la tabla pronosticos.
+    Retorna [(impresora_id, consumible, por impresora, flota)] de los que difieren en
+    más de `tolerancia` segundos o tienen fecha en uno solo de los dos."""
+    with app.db_connect() as conn:
+        flota = {r[0]: list(r[1:]) for r in conn.execute(
+            "SELECT impresora_id, toner, unidad, kit FROM pronosticos")}
+    distintos = []
+    for id_, fechas in por_ip.items():
+        for consumible, a, b in zip(("toner", "unidad", "kit"), fechas,
+                                    flota.get(id_, [None] * 3)):
+            if (a is None) != (b is None) or (a is not None and abs(a - b) > tolerancia):
+                distintos.append((id_, consumible, a, b))
+    return distintos
+
+
+def pronostico(args):
+    """Mide db_pronosticos_actualizar (una consulta sobre resumen_diario y un ajuste
+    vectorizado) contra una consulta y un polyfit por impresora sobre los mismos datos,
+    y verifica que los dos den las mismas fechas."""
+    print(f"{'Impresoras':>10}{'Lecturas':>10}{'Por IP ms':>12}{'Flota ms':>11}{'x':>8}{'Con fecha':>11}")
+    with tempfile.TemporaryDirectory() as carpeta:
+        for n in args.impresoras:
+            app.DB_PATH = os.path.join(carpeta, f"pronostico_{n}.db")
+            app.init_db()
+            _poblar_consumo(n, args.dias, args.por_dia, args.historia)
+            with app.db_connect() as conn:
+                ids = [r[0] for r in conn.execute("SELECT id FROM impresoras")]
+
+            ms_ip, _    = _medir(lambda: _pronostico_por_impresora(ids, args.dias), args.n)
+            ms_flota, _ = _medir(lambda: app.db_pronosticos_actualizar(args.dias), args.n)
+            distintos = _diferencias_pronostico(_pronostico_por_impresora(ids, args.dias),
+                                                args.tolerancia)
+            con_fecha = len(app.db_pronosticos())
+            print(f"{n:>10}{n * args.dias * args.por_dia:>10}{ms_ip:>12.1f}{ms_flota:>11.1f}"
+                  f"{ms_ip / ms_flota if ms_flota else 0:>8.1f}{con_fecha:>11}")
+            app._db_descartar_conexion()
+            if distintos:
+                for id_, consumible, a, b in distintos[:5]:
+                    print(f"    impresora {id_} {consumible}: por impresora {a}  flota {b}")
+                print(f"\nFALLO: {len(distintos)} pronóstico(s) difieren en más de "
+                      f"{args.tolerancia} s.")
+                return 1
+    print(f"\nOK: los dos cálculos dan las mismas fechas (tolerancia {args.tolerancia} s).")
+    return 0
+
+# ---------------------------------------------------------------------------
+# Entrada
+# ---------------------------------------------------------------------------
+
+def main(argv=None):
+    ap  = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = ap.add_subparsers(dest="comando", required=True)
+
+    p_cap = sub.add_parser("capturar", help="Guardar PrinterStatus.html de cada modelo")
+    p_cap.add_argument("--intentos", type=int, default=3,
+                       help="IPs a probar por modelo antes de desistir")
+    p_cap.set_defaults(fn=capturar)
+
+    p_par = sub.add_parser("parser", help="Medir y validar el parseo de los fixtures")
+    p_par.add_argument("-n", type=int, default=200, help="Repeticiones por página")
+    p_par.add_argument("--estricto", action="store_true",
+                       help="Fallar también si algún modelo no tiene fixture")
+    p_par.add_argument("--aleatorias", type=int, default=20000,
+                       help="Páginas aleatorias a comparar contra BeautifulSoup")
+    p_par.add_argument("--semilla", type=int, default=2024, help="Semilla de las páginas aleatorias")
+    p_par.set_defaults(fn=parser)
+
+    p_cat = sub.add_parser("catalogo", help="Medir la carga de niveles del catálogo")
+    p_cat.add_argument("--impresoras", type=int, nargs="+", default=[100, 1000, 10000],
+                       help="Tamaños de flota a medir")
+    p_cat.add_argument("--corridas", type=int, default=50, help="Lecturas por impresora")
+    p_cat.add_argument("-n", type=int, default=5, help="Repeticiones por tamaño")
+    p_cat.set_defaults(fn=catalogo)
+
+    p_pro = sub.add_parser("pronostico", help="Medir el pronóstico de agotamiento de la flota")
+    p_pro.add_argument("--impresoras", type=int, nargs="+", default=[100, 500, 2000],
+                       help="Tamaños de flota a medir")
+    p_pro.add_argument("--dias", type=int, default=30, help="Días de lecturas")
+    p_pro.add_argument("--por-dia", type=int, default=24, help="Lecturas por impresora y día")
+    p_pro.add_argument("--historia", type=int, default=365,
+                       help="Días de resumen_diario anteriores a las lecturas")
+    p_pro.add_argument("-n", type=int, default=3, help="Repeticiones por tamaño")
+    p_pro.add_argument("--tolerancia", type=float, default=60,
+                       help="Diferencia máxima en segundos entre los dos cálculos")
+    p_pro.set_defaults(fn=pronostico)
+
+    args = ap.parse_args(argv)
+    return args.fn(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,15 @@
-import requests
 from bs4 import BeautifulSoup
+from bs4.dammit import EntitySubstitution
 import re
+import argparse
+import csv
 import json
+import queue
+import itertools
+import asyncio
 import os
 import sys
+import time
 import logging
 import sqlite3
 import smtplib
@@ -13,14 +19,16 @@ from contextlib import contextmanager
 import numpy as np
 from types import SimpleNamespace
 from openpyxl import load_workbook, Workbook
-from openpyxl.styles import PatternFill, Font, Alignment
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Font, Alignment, NamedStyle
+from openpyxl.utils import get_column_letter
 from datetime import datetime, timedelta
+from urllib.parse import urljoin, urlsplit
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog
 from tkinter.ttk import Progressbar, Treeview, Scrollbar, Spinbox, Combobox, Style
 import tkinter.ttk as ttk
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import matplotlib
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
@@ -43,6 +51,21 @@ COLOR_BAJO      = "#FF6B6B"
 COLOR_MEDIO     = "#FFD93D"
 COLOR_SIN_DATOS = "#CCCCCC"
 
+TEXTO_EN_ESPERA = "sin datos (en espera)"   # impresora con circuito abierto, no consultada
+
+# Rango (días) hasta el cual el gráfico usa lecturas crudas, y luego el resumen diario;
+# para rangos más largos usa el resumen semanal
+GRAFICO_DIAS_DETALLE = 90
+GRAFICO_DIAS_DIARIO  = 730
+
+# Pronóstico de agotamiento de la flota: recta por mínimos cuadrados sobre el último
+# valor de cada día (resumen_diario) de los últimos días, desde el último recambio
+# (una suba de más de PRONOSTICO_SALTO)
+PRONOSTICO_DIAS_DEFAULT  = 30
+PRONOSTICO_SALTO         = 100   # milésimas
+PRONOSTICO_MIN_LECTURAS  = 3
+PRONOSTICO_MAX_DIAS      = 3650
+
 VERSION = "v1.0.0"
 
 BG_MAIN           = "#F5F5F5"
@@ -56,7 +79,8 @@ FONT_TABLE        = ("Segoe UI", 9)
 FONT_NUM          = ("Segoe UI", 11, "bold")
 
 # 6 columnas: Sucursal primero
-COLUMNAS_TREE = ("Sucursal", "IP", "Modelo", "Último Monitoreo", "Tóner (%)", "Unidad Imagen (%)", "Kit Mantenimiento (%)")
+COLUMNAS_TREE = ("Sucursal", "IP", "Modelo", "Último Monitoreo", "Tóner (%)", "Unidad Imagen (%)", "Kit Mantenimiento (%)",
+                 "Agota el")
 
 TIPOS_INSUMO = ["Tóner", "Unidad Imagen"]
 
@@ -137,18 +161,104 @@ if not _log.handlers:
 # Config persistente
 # ---------------------------------------------------------------------------
 
+# config.json se lee una vez y queda en memoria: cada cargar_config() solo compara la
+# fecha de modificación y el tamaño del archivo, y lo vuelve a leer si otro proceso o
+# una edición a mano lo cambió. guardar_config() escribe un temporal y lo renombra, así
+# nunca queda un archivo a medio escribir, y avisa a los suscriptores.
+
+class _Configuracion:
+    """Caché de config.json con suscriptores a los cambios."""
+
+    def __init__(self):
+        self._lock         = threading.RLock()
+        self._datos        = {}
+        self._firma        = None    # (ruta, mtime_ns, tamaño) de lo que hay en _datos
+        self._suscriptores = []
+
+    @staticmethod
+    def _firma_archivo():
+        try:
+            st = os.stat(CONFIG_PATH)
+        except OSError:
+            return (CONFIG_PATH, None, None)
+        return (CONFIG_PATH, st.st_mtime_ns, st.st_size)
+
+    def _refrescar(self):
+        """Relee el archivo si cambió. Retorna {clave: valor nuevo} de lo que cambió."""
+        firma = self._firma_archivo()
+        if firma == self._firma:
+            return {}
+        datos = {}
+        if firma[1] is not None:
+            try:
+                with open(CONFIG_PATH, "r") as f:
+                    datos = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                _log.error("No se pudo leer %s: %s", CONFIG_PATH, e)
+        cambios = _cambios_config(self._datos, datos) if self._firma is not None else {}
+        self._datos, self._firma = datos, firma
+        return cambios
+
+    def cargar(self):
+        """Retorna una copia de la configuración vigente."""
+        with self._lock:
+            cambios = self._refrescar()
+            datos   = dict(self._datos)
+        self._avisar(cambios)
+        return datos
+
+    def guardar(self, valores):
+        """Actualiza las claves de `valores` y escribe el archivo de forma atómica."""
+        with self._lock:
+            cambios = self._refrescar()
+            datos   = {**self._datos, **valores}
+            temporal = CONFIG_PATH + ".tmp"
+            with open(temporal, "w") as f:
+                json.dump(datos, f, indent=2)
+            os.replace(temporal, CONFIG_PATH)
+            cambios.update(_cambios_config(self._datos, datos))
+            self._datos, self._firma = datos, self._firma_archivo()
+        self._avisar(cambios)
+
+    def suscribir(self, funcion):
+        """Registra funcion(cambios), llamada con {clave: valor nuevo} cada vez que la
+        configuración cambia. Se llama en el hilo que detectó el cambio: las ventanas
+        deben pasar por after(). Retorna la función para anular la suscripción."""
+        with self._lock:
+            self._suscriptores.append(funcion)
+        return lambda: self.desuscribir(funcion)
+
+    def desuscribir(self, funcion):
+        with self._lock:
+            if funcion in self._suscriptores:
+                self._suscriptores.remove(funcion)
+
+    def _avisar(self, cambios):
+        if not cambios:
+            return
+        with self._lock:
+            suscriptores = list(self._suscriptores)
+        for funcion in suscriptores:
+            try:
+                funcion(cambios)
+            except Exception as e:
+                _log.error("Error al avisar un cambio de configuración: %s", e)
+
+
+def _cambios_config(anterior, nueva):
+    """Retorna {clave: valor nuevo (None si se borró)} de las claves que difieren."""
+    return {k: nueva.get(k) for k in anterior.keys() | nueva.keys()
+            if anterior.get(k) != nueva.get(k)}
+
+
+_config = _Configuracion()
+
+
 def cargar_config():
-    try:
-        with open(CONFIG_PATH, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    return _config.cargar()
 
 def guardar_config(**kwargs):
-    config = cargar_config()
-    config.update(kwargs)
-    with open(CONFIG_PATH, "w") as f:
-        json.dump(config, f, indent=2)
+    _config.guardar(kwargs)
 
 
 def _inicializar_db_path():
@@ -166,121 +276,707 @@ def _inicializar_db_path():
 # Base de datos SQLite
 # ---------------------------------------------------------------------------
 
+# Una conexión por hilo, reutilizada entre llamadas. Abrir la DB en un recurso
+# de red cuesta varios viajes SMB, y las pantallas hacen decenas de consultas.
+_db_hilo = threading.local()
+
+# Códigos primarios de SQLite que indican que el archivo dejó de ser accesible o
+# usable; solo con estos se descarta la conexión (no con "database is locked")
+_DB_ERRORES_FATALES = {sqlite3.SQLITE_IOERR, sqlite3.SQLITE_CANTOPEN,
+                       sqlite3.SQLITE_NOTADB, sqlite3.SQLITE_CORRUPT}
+
+
+def _db_conexion_hilo():
+    """Retorna la conexión del hilo actual, abriéndola si no existe o si cambió DB_PATH."""
+    conn = getattr(_db_hilo, "conn", None)
+    if conn is not None and _db_hilo.ruta != DB_PATH and not _db_hilo.profundidad:
+        _db_descartar_conexion()
+        conn = None
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=10, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_hilo.conn        = conn
+        _db_hilo.ruta        = DB_PATH
+        _db_hilo.profundidad = 0
+    return conn
+
+
+def _db_descartar_conexion():
+    """Cierra la conexión del hilo actual; la próxima llamada abre una nueva."""
+    conn = getattr(_db_hilo, "conn", None)
+    _db_hilo.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
 @contextmanager
 def db_connect():
-    """Context manager para conexiones SQLite con commit/rollback automático."""
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
+    """Context manager para conexiones SQLite con commit/rollback automático.
+
+    Reutiliza la conexión del hilo. Los bloques anidados comparten la transacción:
+    solo el más externo hace commit o rollback. Ante un error de E/S (la DB de red
+    dejó de estar accesible) la conexión se descarta para reabrirla en el próximo uso.
+    """
+    conn = _db_conexion_hilo()
+    _db_hilo.profundidad += 1
+    externo = _db_hilo.profundidad == 1
     try:
         yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
+        if externo:
+            conn.commit()
+    except Exception as e:
+        if externo:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                _db_descartar_conexion()
+            codigo = getattr(e, "sqlite_errorcode", None)
+            if codigo is not None and codigo & 0xFF in _DB_ERRORES_FATALES:
+                _db_descartar_conexion()
         raise
     finally:
-        conn.close()
+        _db_hilo.profundidad -= 1
 
 
-def init_db():
-    """Crea las tablas si no existen. Se llama al arrancar la aplicación."""
-    with db_connect() as conn:
-        conn.executescript("""
-            CREATE TABLE IF NOT EXISTS impresoras (
-                id       INTEGER PRIMARY KEY AUTOINCREMENT,
-                ip       TEXT NOT NULL UNIQUE,
-                modelo   TEXT NOT NULL,
-                sucursal TEXT NOT NULL DEFAULT '',
-                nombre   TEXT          DEFAULT '',
-                sn       TEXT          DEFAULT '',
-                activa   INTEGER NOT NULL DEFAULT 1
-            );
-            CREATE TABLE IF NOT EXISTS monitoreos (
-                id                INTEGER PRIMARY KEY AUTOINCREMENT,
-                fecha             TEXT NOT NULL,
-                ip                TEXT NOT NULL,
-                toner             REAL,
-                unidad_imagen     REAL,
-                kit_mantenimiento REAL
-            );
-            CREATE TABLE IF NOT EXISTS envios (
+# ---------------------------------------------------------------------------
+# Migraciones de esquema
+# ---------------------------------------------------------------------------
+# Cada migración se aplica una sola vez y deja PRAGMA user_version en su número.
+# Las DBs creadas antes de este esquema (user_version 0) pasan por la migración 1,
+# que conserva las verificaciones de columnas y tablas de versiones anteriores.
+
+def _migracion_001_esquema_base(conn):
+    """Tablas base y migraciones introspectivas de versiones anteriores."""
+    for sql in (
+        """
+        CREATE TABLE IF NOT EXISTS impresoras (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            ip       TEXT NOT NULL UNIQUE,
+            modelo   TEXT NOT NULL,
+            sucursal TEXT NOT NULL DEFAULT '',
+            nombre   TEXT          DEFAULT '',
+            sn       TEXT          DEFAULT '',
+            activa   INTEGER NOT NULL DEFAULT 1
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS monitoreos (
+            id                INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha             TEXT NOT NULL,
+            ip                TEXT NOT NULL,
+            toner             REAL,
+            unidad_imagen     REAL,
+            kit_mantenimiento REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS envios (
+            id               INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha            TEXT NOT NULL,
+            sucursal         TEXT NOT NULL,
+            ip               TEXT DEFAULT '',
+            tipo_insumo      TEXT NOT NULL,
+            modelo_impresora TEXT NOT NULL,
+            cantidad         INTEGER NOT NULL DEFAULT 1
+        )
+        """,
+    ):
+        conn.execute(sql)
+    # Migración: agrega columna sn a DBs existentes que no la tienen
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(impresoras)").fetchall()}
+    if "sn" not in cols:
+        conn.execute("ALTER TABLE impresoras ADD COLUMN sn TEXT DEFAULT ''")
+    # Migración: tablas de stock (para DBs creadas antes de esta versión)
+    tablas = {r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    if "stock_deposito" not in tablas:
+        conn.execute("""
+            CREATE TABLE stock_deposito (
                 id               INTEGER PRIMARY KEY AUTOINCREMENT,
-                fecha            TEXT NOT NULL,
-                sucursal         TEXT NOT NULL,
-                ip               TEXT DEFAULT '',
-                tipo_insumo      TEXT NOT NULL,
-                modelo_impresora TEXT NOT NULL,
-                cantidad         INTEGER NOT NULL DEFAULT 1
-            );
+                tipo_insumo      TEXT    NOT NULL,
+                modelo_impresora TEXT    NOT NULL,
+                cantidad         INTEGER NOT NULL DEFAULT 0,
+                stock_minimo     INTEGER NOT NULL DEFAULT 2,
+                UNIQUE(tipo_insumo, modelo_impresora)
+            )
         """)
-        # Migración: agrega columna sn a DBs existentes que no la tienen
-        cols = {r[1] for r in conn.execute("PRAGMA table_info(impresoras)").fetchall()}
-        if "sn" not in cols:
-            conn.execute("ALTER TABLE impresoras ADD COLUMN sn TEXT DEFAULT ''")
-        # Migración: tablas de stock (para DBs creadas antes de esta versión)
-        tablas = {r[0] for r in conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
-        if "stock_deposito" not in tablas:
-            conn.execute("""
-                CREATE TABLE stock_deposito (
-                    id               INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tipo_insumo      TEXT    NOT NULL,
-                    modelo_impresora TEXT    NOT NULL,
-                    cantidad         INTEGER NOT NULL DEFAULT 0,
-                    stock_minimo     INTEGER NOT NULL DEFAULT 2,
-                    UNIQUE(tipo_insumo, modelo_impresora)
-                )
-            """)
-        if "movimientos_stock" not in tablas:
-            conn.execute("""
-                CREATE TABLE movimientos_stock (
-                    id               INTEGER PRIMARY KEY AUTOINCREMENT,
-                    fecha            TEXT    NOT NULL,
-                    tipo             TEXT    NOT NULL,
-                    tipo_insumo      TEXT    NOT NULL,
-                    modelo_impresora TEXT    NOT NULL,
-                    cantidad         INTEGER NOT NULL,
-                    observacion      TEXT    DEFAULT '',
-                    envio_id         INTEGER DEFAULT NULL
-                )
-            """)
-        # Migración: columna anulado en envios
-        cols_env = {r[1] for r in conn.execute("PRAGMA table_info(envios)").fetchall()}
-        if "anulado" not in cols_env:
-            conn.execute("ALTER TABLE envios ADD COLUMN anulado INTEGER NOT NULL DEFAULT 0")
-        # Migración: columna ubicacion en impresoras
-        if "ubicacion" not in cols:
-            conn.execute("ALTER TABLE impresoras ADD COLUMN ubicacion TEXT DEFAULT ''")
-        # Migración: tabla modelos
-        tablas2 = {r[0] for r in conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
-        if "modelos" not in tablas2:
-            conn.execute("""
-                CREATE TABLE modelos (
-                    id     INTEGER PRIMARY KEY AUTOINCREMENT,
-                    nombre TEXT NOT NULL UNIQUE
-                )
-            """)
-            # Poblar desde MODELOS_CONFIG + modelos existentes en impresoras
-            conocidos = set()
-            for m in MODELOS_CONFIG:
+    if "movimientos_stock" not in tablas:
+        conn.execute("""
+            CREATE TABLE movimientos_stock (
+                id               INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha            TEXT    NOT NULL,
+                tipo             TEXT    NOT NULL,
+                tipo_insumo      TEXT    NOT NULL,
+                modelo_impresora TEXT    NOT NULL,
+                cantidad         INTEGER NOT NULL,
+                observacion      TEXT    DEFAULT '',
+                envio_id         INTEGER DEFAULT NULL
+            )
+        """)
+    # Migración: columna anulado en envios
+    cols_env = {r[1] for r in conn.execute("PRAGMA table_info(envios)").fetchall()}
+    if "anulado" not in cols_env:
+        conn.execute("ALTER TABLE envios ADD COLUMN anulado INTEGER NOT NULL DEFAULT 0")
+    # Migración: columna ubicacion en impresoras
+    if "ubicacion" not in cols:
+        conn.execute("ALTER TABLE impresoras ADD COLUMN ubicacion TEXT DEFAULT ''")
+    # Migración: tabla modelos
+    tablas2 = {r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    if "modelos" not in tablas2:
+        conn.execute("""
+            CREATE TABLE modelos (
+                id     INTEGER PRIMARY KEY AUTOINCREMENT,
+                nombre TEXT NOT NULL UNIQUE
+            )
+        """)
+        # Poblar desde MODELOS_CONFIG + modelos existentes en impresoras
+        conocidos = set()
+        for m in MODELOS_CONFIG:
+            conn.execute("INSERT OR IGNORE INTO modelos (nombre) VALUES (?)", (m,))
+            conocidos.add(m)
+        extras = conn.execute(
+            "SELECT DISTINCT modelo FROM impresoras WHERE modelo!=''").fetchall()
+        for (m,) in extras:
+            if m not in conocidos:
                 conn.execute("INSERT OR IGNORE INTO modelos (nombre) VALUES (?)", (m,))
-                conocidos.add(m)
-            extras = conn.execute(
-                "SELECT DISTINCT modelo FROM impresoras WHERE modelo!=''").fetchall()
-            for (m,) in extras:
-                if m not in conocidos:
-                    conn.execute("INSERT OR IGNORE INTO modelos (nombre) VALUES (?)", (m,))
-        # Migración: columna modelo_id en impresoras
-        cols3 = {r[1] for r in conn.execute("PRAGMA table_info(impresoras)").fetchall()}
-        if "modelo_id" not in cols3:
-            conn.execute("ALTER TABLE impresoras ADD COLUMN modelo_id INTEGER REFERENCES modelos(id)")
-            conn.execute("""
-                UPDATE impresoras SET modelo_id = (
-                    SELECT id FROM modelos WHERE modelos.nombre = impresoras.modelo
-                )
+    # Migración: columna modelo_id en impresoras
+    cols3 = {r[1] for r in conn.execute("PRAGMA table_info(impresoras)").fetchall()}
+    if "modelo_id" not in cols3:
+        conn.execute("ALTER TABLE impresoras ADD COLUMN modelo_id INTEGER REFERENCES modelos(id)")
+        conn.execute("""
+            UPDATE impresoras SET modelo_id = (
+                SELECT id FROM modelos WHERE modelos.nombre = impresoras.modelo
+            )
+        """)
+    # Migración: corrida a la que pertenece cada lectura (id = inicio en ms epoch)
+    cols_mon = {r[1] for r in conn.execute("PRAGMA table_info(monitoreos)").fetchall()}
+    if "corrida_id" not in cols_mon:
+        conn.execute("ALTER TABLE monitoreos ADD COLUMN corrida_id INTEGER")
+    # Migración: tabla corridas (una fila por monitoreo, con sus totales)
+    tablas3 = {r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    if "corridas" not in tablas3:
+        conn.execute("""
+            CREATE TABLE corridas (
+                id           INTEGER PRIMARY KEY,
+                inicio       TEXT    NOT NULL,
+                fin          TEXT,
+                duracion     REAL,
+                automatico   INTEGER NOT NULL DEFAULT 0,
+                estado       TEXT    NOT NULL DEFAULT 'en_curso',
+                total        INTEGER NOT NULL DEFAULT 0,
+                ok           INTEGER NOT NULL DEFAULT 0,
+                bajo         INTEGER NOT NULL DEFAULT 0,
+                medio        INTEGER NOT NULL DEFAULT 0,
+                sin_datos    INTEGER NOT NULL DEFAULT 0,
+                umbral_bajo  INTEGER,
+                umbral_medio INTEGER
+            )
+        """)
+        conn.execute("CREATE INDEX idx_corridas_inicio ON corridas(inicio)")
+        _migrar_corridas(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_monitoreos_corrida ON monitoreos(corrida_id)")
+    # Migración: backend de consulta por modelo (http = PrinterStatus.html, snmp = Printer-MIB)
+    cols_mod = {r[1] for r in conn.execute("PRAGMA table_info(modelos)").fetchall()}
+    if "backend" not in cols_mod:
+        conn.execute("ALTER TABLE modelos ADD COLUMN backend TEXT NOT NULL DEFAULT 'http'")
+        conn.execute("ALTER TABLE modelos ADD COLUMN snmp_indices TEXT DEFAULT ''")
+    # Migración: circuito por IP (impresoras que no responden)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS circuitos (
+            ip           TEXT PRIMARY KEY,
+            fallos       INTEGER NOT NULL DEFAULT 0,
+            aperturas    INTEGER NOT NULL DEFAULT 0,
+            proximo      TEXT,
+            ultimo_fallo TEXT
+        )
+    """)
+    # Migración: latencia suavizada por IP (timeouts adaptativos)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS latencias (
+            ip       TEXT PRIMARY KEY,
+            srtt     REAL,
+            rttvar   REAL,
+            muestras INTEGER NOT NULL DEFAULT 0,
+            ultima   REAL,
+            fecha    TEXT
+        )
+    """)
+
+
+def _migracion_002_indices(conn):
+    """Índices para los filtros por IP y fecha de historial, gráficos, envíos y stock."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_monitoreos_ip_fecha ON monitoreos(ip, fecha)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_monitoreos_fecha    ON monitoreos(fecha)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_envios_fecha        "
+                 "ON envios(fecha, sucursal, tipo_insumo)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_movimientos_fecha   ON movimientos_stock(fecha)")
+    conn.execute("ANALYZE")
+
+
+def _migracion_003_lecturas(conn):
+    """Pasa monitoreos a la tabla compacta lecturas y deja una vista con el formato anterior.
+
+    lecturas guarda el id de la impresora en lugar de la IP, la fecha como segundos
+    epoch (UTC) y los niveles en milésimas enteras (0.215 -> 215). Las lecturas de IPs
+    que ya no están en el catálogo se conservan dando de alta la impresora como inactiva.
+    """
+    conn.execute("""
+        CREATE TABLE lecturas (
+            id           INTEGER PRIMARY KEY,
+            impresora_id INTEGER NOT NULL REFERENCES impresoras(id),
+            ts           INTEGER NOT NULL,
+            corrida_id   INTEGER,
+            toner        INTEGER,
+            unidad       INTEGER,
+            kit          INTEGER
+        )
+    """)
+    conn.execute("""
+        INSERT INTO impresoras (ip, modelo, sucursal, activa)
+        SELECT DISTINCT ip, '', '', 0 FROM monitoreos
+        WHERE ip NOT IN (SELECT ip FROM impresoras)
+    """)
+    # Las filas que no se pueden pasar (fecha que no se interpreta o sin IP) quedan en
+    # monitoreos_invalidas para revisarlas a mano, en lugar de perderse con monitoreos
+    condicion = "strftime('%s', fecha, 'utc') IS NULL OR ip IS NULL"
+    conn.execute(f"CREATE TABLE monitoreos_invalidas AS SELECT * FROM monitoreos WHERE {condicion}")
+    invalidas = conn.execute("SELECT COUNT(*) FROM monitoreos_invalidas").fetchone()[0]
+    if invalidas:
+        _log.error("Migración de monitoreos a lecturas: %d filas con fecha o IP inválida "
+                   "quedan en la tabla monitoreos_invalidas", invalidas)
+    else:
+        conn.execute("DROP TABLE monitoreos_invalidas")
+    # 'utc' interpreta la fecha guardada como hora local, igual que datetime.timestamp()
+    conn.execute("""
+        INSERT INTO lecturas (id, impresora_id, ts, corrida_id, toner, unidad, kit)
+        SELECT m.id, i.id, CAST(strftime('%s', m.fecha, 'utc') AS INTEGER), m.corrida_id,
+               CAST(ROUND(m.toner * 1000) AS INTEGER),
+               CAST(ROUND(m.unidad_imagen * 1000) AS INTEGER),
+               CAST(ROUND(m.kit_mantenimiento * 1000) AS INTEGER)
+        FROM monitoreos m
+        JOIN impresoras i ON i.ip = m.ip
+        WHERE strftime('%s', m.fecha, 'utc') IS NOT NULL
+    """)
+    conn.execute("DROP TABLE monitoreos")
+    conn.execute("CREATE INDEX idx_lecturas_impresora_ts ON lecturas(impresora_id, ts)")
+    conn.execute("CREATE INDEX idx_lecturas_ts           ON lecturas(ts)")
+    conn.execute("CREATE INDEX idx_lecturas_corrida      ON lecturas(corrida_id)")
+    # Vista de compatibilidad para consultas y herramientas externas que leen monitoreos
+    conn.execute("""
+        CREATE VIEW monitoreos AS
+        SELECT l.id,
+               strftime('%Y-%m-%d %H:%M:%S', l.ts, 'unixepoch', 'localtime') AS fecha,
+               i.ip,
+               l.toner  / 1000.0 AS toner,
+               l.unidad / 1000.0 AS unidad_imagen,
+               l.kit    / 1000.0 AS kit_mantenimiento,
+               l.corrida_id
+        FROM lecturas l
+        JOIN impresoras i ON i.id = l.impresora_id
+    """)
+    conn.execute("""
+        CREATE TRIGGER monitoreos_insertar INSTEAD OF INSERT ON monitoreos
+        BEGIN
+            SELECT RAISE(ABORT, 'IP fuera del catálogo de impresoras')
+            WHERE NOT EXISTS (SELECT 1 FROM impresoras WHERE ip = NEW.ip);
+            INSERT INTO lecturas (impresora_id, ts, corrida_id, toner, unidad, kit)
+            VALUES ((SELECT id FROM impresoras WHERE ip = NEW.ip),
+                    CAST(strftime('%s', NEW.fecha, 'utc') AS INTEGER), NEW.corrida_id,
+                    CAST(ROUND(NEW.toner * 1000) AS INTEGER),
+                    CAST(ROUND(NEW.unidad_imagen * 1000) AS INTEGER),
+                    CAST(ROUND(NEW.kit_mantenimiento * 1000) AS INTEGER));
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER monitoreos_borrar INSTEAD OF DELETE ON monitoreos
+        BEGIN
+            DELETE FROM lecturas WHERE id = OLD.id;
+        END
+    """)
+    conn.execute("ANALYZE")
+    return True
+
+
+# Recalcula ultima_lectura de las impresoras que cumplen {filtro} (condición sobre lecturas)
+_SQL_RECALCULAR_ULTIMA = """
+    INSERT INTO ultima_lectura (impresora_id, ts, corrida_id, toner, unidad, kit,
+                                ts_ok, toner_ok, unidad_ok, kit_ok)
+    SELECT u.impresora_id, u.ts, u.corrida_id, u.toner, u.unidad, u.kit,
+           (SELECT MAX(l.ts) FROM lecturas l WHERE l.impresora_id = u.impresora_id
+              AND COALESCE(l.toner, l.unidad, l.kit) IS NOT NULL),
+           (SELECT l.toner FROM lecturas l WHERE l.impresora_id = u.impresora_id
+              AND l.toner IS NOT NULL ORDER BY l.ts DESC LIMIT 1),
+           (SELECT l.unidad FROM lecturas l WHERE l.impresora_id = u.impresora_id
+              AND l.unidad IS NOT NULL ORDER BY l.ts DESC LIMIT 1),
+           (SELECT l.kit FROM lecturas l WHERE l.impresora_id = u.impresora_id
+              AND l.kit IS NOT NULL ORDER BY l.ts DESC LIMIT 1)
+    FROM (SELECT impresora_id, MAX(ts) AS ts, corrida_id, toner, unidad, kit
+          FROM lecturas WHERE {filtro} GROUP BY impresora_id) u
+"""
+
+
+def _migracion_004_ultima_lectura(conn):
+    """Tabla ultima_lectura: una fila por impresora con su último intento y,
+    por separado, el último valor no nulo de cada consumible.
+
+    Los triggers de lecturas la mantienen en la misma transacción que cada
+    INSERT. Borrar lecturas viejas no la modifica (los valores *_ok conservan el
+    último nivel conocido); borrar la más reciente de una impresora la recalcula.
+    """
+    conn.execute("""
+        CREATE TABLE ultima_lectura (
+            impresora_id INTEGER PRIMARY KEY REFERENCES impresoras(id),
+            ts           INTEGER NOT NULL,
+            corrida_id   INTEGER,
+            toner        INTEGER,
+            unidad       INTEGER,
+            kit          INTEGER,
+            ts_ok        INTEGER,
+            toner_ok     INTEGER,
+            unidad_ok    INTEGER,
+            kit_ok       INTEGER
+        )
+    """)
+    conn.execute(_SQL_RECALCULAR_ULTIMA.format(filtro="1"))
+    conn.execute("""
+        CREATE TRIGGER lecturas_ultima_insertar AFTER INSERT ON lecturas
+        BEGIN
+            INSERT INTO ultima_lectura (impresora_id, ts, corrida_id, toner, unidad, kit,
+                                        ts_ok, toner_ok, unidad_ok, kit_ok)
+            VALUES (NEW.impresora_id, NEW.ts, NEW.corrida_id, NEW.toner, NEW.unidad, NEW.kit,
+                    CASE WHEN COALESCE(NEW.toner, NEW.unidad, NEW.kit) IS NOT NULL
+                         THEN NEW.ts END,
+                    NEW.toner, NEW.unidad, NEW.kit)
+            ON CONFLICT(impresora_id) DO UPDATE SET
+                ts         = excluded.ts,
+                corrida_id = excluded.corrida_id,
+                toner      = excluded.toner,
+                unidad     = excluded.unidad,
+                kit        = excluded.kit,
+                ts_ok      = COALESCE(excluded.ts_ok,     ultima_lectura.ts_ok),
+                toner_ok   = COALESCE(excluded.toner_ok,  ultima_lectura.toner_ok),
+                unidad_ok  = COALESCE(excluded.unidad_ok, ultima_lectura.unidad_ok),
+                kit_ok     = COALESCE(excluded.kit_ok,    ultima_lectura.kit_ok)
+            WHERE excluded.ts >= ultima_lectura.ts;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER lecturas_ultima_borrar AFTER DELETE ON lecturas
+        WHEN OLD.ts >= (SELECT ts FROM ultima_lectura WHERE impresora_id = OLD.impresora_id)
+        BEGIN
+            DELETE FROM ultima_lectura WHERE impresora_id = OLD.impresora_id;
+            {_SQL_RECALCULAR_ULTIMA.format(filtro="impresora_id = OLD.impresora_id")};
+        END
+    """)
+
+
+# Mínimo en milésimas de los consumibles con dato de una lectura ({p}: prefijo de columna)
+_SQL_NIVEL_MIN = ("NULLIF(MIN(COALESCE({p}toner, 100000), COALESCE({p}unidad, 100000), "
+                  "COALESCE({p}kit, 100000)), 100000)")
+
+
+def _sql_nivel(minimo, umbral_bajo, umbral_medio):
+    """Expresión SQL del código de NIVEL_CODIGOS para un mínimo en milésimas."""
+    return (f"CASE WHEN {minimo} IS NULL THEN 3 WHEN {minimo} < 10 * {umbral_bajo} THEN 2 "
+            f"WHEN {minimo} < 10 * {umbral_medio} THEN 1 ELSE 0 END")
+
+
+def _migracion_005_nivel(conn):
+    """Columnas nivel_min y nivel en lecturas, con los umbrales vigentes en cada corrida.
+
+    El monitoreo las completa al guardar; para las lecturas insertadas sin ellas
+    (vista monitoreos, herramientas externas) las calcula un trigger con los
+    umbrales de su corrida o, si no tienen corrida, con los de la última.
+    """
+    cfg = cargar_config()
+    conn.execute("ALTER TABLE lecturas ADD COLUMN nivel_min INTEGER")
+    conn.execute("ALTER TABLE lecturas ADD COLUMN nivel INTEGER")
+    minimo = _SQL_NIVEL_MIN.format(p="")
+    conn.execute(f"""
+        UPDATE lecturas SET
+            nivel_min = {minimo},
+            nivel     = {_sql_nivel(
+                minimo,
+                "COALESCE((SELECT umbral_bajo FROM corridas WHERE id = lecturas.corrida_id), ?)",
+                "COALESCE((SELECT umbral_medio FROM corridas WHERE id = lecturas.corrida_id), ?)")}
+    """, (cfg.get("umbral_bajo", 10), cfg.get("umbral_medio", 25)))
+    conn.execute("CREATE INDEX idx_lecturas_nivel ON lecturas(nivel, ts)")
+    minimo = _SQL_NIVEL_MIN.format(p="NEW.")
+    conn.execute(f"""
+        CREATE TRIGGER lecturas_nivel AFTER INSERT ON lecturas WHEN NEW.nivel IS NULL
+        BEGIN
+            UPDATE lecturas SET
+                nivel_min = {minimo},
+                nivel     = {_sql_nivel(
+                    minimo,
+                    "COALESCE((SELECT umbral_bajo FROM corridas WHERE id = NEW.corrida_id), "
+                    "(SELECT umbral_bajo FROM corridas ORDER BY id DESC LIMIT 1), 10)",
+                    "COALESCE((SELECT umbral_medio FROM corridas WHERE id = NEW.corrida_id), "
+                    "(SELECT umbral_medio FROM corridas ORDER BY id DESC LIMIT 1), 25)")}
+            WHERE id = NEW.id;
+        END
+    """)
+
+
+# Inicio del período de una lectura ({p}: prefijo de columna), en segundos epoch de la
+# medianoche local del día o del lunes de la semana
+_SQL_PERIODO_RESUMEN = {
+    "resumen_diario":  "CAST(strftime('%s', date({p}ts, 'unixepoch', 'localtime'), 'utc') AS INTEGER)",
+    "resumen_semanal": "CAST(strftime('%s', date({p}ts, 'unixepoch', 'localtime', "
+                       "'weekday 0', '-6 days'), 'utc') AS INTEGER)",
+}
+
+
+def _sql_acumular_resumen(tabla, p, origen):
+    """INSERT ... ON CONFLICT que suma a `tabla` las lecturas de `origen`, cuyas columnas
+    llevan el prefijo `p` ('NEW.' en el trigger, '' al recorrer lecturas)."""
+    valores, cambios = [], []
+    for c in ("toner", "unidad", "kit"):
+        valores += [f"{p}{c}"] * 3
+        cambios += [
+            f"{c}_min = MIN(COALESCE({c}_min, excluded.{c}_min), COALESCE(excluded.{c}_min, {c}_min))",
+            f"{c}_max = MAX(COALESCE({c}_max, excluded.{c}_max), COALESCE(excluded.{c}_max, {c}_max))",
+            f"{c}_ult = CASE WHEN excluded.ts_ult >= ts_ult THEN COALESCE(excluded.{c}_ult, {c}_ult) "
+            f"ELSE COALESCE({c}_ult, excluded.{c}_ult) END",
+        ]
+    return f"""
+        INSERT INTO {tabla} (impresora_id, periodo, n, ts_ult,
+                             toner_min, toner_max, toner_ult, unidad_min, unidad_max, unidad_ult,
+                             kit_min, kit_max, kit_ult)
+        SELECT {p}impresora_id, {_SQL_PERIODO_RESUMEN[tabla].format(p=p)}, 1, {p}ts,
+               {", ".join(valores)}
+        {origen} WHERE true
+        ON CONFLICT(impresora_id, periodo) DO UPDATE SET
+            n = n + 1, ts_ult = MAX(ts_ult, excluded.ts_ult),
+            {", ".join(cambios)}
+    """
+
+
+def _migracion_006_resumenes(conn):
+    """Resúmenes diario y semanal por impresora: cantidad de lecturas y mínimo, máximo y
+    último valor no nulo de cada consumible, en milésimas.
+
+    Un trigger los actualiza con cada lectura. Archivar o compactar lecturas no los
+    modifica, así que conservan la historia larga. Las vistas *_sucursal y *_modelo
+    agrupan por la sucursal y el modelo actuales de cada impresora.
+    """
+    for tabla in _SQL_PERIODO_RESUMEN:
+        conn.execute(f"""
+            CREATE TABLE {tabla} (
+                impresora_id INTEGER NOT NULL REFERENCES impresoras(id),
+                periodo      INTEGER NOT NULL,
+                n            INTEGER NOT NULL,
+                ts_ult       INTEGER NOT NULL,
+                toner_min    INTEGER, toner_max  INTEGER, toner_ult  INTEGER,
+                unidad_min   INTEGER, unidad_max INTEGER, unidad_ult INTEGER,
+                kit_min      INTEGER, kit_max    INTEGER, kit_ult    INTEGER,
+                PRIMARY KEY (impresora_id, periodo)
+            ) WITHOUT ROWID
+        """)
+        conn.execute(f"CREATE INDEX idx_{tabla}_periodo ON {tabla}(periodo)")
+        conn.execute(_sql_acumular_resumen(tabla, "", "FROM lecturas"))
+        for grupo in ("sucursal", "modelo"):
+            conn.execute(f"""
+                CREATE VIEW {tabla}_{grupo} AS
+                SELECT i.{grupo}, r.periodo,
+                       date(r.periodo, 'unixepoch', 'localtime') AS fecha,
+                       COUNT(*) AS impresoras, SUM(r.n) AS lecturas,
+                       MIN(r.toner_min)  / 1000.0 AS toner_min,
+                       AVG(r.toner_ult)  / 1000.0 AS toner_prom,
+                       MIN(r.unidad_min) / 1000.0 AS unidad_min,
+                       AVG(r.unidad_ult) / 1000.0 AS unidad_prom,
+                       MIN(r.kit_min)    / 1000.0 AS kit_min,
+                       AVG(r.kit_ult)    / 1000.0 AS kit_prom
+                FROM {tabla} r
+                JOIN impresoras i ON i.id = r.impresora_id
+                GROUP BY i.{grupo}, r.periodo
             """)
+    conn.execute(f"""
+        CREATE TRIGGER lecturas_resumen AFTER INSERT ON lecturas
+        BEGIN
+            {_sql_acumular_resumen("resumen_diario", "NEW.", "")};
+            {_sql_acumular_resumen("resumen_semanal", "NEW.", "")};
+        END
+    """)
+
+
+def _migracion_007_cursores_exportacion(conn):
+    """Tabla cursores_exportacion: último id exportado de cada tabla por cada consumidor
+    de las exportaciones CSV/NDJSON incrementales."""
+    conn.execute("""
+        CREATE TABLE cursores_exportacion (
+            tabla     TEXT    NOT NULL,
+            nombre    TEXT    NOT NULL,
+            ultimo_id INTEGER NOT NULL,
+            fecha     TEXT    NOT NULL,
+            PRIMARY KEY (tabla, nombre)
+        )
+    """)
+
+
+def _migracion_008_pronosticos(conn):
+    """Tabla pronosticos: fecha estimada de agotamiento (ts epoch, NULL = sin pronóstico)
+    de cada consumible por impresora, y la más próxima de las tres en agota.
+    La recalcula db_pronosticos_actualizar() después de cada monitoreo."""
+    conn.execute("""
+        CREATE TABLE pronosticos (
+            impresora_id INTEGER PRIMARY KEY REFERENCES impresoras(id),
+            calculado    INTEGER NOT NULL,
+            toner        INTEGER,
+            unidad       INTEGER,
+            kit          INTEGER,
+            agota        INTEGER
+        )
+    """)
+
+
+def _migracion_009_lecturas_omitidas(conn):
+    """Tabla lecturas_omitidas: impresoras consultadas en cada corrida cuya lectura no se
+    guardó por ser igual a la anterior (guardado solo de cambios o compactación), con
+    su nivel_min: db_recalcular_niveles() las clasifica igual que a las lecturas, sin
+    buscar la lectura anterior en la DB principal y los archivos."""
+    conn.execute("""
+        CREATE TABLE lecturas_omitidas (
+            corrida_id   INTEGER NOT NULL,
+            impresora_id INTEGER NOT NULL REFERENCES impresoras(id),
+            nivel_min    INTEGER,
+            PRIMARY KEY (corrida_id, impresora_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migracion_010_cursor_lecturas(conn):
+    """Trigger que mantiene válidos los cursores de exportación de monitoreos.
+
+    lecturas.id no es AUTOINCREMENT: si se borran las filas de id más alto, SQLite
+    reutiliza esos ids para las lecturas nuevas, que quedarían por debajo del cursor
+    y no se exportarían nunca. Al borrar la fila de id más alto, los cursores bajan
+    al nuevo máximo.
+    """
+    conn.execute("""
+        CREATE TRIGGER lecturas_cursor_exportacion AFTER DELETE ON lecturas
+        WHEN OLD.id > COALESCE((SELECT MAX(id) FROM lecturas), 0)
+        BEGIN
+            UPDATE cursores_exportacion
+            SET ultimo_id = COALESCE((SELECT MAX(id) FROM lecturas), 0)
+            WHERE tabla = 'monitoreos' AND ultimo_id > COALESCE((SELECT MAX(id) FROM lecturas), 0);
+        END
+    """)
+
+
+MIGRACIONES = [
+    _migracion_001_esquema_base,
+    _migracion_002_indices,
+    _migracion_003_lecturas,
+    _migracion_004_ultima_lectura,
+    _migracion_005_nivel,
+    _migracion_006_resumenes,
+    _migracion_007_cursores_exportacion,
+    _migracion_008_pronosticos,
+    _migracion_009_lecturas_omitidas,
+    _migracion_010_cursor_lecturas,
+]
+
+
+def init_db():
+    """Aplica las migraciones pendientes. Se llama al arrancar la aplicación.
+    Si la DB ya está en la última versión, solo lee PRAGMA user_version.
+    Una migración que retorna True pide un VACUUM al final, fuera de la transacción.
+    """
+    compactar = False
+    with db_connect() as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRACIONES):
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        # Releer dentro del lock: otro equipo puede haber migrado la DB compartida
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for numero, migracion in enumerate(MIGRACIONES[version:], start=version + 1):
+            compactar = migracion(conn) or compactar
+            conn.execute(f"PRAGMA user_version = {numero}")
+    if compactar:
+        try:
+            with db_connect() as conn:
+                conn.execute("VACUUM")
+        except sqlite3.Error as e:
+            _log.error("No se pudo compactar la base de datos: %s", e)
+
+
+def _migrar_corridas(conn):
+    """Crea una corrida por cada fecha distinta de monitoreos y enlaza sus filas.
+    Los totales se calculan con los umbrales actuales de config.json.
+    """
+    cfg          = cargar_config()
+    umbral_bajo  = cfg.get("umbral_bajo",  10)
+    umbral_medio = cfg.get("umbral_medio", 25)
+    corridas = {}
+    for fecha, corrida_id, toner, unidad, kit in conn.execute(
+            "SELECT fecha, corrida_id, toner, unidad_imagen, kit_mantenimiento "
+            "FROM monitoreos ORDER BY fecha"):
+        if corrida_id is None:
+            try:
+                corrida_id = int(datetime.strptime(fecha, "%Y-%m-%d %H:%M:%S").timestamp() * 1000)
+            except (ValueError, TypeError):
+                continue
+        c = corridas.setdefault(corrida_id, {"inicio": fecha, "total": 0, "": 0,
+                                             "bajo": 0, "medio": 0, "sin_datos": 0})
+        c["total"] += 1
+        c[clasificar_nivel([v for v in (toner, kit, unidad) if v is not None],
+                           umbral_bajo, umbral_medio)] += 1
+    conn.executemany("""
+        INSERT OR IGNORE INTO corridas (id, inicio, fin, automatico, estado, total, ok,
+                                        bajo, medio, sin_datos, umbral_bajo, umbral_medio)
+        VALUES (?, ?, ?, 0, 'completa', ?, ?, ?, ?, ?, ?, ?)
+    """, [(cid, c["inicio"], c["inicio"], c["total"], c[""], c["bajo"], c["medio"],
+           c["sin_datos"], umbral_bajo, umbral_medio) for cid, c in corridas.items()])
+    conn.execute("""
+        UPDATE monitoreos SET corrida_id = (
+            SELECT id FROM corridas WHERE corridas.inicio = monitoreos.fecha
+        ) WHERE corrida_id IS NULL
+    """)
+
+
+# Los niveles se guardan en lecturas como milésimas enteras (0.215 -> 215)
+def _a_milesimos(nivel):
+    return None if nivel is None else int(round(nivel * 1000))
+
+
+def _de_milesimos(valor):
+    return None if valor is None else valor / 1000
+
+
+# Clasificación guardada en lecturas.nivel: tag de clasificar_nivel() -> código
+NIVEL_CODIGOS = {"": 0, "medio": 1, "bajo": 2, "sin_datos": 3}
+NIVEL_TAGS    = {codigo: tag for tag, codigo in NIVEL_CODIGOS.items()}
+
+
+def _nivel_lectura(toner, unidad, kit, umbral_bajo, umbral_medio):
+    """Retorna (nivel_min, código de NIVEL_CODIGOS) de niveles en milésimas.
+    Equivale a clasificar_nivel() y a _sql_nivel(), sin redondeos de float."""
+    valores = [v for v in (toner, unidad, kit) if v is not None]
+    if not valores:
+        return None, NIVEL_CODIGOS["sin_datos"]
+    minimo = min(valores)
+    if minimo < umbral_bajo * 10:
+        return minimo, NIVEL_CODIGOS["bajo"]
+    if minimo < umbral_medio * 10:
+        return minimo, NIVEL_CODIGOS["medio"]
+    return minimo, NIVEL_CODIGOS[""]
+
+
+def _fecha_lectura(ts, formato, cache):
+    """Formatea el ts epoch de una lectura en hora local. Las lecturas de una corrida
+    comparten ts, así que `cache` evita formatear la misma fecha una vez por fila."""
+    texto = cache.get(ts)
+    if texto is None:
+        texto = cache[ts] = datetime.fromtimestamp(ts).strftime(formato)
+    return texto
 
 
 def db_impresoras_todas(activas_solo=False):
@@ -303,27 +999,217 @@ def db_impresora_agregar(ip, modelo, sucursal, nombre="", sn="", ubicacion=""):
         )
 
 
+_CAMPOS_IMPORTACION = ("ip", "modelo", "sucursal", "nombre", "sn", "ubicacion", "activa")
+
+
+def db_impresoras_importar(filas):
+    """Da de alta o actualiza impresoras en una sola transacción.
+
+    filas: iterable de (numero_fila, dict) con las claves de _CAMPOS_IMPORTACION; ip y
+    modelo son obligatorios, y los demás campos vacíos o ausentes conservan el valor
+    actual de la impresora. Retorna un dict con la cantidad de impresoras 'insertadas',
+    'actualizadas' y 'sin_cambios', y 'omitidas': lista de (numero_fila, motivo).
+    """
+    reporte = {"insertadas": 0, "actualizadas": 0, "sin_cambios": 0, "omitidas": []}
+    with db_connect() as conn:
+        actuales = {r["ip"]: dict(r) for r in conn.execute(
+            "SELECT ip, modelo, sucursal, nombre, sn, ubicacion, activa FROM impresoras")}
+        nuevas, vistas = {}, set()
+        for numero, datos in filas:
+            ip, modelo = datos.get("ip", ""), datos.get("modelo", "")
+            if not ip or not modelo:
+                reporte["omitidas"].append((numero, "sin IP" if not ip else "sin modelo"))
+                continue
+            if ip in vistas:
+                reporte["omitidas"].append((numero, f"IP {ip} repetida en la planilla"))
+                continue
+            vistas.add(ip)
+            previa = actuales.get(ip) or {}
+            fila = {}
+            for campo in _CAMPOS_IMPORTACION:
+                valor = datos.get(campo)
+                if valor is None or valor == "":
+                    valor = previa.get(campo)
+                if campo == "activa":
+                    fila[campo] = 1 if valor is None else int(bool(valor))
+                else:
+                    fila[campo] = valor or ""
+            if not previa:
+                reporte["insertadas"] += 1
+            elif all(fila[c] == (previa[c] if c == "activa" else previa[c] or "")
+                     for c in _CAMPOS_IMPORTACION):
+                reporte["sin_cambios"] += 1
+                continue
+            else:
+                reporte["actualizadas"] += 1
+            nuevas[ip] = fila
+
+        # Todos los modelos en una pasada
+        conn.executemany("INSERT OR IGNORE INTO modelos (nombre) VALUES (?)",
+                         [(m,) for m in {f["modelo"] for f in nuevas.values()}])
+        modelo_ids = dict(conn.execute("SELECT nombre, id FROM modelos").fetchall())
+        conn.executemany("""
+            INSERT INTO impresoras (ip, modelo, sucursal, nombre, sn, ubicacion, activa, modelo_id)
+            VALUES (:ip, :modelo, :sucursal, :nombre, :sn, :ubicacion, :activa, :modelo_id)
+            ON CONFLICT(ip) DO UPDATE SET
+                modelo = excluded.modelo, sucursal = excluded.sucursal,
+                nombre = excluded.nombre, sn = excluded.sn, ubicacion = excluded.ubicacion,
+                activa = excluded.activa, modelo_id = excluded.modelo_id
+        """, [{**f, "modelo_id": modelo_ids.get(f["modelo"])} for f in nuevas.values()])
+        # Como al editar una impresora: las actualizadas salen de espera
+        conn.executemany("DELETE FROM circuitos WHERE ip=?",
+                         [(ip,) for ip in nuevas if ip in actuales])
+    return reporte
+
+
 def db_impresora_actualizar(id_, ip, modelo, sucursal, nombre, sn, activa, ubicacion=""):
     modelo_id = _modelo_id_obtener_o_crear(modelo)
     with db_connect() as conn:
+        fila = conn.execute("SELECT ip FROM impresoras WHERE id=?", (id_,)).fetchone()
         conn.execute(
             "UPDATE impresoras SET ip=?, modelo=?, sucursal=?, nombre=?, sn=?, activa=?, ubicacion=?, modelo_id=? WHERE id=?",
             (ip, modelo, sucursal, nombre, sn, 1 if activa else 0, ubicacion, modelo_id, id_),
         )
+        # Editar la impresora la saca de espera: se vuelve a consultar en la próxima corrida.
+        # Si cambió la IP también se borra el circuito de la anterior, que ya no se usa.
+        conn.execute("DELETE FROM circuitos WHERE ip IN (?, ?)", (ip, fila["ip"] if fila else ip))
 
 
 def db_impresora_eliminar(id_):
+    """Elimina la impresora y todo su historial: lecturas (también las de los archivos
+    anuales), ultima_lectura, lecturas omitidas, resúmenes diario y semanal y
+    pronóstico. No se puede deshacer; para conservar el historial, desactivarla.
+    """
     with db_connect() as conn:
+        # Adjuntar los archivos antes de escribir: ATTACH no se admite en una transacción
+        archivos = [_adjuntar_archivo(conn, anio, ruta)
+                    for anio, ruta in _archivos_lecturas().items()]
+        for alias in archivos:
+            conn.execute(f"DELETE FROM {alias}.lecturas WHERE impresora_id=?", (id_,))
+        conn.execute("DELETE FROM lecturas WHERE impresora_id=?", (id_,))
+        conn.execute("DELETE FROM ultima_lectura WHERE impresora_id=?", (id_,))
+        conn.execute("DELETE FROM lecturas_omitidas WHERE impresora_id=?", (id_,))
+        conn.execute("DELETE FROM resumen_diario WHERE impresora_id=?", (id_,))
+        conn.execute("DELETE FROM resumen_semanal WHERE impresora_id=?", (id_,))
+        conn.execute("DELETE FROM pronosticos WHERE impresora_id=?", (id_,))
         conn.execute("DELETE FROM impresoras WHERE id=?", (id_,))
 
 
 def db_ultimo_toner(ip):
     """Retorna el último nivel de tóner registrado para una IP, o None."""
     with db_connect() as conn:
-        row = conn.execute(
-            "SELECT toner FROM monitoreos WHERE ip=? AND toner IS NOT NULL ORDER BY fecha DESC LIMIT 1",
-            (ip,)).fetchone()
-        return row[0] if row else None
+        row = conn.execute("""
+            SELECT u.toner_ok FROM ultima_lectura u
+            JOIN impresoras i ON i.id = u.impresora_id
+            WHERE i.ip=?
+        """, (ip,)).fetchone()
+        return _de_milesimos(row[0]) if row else None
+
+
+def db_ultimos_niveles():
+    """Retorna {ip: (toner, unidad, kit)} con el último nivel no nulo de cada consumible
+    de todas las impresoras que tienen lecturas, en una sola consulta."""
+    with db_connect() as conn:
+        return {r[0]: (_de_milesimos(r[1]), _de_milesimos(r[2]), _de_milesimos(r[3]))
+                for r in conn.execute("""
+                    SELECT i.ip, u.toner_ok, u.unidad_ok, u.kit_ok
+                    FROM ultima_lectura u
+                    JOIN impresoras i ON i.id = u.impresora_id
+                """)}
+
+
+def db_ultimas_filas():
+    """Retorna {impresora_id: (ts, toner, unidad, kit)} con la última fila guardada de
+    cada impresora (niveles en milésimas), para el guardado solo de cambios."""
+    with db_connect() as conn:
+        return {r[0]: (r[1],) + tuple(r[2:]) for r in conn.execute("""
+            SELECT u.impresora_id,
+                   (SELECT MAX(l.ts) FROM lecturas l WHERE l.impresora_id = u.impresora_id),
+                   u.toner, u.unidad, u.kit
+            FROM ultima_lectura u
+        """) if r[1] is not None}
+
+
+def db_serie_impresora(ip, desde_dt=None, hasta_dt=None):
+    """Retorna (resolucion, fechas, series) para graficar una impresora entre dos fechas.
+
+    Según el largo del rango usa las lecturas crudas ('lecturas'), el resumen diario
+    ('diario') o el semanal ('semanal'). series es {consumible: (ultimo, minimo, maximo)},
+    listas de porcentajes con NaN donde no hay dato; con lecturas crudas mínimo y
+    máximo son None.
+    """
+    cfg = cargar_config()
+    dias_detalle = cfg.get("grafico_dias_detalle", GRAFICO_DIAS_DETALLE)
+    dias_diario  = cfg.get("grafico_dias_diario",  GRAFICO_DIAS_DIARIO)
+
+    with db_connect() as conn:
+        row = conn.execute("SELECT id FROM impresoras WHERE ip=?", (ip,)).fetchone()
+        if not row:
+            return "lecturas", [], {}
+        id_ = row[0]
+        desde = int(desde_dt.timestamp()) if desde_dt else None
+        hasta = int(hasta_dt.timestamp()) if hasta_dt else None
+        inicio = desde
+        if inicio is None:
+            inicio = conn.execute("SELECT MIN(periodo) FROM resumen_semanal WHERE impresora_id=?",
+                                  (id_,)).fetchone()[0]
+        dias = ((hasta or time.time()) - inicio) / 86400 if inicio is not None else 0
+
+        condiciones, params = ["impresora_id=?"], [id_]
+        if dias <= dias_detalle:
+            resolucion, columna = "lecturas", "ts"
+            sql = ("SELECT ts, toner, unidad, kit FROM "
+                   + _fuente_lecturas(conn, desde, hasta + 1 if hasta is not None else None))
+        else:
+            resolucion = "diario" if dias <= dias_diario else "semanal"
+            columna = "periodo"
+            sql = ("SELECT periodo, toner_ult, unidad_ult, kit_ult, toner_min, unidad_min, "
+                   "kit_min, toner_max, unidad_max, kit_max FROM resumen_" + resolucion)
+            # El período que contiene `desde` empieza antes que él
+            if desde is not None:
+                desde -= 7 * 86400 if resolucion == "semanal" else 86400
+        if desde is not None:
+            condiciones.append(f"{columna} >= ?")
+            params.append(desde)
+        if hasta is not None:
+            condiciones.append(f"{columna} <= ?")
+            params.append(hasta)
+        rows = [tuple(r) for r in conn.execute(
+            f"{sql} WHERE {' AND '.join(condiciones)} ORDER BY {columna}", params)]
+
+        if resolucion == "lecturas":
+            # Con el guardado solo de cambios cada valor sigue vigente hasta la próxima
+            # fila (como mucho `latido` segundos): se extiende la serie desde la fila
+            # anterior al rango y hasta el último intento de ultima_lectura
+            latido = cfg.get("lecturas_latido_seg", LECTURAS_LATIDO_DEFAULT)
+            if desde is not None:
+                previa = conn.execute(f"""
+                    SELECT toner, unidad, kit FROM {_fuente_lecturas(conn, desde - latido, desde)}
+                    WHERE impresora_id=? AND ts >= ? AND ts < ? ORDER BY ts DESC LIMIT 1
+                """, (id_, desde - latido, desde)).fetchone()
+                if previa:
+                    rows.insert(0, (desde,) + tuple(previa))
+            ultimo = conn.execute("SELECT ts FROM ultima_lectura WHERE impresora_id=?",
+                                  (id_,)).fetchone()
+            if rows and ultimo:
+                fin = min(ultimo[0], rows[-1][0] + latido,
+                          hasta if hasta is not None else ultimo[0])
+                if fin > rows[-1][0]:
+                    rows.append((fin,) + rows[-1][1:])
+
+    def pct(v):
+        return v / 10 if v is not None else float('nan')
+
+    fechas = [datetime.fromtimestamp(r[0]) for r in rows]
+    series = {}
+    for i, consumible in enumerate(("toner", "unidad", "kit")):
+        ultimo = [pct(r[1 + i]) for r in rows]
+        if resolucion == "lecturas":
+            series[consumible] = (ultimo, None, None)
+        else:
+            series[consumible] = (ultimo, [pct(r[4 + i]) for r in rows],
+                                  [pct(r[7 + i]) for r in rows])
+    return resolucion, fechas, series
 
 
 def db_modelos_activos():
@@ -372,6 +1258,27 @@ def db_modelo_renombrar(id_, nuevo_nombre):
         conn.execute("UPDATE impresoras SET modelo=? WHERE modelo_id=?", (nuevo, id_))
 
 
+def db_modelos_consulta():
+    """Retorna lista de (id, nombre, backend, snmp_indices) de todos los modelos."""
+    with db_connect() as conn:
+        return [tuple(r) for r in conn.execute(
+            "SELECT id, nombre, backend, snmp_indices FROM modelos ORDER BY nombre").fetchall()]
+
+
+def db_modelo_configurar_consulta(id_, backend, snmp_indices=""):
+    """Define cómo se consultan las impresoras del modelo: 'http' o 'snmp'."""
+    with db_connect() as conn:
+        conn.execute("UPDATE modelos SET backend=?, snmp_indices=? WHERE id=?",
+                     (backend, snmp_indices.strip(), id_))
+
+
+def db_modelos_snmp():
+    """Retorna {nombre: (índice tóner, kit, unidad)} de los modelos con backend SNMP."""
+    with db_connect() as conn:
+        return {r[0]: _parsear_indices_snmp(r[1]) for r in conn.execute(
+            "SELECT nombre, snmp_indices FROM modelos WHERE backend='snmp'").fetchall()}
+
+
 def db_modelo_eliminar(id_):
     """Elimina un modelo solo si ninguna impresora lo referencia."""
     with db_connect() as conn:
@@ -492,134 +1399,1504 @@ def db_cargar_envios(sucursal_filtro="", anio=None, mes=0, filtro_anulado=None):
         filas.append((r[0], fecha_str, r[2], r[3], r[4], r[5], r[6], r[7]))
     return filas
 
-def db_cargar_historial(desde=None, hasta=None, sucursal="", modelo="", ip=""):
-    """Retorna filas de monitoreos con JOIN a impresoras.
+
+# Archivo anual de lecturas: las lecturas con más de `archivo_dias` días pasan de
+# impresoras.db a impresoras_AAAA.db (según el año de la lectura, en la misma carpeta).
+# La DB principal queda chica y los checkpoints y copias por SMB no arrastran años de
+# historial. Las consultas por rango adjuntan con ATTACH solo los años que tocan.
+
+ARCHIVO_DIAS_DEFAULT = 730   # antigüedad a partir de la cual se archiva (0 = nunca)
+ARCHIVO_CACHE_SEG    = 300   # vigencia del listado de archivos (otro equipo puede archivar)
+
+_COLUMNAS_LECTURAS = "id, impresora_id, ts, corrida_id, toner, unidad, kit, nivel_min, nivel"
+_archivos_cache = {}
+
+
+def _ruta_archivo(anio):
+    return f"{os.path.splitext(DB_PATH)[0]}_{anio}.db"
+
+
+def _inicio_anio(anio):
+    return int(datetime(anio, 1, 1).timestamp())
+
+
+def _archivos_lecturas(refrescar=False):
+    """Retorna {año: ruta} de los archivos anuales de la DB actual."""
+    cache = _archivos_cache.get(DB_PATH)
+    if cache and not refrescar and time.monotonic() - cache[0] < ARCHIVO_CACHE_SEG:
+        return cache[1]
+    carpeta = os.path.dirname(DB_PATH) or "."
+    patron  = re.compile(re.escape(os.path.splitext(os.path.basename(DB_PATH))[0])
+                         + r"_(\d{4})\.db$", re.IGNORECASE)
+    archivos = {}
+    try:
+        for nombre in os.listdir(carpeta):
+            m = patron.match(nombre)
+            if m:
+                archivos[int(m.group(1))] = os.path.join(carpeta, nombre)
+    except OSError as e:
+        _log.error("No se pudo listar los archivos de lecturas en %s: %s", carpeta, e)
+    _archivos_cache[DB_PATH] = (time.monotonic(), archivos)
+    return archivos
+
+
+def _adjuntar_archivo(conn, anio, ruta=None):
+    """Adjunta el archivo del año a la conexión (si no lo estaba) y retorna su alias.
+    ATTACH no se permite dentro de una transacción."""
+    alias = f"archivo_{anio}"
+    if alias not in {r[1] for r in conn.execute("PRAGMA database_list")}:
+        conn.execute(f"ATTACH DATABASE ? AS {alias}", (ruta or _ruta_archivo(anio),))
+    return alias
+
+
+def _fuente_lecturas(conn, desde_ts=None, hasta_ts=None):
+    """Retorna la expresión FROM para leer lecturas con ts en [desde_ts, hasta_ts):
+    la tabla lecturas o, si el rango llega a años archivados, su UNION ALL con esos
+    archivos. Los filtros del WHERE exterior se aplican dentro de cada parte.
+
+    Los archivos que falten adjuntar se adjuntan acá, así que con archivos en el rango
+    hay que llamarla antes de escribir en la conexión. Si un archivo no se puede
+    adjuntar (transacción abierta o error al abrirlo) lanza sqlite3.OperationalError:
+    un resultado sin los archivos pasaría por completo."""
+    adjuntos = {r[1] for r in conn.execute("PRAGMA database_list")}
+    partes = []
+    for anio, ruta in sorted(_archivos_lecturas().items()):
+        if desde_ts is not None and desde_ts >= _inicio_anio(anio + 1):
+            continue
+        if hasta_ts is not None and hasta_ts <= _inicio_anio(anio):
+            continue
+        if f"archivo_{anio}" not in adjuntos and conn.in_transaction:
+            _log.error("Consulta de lecturas de %d dentro de una transacción", anio)
+            raise sqlite3.OperationalError(
+                f"No se puede adjuntar el archivo de lecturas de {anio} con una "
+                "transacción abierta")
+        try:
+            partes.append(_adjuntar_archivo(conn, anio, ruta))
+        except sqlite3.Error as e:
+            _log.error("No se pudo abrir el archivo de lecturas %s: %s", ruta, e)
+            raise
+    if not partes:
+        return "lecturas"
+    return ("(SELECT " + _COLUMNAS_LECTURAS + " FROM main.lecturas"
+            + "".join(f" UNION ALL SELECT {_COLUMNAS_LECTURAS} FROM {a}.lecturas" for a in partes)
+            + ")")
+
+
+def db_archivar_lecturas(dias=None):
+    """Mueve a los archivos anuales las lecturas con más de `dias` días (por defecto
+    archivo_dias de config.json). Retorna la cantidad de lecturas movidas.
+
+    La lectura más reciente de cada impresora no se archiva, así ultima_lectura no
+    cambia. Los resúmenes diario y semanal quedan en la DB principal. Cada año se
+    copia y luego se borra en transacciones separadas: si el proceso se corta en el
+    medio, la próxima ejecución lo completa sin duplicar filas.
+    """
+    if dias is None:
+        dias = cargar_config().get("archivo_dias", ARCHIVO_DIAS_DEFAULT)
+    if not dias or dias <= 0:
+        return 0
+    corte = int(time.time()) - int(dias) * 86400
+    filtro = """l.ts >= ? AND l.ts < ? AND l.ts < (
+        SELECT u.ts FROM main.ultima_lectura u WHERE u.impresora_id = l.impresora_id)"""
+
+    # Solo los años con lecturas para archivar: la última lectura de una impresora dada
+    # de baja queda en la DB principal para siempre y no debe crear archivos vacíos
+    with db_connect() as conn:
+        anios = [int(r[0]) for r in conn.execute(f"""
+            SELECT DISTINCT strftime('%Y', l.ts, 'unixepoch', 'localtime')
+            FROM main.lecturas l WHERE {filtro}
+        """, (0, corte))]
+    if not anios:
+        return 0
+
+    movidas = 0
+    for anio in sorted(anios):
+        rango = (_inicio_anio(anio), min(_inicio_anio(anio + 1), corte))
+        with db_connect() as conn:
+            alias = _adjuntar_archivo(conn, anio)
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {alias}.lecturas (
+                    id           INTEGER PRIMARY KEY,
+                    impresora_id INTEGER NOT NULL,
+                    ts           INTEGER NOT NULL,
+                    corrida_id   INTEGER,
+                    toner        INTEGER,
+                    unidad       INTEGER,
+                    kit          INTEGER,
+                    nivel_min    INTEGER,
+                    nivel        INTEGER
+                )
+            """)
+            for nombre, columnas in (("impresora_ts", "impresora_id, ts"), ("ts", "ts"),
+                                     ("corrida", "corrida_id"), ("nivel", "nivel, ts")):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_lecturas_{nombre} "
+                             f"ON lecturas({columnas})")
+            conn.execute(f"""
+                INSERT OR IGNORE INTO {alias}.lecturas ({_COLUMNAS_LECTURAS})
+                SELECT {_COLUMNAS_LECTURAS} FROM main.lecturas l WHERE {filtro}
+            """, rango)
+        with db_connect() as conn:
+            movidas += conn.execute(f"""
+                DELETE FROM main.lecturas AS l WHERE {filtro}
+                AND l.id IN (SELECT id FROM {alias}.lecturas)
+            """, rango).rowcount
+    _archivos_lecturas(refrescar=True)
+    if movidas:
+        _vacuum_si_conviene(["main"])
+    return movidas
+
+
+def _vacuum_si_conviene(esquemas):
+    """VACUUM de cada esquema ('main' o alias de archivo) con más de un cuarto de
+    páginas libres. Las páginas libres se reutilizan con las lecturas nuevas; reescribir
+    todo el archivo solo vale la pena tras liberar mucho, como en el primer archivado."""
+    try:
+        with db_connect() as conn:
+            for esquema in esquemas:
+                libres  = conn.execute(f"PRAGMA {esquema}.freelist_count").fetchone()[0]
+                paginas = conn.execute(f"PRAGMA {esquema}.page_count").fetchone()[0]
+                if libres > paginas // 4:
+                    conn.execute(f"VACUUM {esquema}")
+    except sqlite3.Error as e:
+        _log.error("No se pudo compactar la base de datos: %s", e)
+
+
+def db_compactar_lecturas(latido=None, lote=5000):
+    """Aplica el guardado solo de cambios al historial existente: borra las lecturas
+    iguales a la anterior conservada de la misma impresora con menos de `latido`
+    segundos entre ambas (por defecto lecturas_latido_seg de config.json), en la DB
+    principal y en los archivos. Retorna la cantidad de lecturas borradas.
+
+    La última lectura de cada impresora se conserva (ultima_lectura no cambia), los
+    resúmenes diario y semanal siguen contando las lecturas originales y las borradas
+    quedan en lecturas_omitidas para los totales de su corrida.
+    """
+    if latido is None:
+        latido = cargar_config().get("lecturas_latido_seg", LECTURAS_LATIDO_DEFAULT)
+    with db_connect() as conn:
+        _fuente_lecturas(conn)
+        esquemas = [r[1] for r in conn.execute("PRAGMA database_list")
+                    if r[1] == "main" or r[1].startswith("archivo_")]
+
+    borradas = 0
+    for esquema in esquemas:
+        with db_connect() as conn:
+            impresoras = [r[0] for r in conn.execute(
+                f"SELECT DISTINCT impresora_id FROM {esquema}.lecturas")]
+        a_borrar, omitidas = [], []
+        for n, impresora_id in enumerate(impresoras, start=1):
+            with db_connect() as conn:
+                filas = conn.execute(f"""
+                    SELECT id, ts, corrida_id, toner, unidad, kit, nivel_min
+                    FROM {esquema}.lecturas
+                    WHERE impresora_id = ? ORDER BY ts, id
+                """, (impresora_id,)).fetchall()
+            conservada = None
+            for fila in filas[:-1] if esquema == "main" else filas:
+                if (conservada is not None and tuple(fila[3:6]) == tuple(conservada[3:6])
+                        and fila[1] - conservada[1] < latido):
+                    a_borrar.append((fila[0],))
+                    if fila[2] is not None:
+                        omitidas.append((fila[2], impresora_id, fila[6]))
+                else:
+                    conservada = fila
+            if len(a_borrar) >= lote or (n == len(impresoras) and a_borrar):
+                with db_connect() as conn:
+                    borradas += conn.executemany(
+                        f"DELETE FROM {esquema}.lecturas WHERE id = ?", a_borrar).rowcount
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO lecturas_omitidas "
+                        "(corrida_id, impresora_id, nivel_min) VALUES (?, ?, ?)", omitidas)
+                a_borrar, omitidas = [], []
+    if borradas:
+        _vacuum_si_conviene(esquemas)
+    return borradas
+
+
+# Historial paginado: filtros, orden y límite de página se resuelven en SQL. Las páginas se recorren
+# por keyset: el cursor son los valores de las claves de orden de la primera o
+# la última fila de la página, así que pasar de página cuesta lo mismo al
+# principio que al final del historial y solo se formatean las filas visibles.
+
+# Expresión de orden por índice de columna de la tabla de historial
+_HISTORIAL_ORDEN = {
+    0: "l.ts",
+    1: "LOWER(i.sucursal)",
+    2: "LOWER(i.ip)",
+    3: "LOWER(i.modelo)",
+    4: "COALESCE(l.toner, -1)",
+    5: "COALESCE(l.unidad, -1)",
+    6: "COALESCE(l.kit, -1)",
+}
+def _rango_historial(desde=None, hasta=None):
+    """Convierte desde/hasta 'YYYY-MM-DD' en (desde_ts, hasta_ts) con hasta exclusivo."""
+    return (int(datetime.strptime(desde, "%Y-%m-%d").timestamp()) if desde else None,
+            int((datetime.strptime(hasta, "%Y-%m-%d") + timedelta(days=1)).timestamp())
+            if hasta else None)
+
+
+def _fuente_historial(conn, filtros):
+    """_fuente_lecturas() para el rango de fechas de los filtros del historial."""
+    return _fuente_lecturas(conn, *_rango_historial(filtros.get("desde"), filtros.get("hasta")))
+
+
+def _historial_where(desde=None, hasta=None, sucursal="", modelo="", ip="", corrida_id=None,
+                     alerta=None):
+    """Retorna (sql, params) con la condición WHERE sobre lecturas l.
     desde/hasta: strings 'YYYY-MM-DD'. modelo/ip: filtro exacto (o vacío = sin filtro).
-    Retorna lista de tuplas (7 datos + tag).
+    alerta: tag de clasificar_nivel() ('bajo', 'medio', 'sin_datos', '' = normal) o None.
+    Los filtros de impresora van en una subconsulta para que contar no necesite el JOIN.
     """
-    cfg          = cargar_config()
-    umbral_bajo  = cfg.get("umbral_bajo",  10)
-    umbral_medio = cfg.get("umbral_medio", 25)
+    condiciones, params = ["1=1"], []
+    desde_ts, hasta_ts = _rango_historial(desde, hasta)
+    if desde_ts is not None:
+        condiciones.append("l.ts >= ?")
+        params.append(desde_ts)
+    if hasta_ts is not None:
+        condiciones.append("l.ts < ?")
+        params.append(hasta_ts)
+    if corrida_id is not None:
+        condiciones.append("l.corrida_id = ?")
+        params.append(corrida_id)
+    if alerta is not None:
+        condiciones.append("l.nivel = ?")
+        params.append(NIVEL_CODIGOS[alerta])
+
+    de_impresora, params_imp = [], []
+    if sucursal and sucursal != "Todas":
+        de_impresora.append("LOWER(sucursal) LIKE ?")
+        params_imp.append(f"%{sucursal.lower()}%")
+    if modelo and modelo != "Todos":
+        de_impresora.append("modelo = ?")
+        params_imp.append(modelo)
+    if ip and ip != "Todas":
+        de_impresora.append("ip = ?")
+        params_imp.append(ip)
+    if de_impresora:
+        condiciones.append("l.impresora_id IN (SELECT id FROM impresoras WHERE "
+                           + " AND ".join(de_impresora) + ")")
+        params += params_imp
+    return " AND ".join(condiciones), params
+
+
+def _condicion_keyset(claves, cursor):
+    """Retorna (sql, params) de las filas posteriores a `cursor` en el orden de `claves`,
+    lista de (expresión, descendente). Admite direcciones mezcladas."""
+    alternativas, params = [], []
+    for n, (expr, desc) in enumerate(claves):
+        partes = [f"{e} = ?" for e, _ in claves[:n]] + [f"{expr} {'<' if desc else '>'} ?"]
+        alternativas.append("(" + " AND ".join(partes) + ")")
+        params += list(cursor[:n + 1])
+    # La cota sobre la primera clave permite usar su índice
+    primera, desc = claves[0]
+    sql = f"{primera} {'<=' if desc else '>='} ? AND (" + " OR ".join(alternativas) + ")"
+    return sql, [cursor[0]] + params
+
+
+def _fila_historial(r, fechas):
+    """Formatea (ts, sucursal, ip, modelo, toner, unidad, kit, nivel) como fila de la
+    tabla + tag. El tag es el nivel guardado con la lectura."""
+    toner  = _de_milesimos(r[4])
+    unidad = _de_milesimos(r[5])
+    kit    = _de_milesimos(r[6])
+    toner_str  = f"{toner*100:.1f}%"  if toner  is not None else "—"
+    unidad_str = f"{unidad*100:.1f}%" if unidad is not None else "—"
+    kit_str    = f"{kit*100:.1f}%"    if kit    is not None else "—"
+    return (_fecha_lectura(r[0], "%d/%m/%Y %H:%M", fechas), r[1] or "", r[2],
+            r[3] or "", toner_str, unidad_str, kit_str, NIVEL_TAGS.get(r[7], ""))
 
+
+def db_historial_contar_niveles(**filtros):
+    """Retorna {tag: cantidad} de las lecturas que cumplen los filtros de _historial_where()."""
+    where, params = _historial_where(**filtros)
     with db_connect() as conn:
-        q = """
-            SELECT m.fecha,
-                   COALESCE(i.sucursal, '') AS sucursal,
-                   m.ip,
-                   COALESCE(i.modelo, '')   AS modelo,
-                   m.toner, m.unidad_imagen, m.kit_mantenimiento
-            FROM monitoreos m
-            LEFT JOIN impresoras i ON m.ip = i.ip
-            WHERE 1=1
-        """
-        params = []
-        if desde:
-            q += " AND m.fecha >= ?"
-            params.append(desde + " 00:00:00")
-        if hasta:
-            q += " AND m.fecha <= ?"
-            params.append(hasta + " 23:59:59")
-        if sucursal and sucursal != "Todas":
-            q += " AND LOWER(COALESCE(i.sucursal, '')) LIKE ?"
-            params.append(f"%{sucursal.lower()}%")
-        if modelo and modelo != "Todos":
-            q += " AND i.modelo = ?"
-            params.append(modelo)
-        if ip and ip != "Todas":
-            q += " AND m.ip = ?"
-            params.append(ip)
-        q += " ORDER BY m.fecha DESC, sucursal, m.ip"
-        rows = conn.execute(q, params).fetchall()
+        fuente = _fuente_historial(conn, filtros)
+        return {NIVEL_TAGS.get(nivel, ""): n for nivel, n in conn.execute(
+            f"SELECT l.nivel, COUNT(*) FROM {fuente} l WHERE {where} GROUP BY l.nivel", params)}
 
-    filas = []
+
+def _consulta_historial(conn, filtros, orden, ascendente, cursor=None, atras=False):
+    """Retorna (sql, params) de las filas del historial en el orden pedido, sin LIMIT.
+    Ver db_historial_pagina(); las claves de orden van desde la columna 8."""
+    where, params = _historial_where(**filtros)
+    if orden is None:
+        claves = [("l.ts", True), ("i.sucursal", False), ("i.ip", False), ("l.id", False)]
+    else:
+        claves = [(_HISTORIAL_ORDEN[orden], not ascendente), ("l.id", not ascendente)]
+    if atras:
+        claves = [(expr, not desc) for expr, desc in claves]
+    if cursor is not None:
+        cond, params_cursor = _condicion_keyset(claves, cursor)
+        where  += " AND " + cond
+        params += params_cursor
+    q = f"""
+        SELECT l.ts, i.sucursal, i.ip, i.modelo, l.toner, l.unidad, l.kit, l.nivel,
+               {", ".join(expr for expr, _ in claves)}
+        FROM {_fuente_historial(conn, filtros)} l
+        JOIN impresoras i ON i.id = l.impresora_id
+        WHERE {where}
+        ORDER BY {", ".join(f"{expr} {'DESC' if desc else 'ASC'}" for expr, desc in claves)}
+    """
+    return q, params
+
+
+def db_historial_filas(filtros, orden=None, ascendente=True):
+    """Generador de todas las filas del historial (formato de db_historial_pagina)
+    leídas de un solo cursor, para exportar sin cargar el resultado en memoria."""
+    with db_connect() as conn:
+        q, params = _consulta_historial(conn, filtros, orden, ascendente)
+        fechas = {}
+        for r in conn.execute(q, params):
+            if len(fechas) > 10000:
+                fechas.clear()
+            yield _fila_historial(r, fechas)
+
+
+def db_historial_pagina(filtros, orden=None, ascendente=True, cursor=None, atras=False,
+                        limite=200):
+    """Retorna (filas, primero, ultimo) con una página del historial.
+
+    filtros: dict para _historial_where(). orden: índice de columna (None = fecha
+    descendente, sucursal, IP). cursor: `ultimo` de la página anterior para avanzar,
+    o `primero` de la actual con atras=True para retroceder. limite=None trae todo.
+    filas: tuplas (7 datos + tag); primero/ultimo: cursores de la página (None si vacía).
+    """
+    with db_connect() as conn:
+        q, params = _consulta_historial(conn, filtros, orden, ascendente, cursor, atras)
+        rows = conn.execute(q + " LIMIT ?", params + [-1 if limite is None else limite]).fetchall()
+    if atras:
+        rows.reverse()
+    if not rows:
+        return [], None, None
+    fechas = {}
+    filas  = [_fila_historial(r, fechas) for r in rows]
+    return filas, tuple(rows[0])[8:], tuple(rows[-1])[8:]
+
+
+def db_historial_dias(filtros, descendente=False, cursor=None, atras=False, limite=20):
+    """Retorna (dias, total) para la vista árbol: dias es [(fecha 'YYYY-MM-DD', lecturas)]
+    de una página de `limite` días, continuando después de `cursor` (un día) o,
+    con atras=True, antes de él. total es la cantidad de días con lecturas."""
+    where, params = _historial_where(**filtros)
+    dia = "strftime('%Y-%m-%d', l.ts, 'unixepoch', 'localtime')"
+    with db_connect() as conn:
+        fuente = _fuente_historial(conn, filtros)
+        total = conn.execute(f"SELECT COUNT(DISTINCT {dia}) FROM {fuente} l WHERE {where}",
+                             params).fetchone()[0]
+        if cursor is not None:
+            # El día se traduce a una cota sobre ts para usar el índice
+            inicio = datetime.strptime(cursor, "%Y-%m-%d")
+            if descendente != atras:
+                where += " AND l.ts < ?"
+                params = params + [int(inicio.timestamp())]
+            else:
+                where += " AND l.ts >= ?"
+                params = params + [int((inicio + timedelta(days=1)).timestamp())]
+        sentido = "DESC" if descendente != atras else "ASC"
+        dias = conn.execute(f"""
+            SELECT {dia} AS dia, COUNT(*) FROM {fuente} l WHERE {where}
+            GROUP BY dia ORDER BY dia {sentido} LIMIT ?
+        """, params + [limite]).fetchall()
+    dias = [tuple(d) for d in dias]
+    if atras:
+        dias.reverse()
+    return dias, total
+
+
+# ---------------------------------------------------------------------------
+# Exportación de tablas (CSV / NDJSON)
+# ---------------------------------------------------------------------------
+# tabla -> (columnas, SELECT con {fuente} para las lecturas, columna de fecha, fecha en ts)
+# Las filas salen ordenadas por id: el cursor incremental es el último id exportado.
+
+_SQL_NIVEL_TEXTO = ("CASE l.nivel " + " ".join(
+    f"WHEN {codigo} THEN '{tag or 'normal'}'" for tag, codigo in NIVEL_CODIGOS.items()) + " END")
+
+_EXPORTACIONES = {
+    "monitoreos": (
+        ["id", "fecha", "ip", "sucursal", "modelo", "toner", "unidad_imagen",
+         "kit_mantenimiento", "nivel", "corrida_id"],
+        f"""SELECT l.id, strftime('%Y-%m-%d %H:%M:%S', l.ts, 'unixepoch', 'localtime'),
+                   i.ip, i.sucursal, i.modelo, l.toner / 1000.0, l.unidad / 1000.0,
+                   l.kit / 1000.0, {_SQL_NIVEL_TEXTO}, l.corrida_id
+            FROM {{fuente}} l JOIN impresoras i ON i.id = l.impresora_id""",
+        "l.ts", True),
+    "envios": (
+        ["id", "fecha", "sucursal", "ip", "tipo_insumo", "modelo_impresora", "cantidad",
+         "anulado"],
+        """SELECT id, fecha, sucursal, ip, tipo_insumo, modelo_impresora, cantidad, anulado
+            FROM envios""",
+        "fecha", False),
+    "movimientos_stock": (
+        ["id", "fecha", "tipo", "tipo_insumo", "modelo_impresora", "cantidad",
+         "observacion", "envio_id"],
+        """SELECT id, fecha, tipo, tipo_insumo, modelo_impresora, cantidad, observacion,
+                   envio_id
+            FROM movimientos_stock""",
+        "fecha", False),
+}
+
+
+def db_exportacion_filas(tabla, desde=None, hasta=None, despues_de=None):
+    """Generador de las filas (tuplas con las columnas de _EXPORTACIONES) de `tabla`
+    con fecha entre desde y hasta ('YYYY-MM-DD', ambos inclusive) e id > despues_de,
+    ordenadas por id y leídas de un solo cursor. Las lecturas incluyen los archivos
+    anuales que caen en el rango."""
+    _, select, col_fecha, por_ts = _EXPORTACIONES[tabla]
+    desde_ts, hasta_ts = _rango_historial(desde, hasta)
+    condiciones, params = ["1=1"], []
+    if desde_ts is not None:
+        condiciones.append(f"{col_fecha} >= ?")
+        params.append(desde_ts if por_ts else desde)
+    if hasta_ts is not None:
+        condiciones.append(f"{col_fecha} < ?")
+        params.append(hasta_ts if por_ts else
+                      (datetime.strptime(hasta, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d"))
+    col_id = "l.id" if por_ts else "id"
+    if despues_de is not None:
+        condiciones.append(f"{col_id} > ?")
+        params.append(despues_de)
+    with db_connect() as conn:
+        if por_ts:
+            select = select.format(fuente=_fuente_lecturas(conn, desde_ts, hasta_ts))
+        yield from conn.execute(
+            f"{select} WHERE {' AND '.join(condiciones)} ORDER BY {col_id}", params)
+
+
+def db_cursor_exportacion(tabla, nombre):
+    """Retorna el último id exportado de `tabla` para el consumidor `nombre`, o None."""
+    with db_connect() as conn:
+        row = conn.execute("SELECT ultimo_id FROM cursores_exportacion WHERE tabla=? AND nombre=?",
+                           (tabla, nombre)).fetchone()
+    return row[0] if row else None
+
+
+def db_guardar_cursor_exportacion(tabla, nombre, ultimo_id):
+    """Registra el último id exportado de `tabla` para el consumidor `nombre`."""
+    with db_connect() as conn:
+        conn.execute("""
+            INSERT INTO cursores_exportacion (tabla, nombre, ultimo_id, fecha) VALUES (?, ?, ?, ?)
+            ON CONFLICT(tabla, nombre) DO UPDATE SET
+                ultimo_id = excluded.ultimo_id, fecha = excluded.fecha
+        """, (tabla, nombre, ultimo_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def db_cargar_ultimo_monitoreo(umbral_bajo, umbral_medio):
+    """Retorna (filas, fecha_str) con el último intento de cada impresora activa,
+    leído de ultima_lectura, para poblar la tabla al inicio. fecha_str es el inicio
+    de la última corrida completa.
+    filas: lista de tuplas (sucursal, ip, modelo, fecha_str, toner_str, unidad_str, kit_str,
+    agota_str, tag).
+    """
+    corrida = db_ultima_corrida()
+    if corrida is None:
+        return [], None
+    with db_connect() as conn:
+        rows = conn.execute("""
+            SELECT i.sucursal, i.ip, i.modelo, u.toner, u.unidad, u.kit, u.ts,
+                   u.corrida_id, c.proximo, p.agota
+            FROM ultima_lectura u
+            JOIN impresoras i ON i.id = u.impresora_id
+            LEFT JOIN circuitos c ON c.ip = i.ip
+            LEFT JOIN pronosticos p ON p.impresora_id = u.impresora_id
+            WHERE i.activa = 1
+            ORDER BY i.sucursal, i.ip
+        """).fetchall()
+
+    filas  = []
+    fechas = {}
     for r in rows:
-        try:
-            fecha_dt  = datetime.strptime(r[0], "%Y-%m-%d %H:%M:%S")
-            fecha_str = fecha_dt.strftime("%d/%m/%Y %H:%M")
-        except (ValueError, TypeError):
-            fecha_str = str(r[0] or "")
-        toner  = r[4]
-        unidad = r[5]
-        kit    = r[6]
+        # Circuito abierto y sin lectura en la última corrida: no se consultó
+        if r[8] is not None and r[7] != corrida["id"]:
+            filas.append((r[0] or "", r[1], r[2] or "", TEXTO_EN_ESPERA, "—", "—", "—",
+                          _texto_agota(r[9]), "sin_datos"))
+            continue
+        fecha_ult = _fecha_lectura(r[6], "%d/%m/%Y %H:%M", fechas)
+        toner  = _de_milesimos(r[3])
+        unidad = _de_milesimos(r[4])
+        kit    = _de_milesimos(r[5])
         toner_str  = f"{toner*100:.1f}%"  if toner  is not None else "—"
         unidad_str = f"{unidad*100:.1f}%" if unidad is not None else "—"
         kit_str    = f"{kit*100:.1f}%"    if kit    is not None else "—"
         valores = [v for v in (toner, kit, unidad) if v is not None]
         tag     = clasificar_nivel(valores, umbral_bajo, umbral_medio)
-        filas.append((fecha_str, r[1], r[2], r[3], toner_str, unidad_str, kit_str, tag))
-    return filas
+        filas.append((r[0] or "", r[1], r[2] or "", fecha_ult, toner_str, unidad_str, kit_str,
+                      _texto_agota(r[9]), tag))
+    return filas, corrida["inicio"]
+
+
+def db_pronosticos_actualizar(dias=None):
+    """Recalcula la tabla pronosticos de todas las impresoras con el último valor de
+    cada día de los últimos `dias` días (por defecto pronostico_dias de config.json),
+    en una sola consulta y un solo ajuste vectorizado (_pronosticar). Retorna la
+    cantidad de impresoras con algún pronóstico.
+
+    Lee resumen_diario y no lecturas: una fila por impresora y día, en la DB principal
+    aunque las lecturas estén archivadas.
+    """
+    if dias is None:
+        dias = cargar_config().get("pronostico_dias", PRONOSTICO_DIAS_DEFAULT)
+    ahora = int(time.time())
+    desde = ahora - int(dias) * 86400
+    with db_connect() as conn:
+        cur = conn.cursor()
+        cur.row_factory = None              # tuplas: numpy las convierte mucho más rápido que Row
+        # Con guardado solo de cambios el último valor conocido vale hasta ts_ok.
+        # El IN sobre impresoras hace que resumen_diario se recorra por su clave
+        # (impresora_id, periodo) desde `desde`, sin pasar por la historia anterior.
+        filas = cur.execute("""
+            SELECT r.impresora_id, r.ts_ult, r.toner_ult, r.unidad_ult, r.kit_ult
+            FROM resumen_diario r
+            WHERE r.impresora_id IN (SELECT id FROM impresoras) AND r.periodo >= ?
+              AND COALESCE(r.toner_ult, r.unidad_ult, r.kit_ult) IS NOT NULL
+            UNION ALL
+            SELECT u.impresora_id, u.ts_ok, u.toner_ok, u.unidad_ok, u.kit_ok
+            FROM ultima_lectura u
+            WHERE u.ts_ok >= ? AND u.ts_ok > (
+                SELECT r.ts_ult FROM resumen_diario r WHERE r.impresora_id = u.impresora_id
+                ORDER BY r.periodo DESC LIMIT 1)
+            ORDER BY 1, 2
+        """, (desde, desde)).fetchall()
+        filas_pron = []
+        if filas:
+            datos = np.array(filas, dtype=float)
+            grupos, fechas = _pronosticar(datos[:, 0].astype(np.int64), datos[:, 1],
+                                          datos[:, 2:], ahora)
+            for id_, f in zip(grupos.tolist(), fechas):
+                if np.isnan(f).all():
+                    continue
+                t, u, k = (None if v != v else int(v) for v in f)
+                filas_pron.append((id_, ahora, t, u, k, int(np.nanmin(f))))
+        conn.execute("DELETE FROM pronosticos")
+        conn.executemany("INSERT INTO pronosticos VALUES (?, ?, ?, ?, ?, ?)", filas_pron)
+    return len(filas_pron)
+
+
+def db_pronosticos():
+    """Retorna {ip: ts epoch} con la fecha de agotamiento más próxima de cada impresora."""
+    with db_connect() as conn:
+        return dict(conn.execute("""
+            SELECT i.ip, p.agota FROM pronosticos p JOIN impresoras i ON i.id = p.impresora_id
+            WHERE p.agota IS NOT NULL
+        """).fetchall())
+
+
+def _texto_agota(ts):
+    """Fecha de agotamiento para las tablas: 'dd/mm/aaaa' o '—'."""
+    return datetime.fromtimestamp(ts).strftime("%d/%m/%Y") if ts else "—"
+
+
+def db_corrida_iniciar(corrida_id, inicio, automatico, umbral_bajo, umbral_medio):
+    """Registra el comienzo de una corrida de monitoreo."""
+    with db_connect() as conn:
+        conn.execute("""
+            INSERT INTO corridas (id, inicio, automatico, umbral_bajo, umbral_medio)
+            VALUES (?, ?, ?, ?, ?)
+        """, (corrida_id, inicio, 1 if automatico else 0, umbral_bajo, umbral_medio))
+
+
+def db_corrida_finalizar(corrida_id, estado, total=0, ok=0, bajo=0, medio=0, sin_datos=0):
+    """Cierra una corrida con su estado ('completa', 'cancelada', 'error') y sus totales."""
+    fin = datetime.now()
+    with db_connect() as conn:
+        row = conn.execute("SELECT inicio FROM corridas WHERE id=?", (corrida_id,)).fetchone()
+        if row is None:
+            return
+        duracion = (fin - datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")).total_seconds()
+        conn.execute("""
+            UPDATE corridas SET fin=?, duracion=?, estado=?, total=?, ok=?, bajo=?, medio=?,
+                                sin_datos=?
+            WHERE id=?
+        """, (fin.strftime("%Y-%m-%d %H:%M:%S"), duracion, estado, total, ok, bajo, medio,
+              sin_datos, corrida_id))
+
+
+def db_ultima_corrida():
+    """Retorna la última corrida completa como dict, o None si no hay ninguna."""
+    with db_connect() as conn:
+        row = conn.execute(
+            "SELECT * FROM corridas WHERE estado='completa' ORDER BY id DESC LIMIT 1").fetchone()
+        return dict(row) if row else None
+
+
+def db_corridas_listar(limite=100):
+    """Retorna las últimas corridas (más reciente primero) como lista de dicts."""
+    with db_connect() as conn:
+        return [dict(r) for r in conn.execute(
+            "SELECT * FROM corridas ORDER BY id DESC LIMIT ?", (limite,)).fetchall()]
+
+
+def db_recalcular_niveles(umbral_bajo, umbral_medio):
+    """Reclasifica todas las lecturas con nuevos umbrales y recalcula los totales de
+    las corridas, incluidas las archivadas. Retorna la cantidad de lecturas revisadas."""
+    with db_connect() as conn:
+        fuente = _fuente_lecturas(conn)
+        n = 0
+        for alias in [r[1] for r in conn.execute("PRAGMA database_list")
+                      if r[1] == "main" or r[1].startswith("archivo_")]:
+            n += conn.execute(
+                f"UPDATE {alias}.lecturas SET nivel = {_sql_nivel('nivel_min', '?', '?')}",
+                (umbral_bajo, umbral_medio)).rowcount
+        # Cada corrida cuenta sus lecturas y, con el guardado solo de cambios, las
+        # omitidas por repetir la anterior, clasificadas por su nivel_min. Las
+        # impresoras en espera no tienen ninguna de las dos y cuentan como sin datos.
+        totales = conn.execute(f"""
+            SELECT SUM(nivel = 0), SUM(nivel = 1), SUM(nivel = 2), corrida_id FROM (
+                SELECT corrida_id, nivel FROM {fuente} WHERE corrida_id IS NOT NULL
+                UNION ALL
+                SELECT corrida_id, {_sql_nivel('nivel_min', '?', '?')} FROM lecturas_omitidas
+            )
+            GROUP BY corrida_id
+        """, (umbral_bajo, umbral_medio)).fetchall()
+        conn.execute("UPDATE corridas SET umbral_bajo = ?, umbral_medio = ?, ok = 0, medio = 0, bajo = 0",
+                     (umbral_bajo, umbral_medio))
+        conn.executemany("UPDATE corridas SET ok = ?, medio = ?, bajo = ? WHERE id = ?", totales)
+        conn.execute("UPDATE corridas SET sin_datos = total - ok - medio - bajo")
+        return n
+
+
+def db_circuitos_cargar():
+    """Retorna {ip: [fallos, aperturas, proximo, ultimo_fallo]} de las IPs con fallos."""
+    with db_connect() as conn:
+        return {r[0]: list(r[1:]) for r in conn.execute(
+            "SELECT ip, fallos, aperturas, proximo, ultimo_fallo FROM circuitos").fetchall()}
+
+
+def db_circuitos_guardar(filas, cerrar):
+    """Guarda filas (ip, fallos, aperturas, proximo, ultimo_fallo) y borra las IPs de `cerrar`."""
+    with db_connect() as conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO circuitos (ip, fallos, aperturas, proximo, ultimo_fallo)
+            VALUES (?, ?, ?, ?, ?)
+        """, filas)
+        conn.executemany("DELETE FROM circuitos WHERE ip=?", [(ip,) for ip in cerrar])
+
+
+def db_latencias_cargar():
+    """Retorna {ip: (srtt, rttvar, muestras)} con la latencia suavizada de cada IP."""
+    with db_connect() as conn:
+        return {r[0]: (r[1], r[2], r[3]) for r in conn.execute(
+            "SELECT ip, srtt, rttvar, muestras FROM latencias").fetchall()}
+
+
+def db_latencias_guardar(filas, fecha):
+    """Guarda filas (ip, srtt, rttvar, muestras, ultima) de EstimadorLatencia.exportar()."""
+    with db_connect() as conn:
+        conn.executemany("""
+            INSERT INTO latencias (ip, srtt, rttvar, muestras, ultima, fecha)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(ip) DO UPDATE SET
+                srtt = excluded.srtt, rttvar = excluded.rttvar,
+                muestras = excluded.muestras,
+                ultima = COALESCE(excluded.ultima, latencias.ultima),
+                fecha = excluded.fecha
+        """, [f + (fecha,) for f in filas])
+
+# ---------------------------------------------------------------------------
+# Lógica de negocio — monitoreo
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+# Motor de sondeo asíncrono
+# ---------------------------------------------------------------------------
+
+RUTA_STATUS              = "/cgi-bin/dynamic/printer/PrinterStatus.html"
+TIMEOUT_HTTP             = 5      # segundos para una IP sin latencia registrada
+TIMEOUT_MIN_DEFAULT      = 0.5    # cotas del timeout adaptativo por impresora
+TIMEOUT_MAX_DEFAULT      = 10
+TIMEOUT_SONDEO_TCP       = 2      # tope del sondeo TCP a una impresora con circuito abierto
+PRESONDEO_TIMEOUT_DEFAULT = 1.0   # plazo del barrido TCP previo a la consulta HTTP
+SNMP_PUERTO_DEFAULT      = 161
+SNMP_COMUNIDAD_DEFAULT   = "public"
+SNMP_INDICES_DEFAULT     = "1,2,3"  # prtMarkerSuppliesIndex de tóner, kit, unidad
+CIRCUITO_FALLOS_DEFAULT  = 3      # fallos seguidos que abren el circuito de una IP
+CIRCUITO_ESPERA_DEFAULT  = 900    # segundos hasta el primer reintento (se duplica)
+CIRCUITO_ESPERA_MAX_DEFAULT = 86400
+MAX_CONCURRENCIA_DEFAULT = 500    # consultas simultáneas en el event loop
+POOL_MAX_DEFAULT         = 1000   # conexiones keep-alive en reposo (todas las IPs)
+POOL_INACTIVIDAD_DEFAULT = 1200   # segundos antes de cerrar una conexión en reposo
+
+
+class MotorSondeo:
+    """Event loop único, en un hilo daemon, donde corren todas las consultas HTTP.
+
+    Reemplaza al pool de hilos: cada impresora es una corrutina, así que una IP
+    caída solo ocupa un socket mientras vence su timeout, no un hilo del sistema.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _asegurar_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever,
+                                 name="motor-sondeo", daemon=True).start()
+            return self._loop
+
+    def ejecutar(self, coro):
+        """Corre una corrutina en el loop del motor y bloquea hasta su resultado."""
+        return asyncio.run_coroutine_threadsafe(coro, self._asegurar_loop()).result()
+
+    def sondear(self, impresoras, evento_cancelar, concurrencia, a_sondear=(), snmp=None):
+        """Consulta todas las impresoras con a lo sumo `concurrencia` conexiones abiertas.
+        Generador: entrega (impresora, (toner, kit, unidad), alcanzable) a medida que terminan,
+        en el hilo que lo itera. Ver _sondear_todas() para `a_sondear` y `snmp`.
+        """
+        cola = queue.Queue()
+        fin  = object()
+
+        async def _correr():
+            try:
+                await _sondear_todas(impresoras, evento_cancelar, concurrencia, cola.put,
+                                     a_sondear, snmp)
+            finally:
+                cola.put(fin)
+
+        futuro = asyncio.run_coroutine_threadsafe(_correr(), self._asegurar_loop())
+        while True:
+            item = cola.get()
+            if item is fin:
+                break
+            yield item
+        futuro.result()
+
+
+class PoolConexiones:
+    """Conexiones HTTP keep-alive reutilizables, agrupadas por (host, puerto).
+
+    Vive en el loop de MotorSondeo, que no se detiene entre corridas, así que
+    una conexión abierta en un monitoreo se reutiliza en el siguiente si la
+    impresora no la cerró. Las estructuras se protegen con lock para poder
+    leer estadísticas desde el hilo de la UI.
+    """
+
+    def __init__(self, max_total=POOL_MAX_DEFAULT, inactividad=POOL_INACTIVIDAD_DEFAULT,
+                 max_por_host=2):
+        self.max_total    = max_total
+        self.inactividad  = inactividad
+        self.max_por_host = max_por_host
+        self._libres      = {}      # (host, port) -> [(reader, writer, ts_devuelta)]
+        self._n_libres    = 0
+        self._lock        = threading.Lock()
+        self._limpieza    = None
+        self._stats       = {"nuevas": 0, "reutilizadas": 0, "expiradas": 0,
+                             "descartadas": 0, "fallos_reuso": 0}
+
+    async def obtener(self, host, port, timeout=TIMEOUT_HTTP):
+        """Retorna (reader, writer, reutilizada) con una conexión lista para usar.
+        `timeout` limita solo el establecimiento de una conexión nueva.
+        """
+        ahora = time.monotonic()
+        with self._lock:
+            libres = self._libres.get((host, port))
+            while libres:
+                reader, writer, ts = libres.pop()
+                self._n_libres -= 1
+                if ahora - ts > self.inactividad or writer.is_closing() or reader.at_eof():
+                    self._stats["expiradas"] += 1
+                    writer.close()
+                    continue
+                self._stats["reutilizadas"] += 1
+                return reader, writer, True
+        if self._limpieza is None or self._limpieza.done():
+            self._limpieza = asyncio.ensure_future(self._limpiar_periodicamente())
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        with self._lock:
+            self._stats["nuevas"] += 1
+        return reader, writer, False
+
+    def devolver(self, host, port, reader, writer):
+        """Deja la conexión en reposo para reutilizarla, o la cierra si el pool está lleno."""
+        with self._lock:
+            libres = self._libres.setdefault((host, port), [])
+            if len(libres) >= self.max_por_host or self._n_libres >= self.max_total:
+                self._stats["descartadas"] += 1
+                writer.close()
+                return
+            libres.append((reader, writer, time.monotonic()))
+            self._n_libres += 1
+
+    def fallo_reuso(self):
+        """Cuenta una conexión reutilizada que el servidor ya había cerrado."""
+        with self._lock:
+            self._stats["fallos_reuso"] += 1
+
+    def expirar(self):
+        """Cierra las conexiones que superaron el tiempo de inactividad."""
+        limite = time.monotonic() - self.inactividad
+        with self._lock:
+            for clave in list(self._libres):
+                vigentes = []
+                for reader, writer, ts in self._libres[clave]:
+                    if ts < limite or writer.is_closing():
+                        writer.close()
+                        self._n_libres -= 1
+                        self._stats["expiradas"] += 1
+                    else:
+                        vigentes.append((reader, writer, ts))
+                if vigentes:
+                    self._libres[clave] = vigentes
+                else:
+                    del self._libres[clave]
+
+    async def _limpiar_periodicamente(self):
+        while True:
+            await asyncio.sleep(30)
+            self.expirar()
+            if not self._n_libres:
+                return
+
+    def estadisticas(self):
+        """Retorna un dict con contadores de conexiones y la tasa de reutilización."""
+        with self._lock:
+            st = dict(self._stats, en_reposo=self._n_libres)
+        usadas = st["nuevas"] + st["reutilizadas"]
+        st["tasa_reuso"] = st["reutilizadas"] / usadas if usadas else 0.0
+        return st
+
+
+class EstimadorLatencia:
+    """Latencia suavizada por IP y timeout derivado, al estilo del RTO de TCP (RFC 6298).
+
+    Cada consulta exitosa aporta una muestra: srtt y rttvar son promedios móviles
+    exponenciales de la latencia y de su desvío, y el timeout es srtt + 4·rttvar,
+    acotado a [minimo, maximo]. Un timeout duplica el siguiente (backoff) sin
+    tocar srtt, así un enlace lento deja de cortarse antes de tiempo y una
+    impresora de la LAN que deja de responder falla rápido.
+    """
+
+    ALFA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, minimo=TIMEOUT_MIN_DEFAULT, maximo=TIMEOUT_MAX_DEFAULT):
+        self.minimo  = minimo
+        self.maximo  = maximo
+        self._datos  = {}       # ip -> [srtt, rttvar, muestras, ultima]
+        self._sucias = set()
+        self._lock   = threading.Lock()
+
+    def cargar(self, datos):
+        """Reemplaza el estado con {ip: (srtt, rttvar, muestras)} leído de la DB."""
+        with self._lock:
+            self._datos  = {ip: [srtt, rttvar, muestras, None]
+                            for ip, (srtt, rttvar, muestras) in datos.items()}
+            self._sucias = set()
+
+    def timeout(self, ip):
+        """Timeout de conexión y de lectura, en segundos, para la próxima consulta a ip."""
+        with self._lock:
+            d = self._datos.get(ip)
+        rto = TIMEOUT_HTTP if d is None else d[0] + 4 * d[1]
+        return min(max(rto, self.minimo), self.maximo)
+
+    def registrar(self, ip, segundos):
+        """Incorpora la latencia de una consulta exitosa."""
+        with self._lock:
+            d = self._datos.get(ip)
+            if d is None or not d[2]:
+                d = self._datos[ip] = [segundos, segundos / 2, 0, None]
+            else:
+                d[1] = (1 - self.BETA) * d[1] + self.BETA * abs(d[0] - segundos)
+                d[0] = (1 - self.ALFA) * d[0] + self.ALFA * segundos
+            d[2] += 1
+            d[3]  = segundos
+            self._sucias.add(ip)
+
+    def registrar_timeout(self, ip, timeout_usado):
+        """Backoff: el próximo timeout de ip será el doble del que venció."""
+        with self._lock:
+            d = self._datos.get(ip)
+            if d is None:
+                d = self._datos[ip] = [timeout_usado, 0.0, 0, None]
+            d[1] = max(d[1], (2 * timeout_usado - d[0]) / 4)
+            self._sucias.add(ip)
+
+    def exportar(self):
+        """Retorna [(ip, srtt, rttvar, muestras, ultima)] de las IPs modificadas desde
+        la última exportación, para persistirlas con db_latencias_guardar()."""
+        with self._lock:
+            filas = [(ip, *self._datos[ip]) for ip in self._sucias]
+            self._sucias = set()
+        return filas
+
+
+class CircuitosImpresoras:
+    """Circuito por IP para no gastar un timeout por corrida en impresoras apagadas.
+
+    Tras `umbral` fallos seguidos el circuito se abre: la IP no se consulta hasta
+    `proximo`. Vencida la espera se prueba con una conexión TCP; si la impresora
+    vuelve a fallar la espera se duplica (hasta `espera_max`), y con la primera
+    respuesta el circuito se cierra. Solo cuentan como fallos los de conexión o
+    plazo vencido: una página sin los valores no indica que esté apagada. El estado se guarda en la tabla
+    circuitos para que sobreviva a los reinicios.
+    """
+
+    def __init__(self, umbral=CIRCUITO_FALLOS_DEFAULT, espera=CIRCUITO_ESPERA_DEFAULT,
+                 espera_max=CIRCUITO_ESPERA_MAX_DEFAULT):
+        self.umbral     = umbral
+        self.espera     = espera
+        self.espera_max = espera_max
+        self._datos     = {}    # ip -> [fallos, aperturas, proximo, ultimo_fallo]
+        self._sucias    = set()
+        self._cerrar    = set()
+
+    def cargar(self, datos):
+        """Reemplaza el estado con lo leído por db_circuitos_cargar()."""
+        self._datos  = datos
+        self._sucias = set()
+        self._cerrar = set()
+
+    def estado(self, ip, ahora):
+        """'cerrado', 'abierto' (en espera, no consultar) o 'semiabierto' (sondear)."""
+        d = self._datos.get(ip)
+        if d is None or d[2] is None:
+            return "cerrado"
+        return "abierto" if ahora < d[2] else "semiabierto"
+
+    def registrar(self, ip, ok, ahora):
+        """Registra el resultado de una consulta. `ahora` es una fecha '%Y-%m-%d %H:%M:%S'."""
+        if ok:
+            if self._datos.pop(ip, None) is not None:
+                self._sucias.discard(ip)
+                self._cerrar.add(ip)
+            return
+        d = self._datos.setdefault(ip, [0, 0, None, None])
+        d[0] += 1
+        d[3]  = ahora
+        if d[0] >= self.umbral:
+            espera = min(self.espera * 2 ** d[1], self.espera_max)
+            d[1] += 1
+            d[2]  = (datetime.strptime(ahora, "%Y-%m-%d %H:%M:%S")
+                     + timedelta(seconds=espera)).strftime("%Y-%m-%d %H:%M:%S")
+        self._sucias.add(ip)
+        self._cerrar.discard(ip)
+
+    def exportar(self):
+        """Retorna (filas, cerrar) para db_circuitos_guardar() y limpia los cambios pendientes."""
+        filas = [(ip, *self._datos[ip]) for ip in self._sucias]
+        cerrar = list(self._cerrar)
+        self._sucias = set()
+        self._cerrar = set()
+        return filas, cerrar
+
+
+_motor     = MotorSondeo()
+_pool      = PoolConexiones()
+_latencias = EstimadorLatencia()
+_circuitos = CircuitosImpresoras()
+
+
+async def _sondear_todas(impresoras, evento_cancelar, concurrencia, entregar, a_sondear=(),
+                         snmp=None):
+    """Lanza una tarea por impresora, limitadas por semáforo, y entrega cada resultado
+    como (impresora, (toner, kit, unidad), alcanzable); ver _obtener_status_async().
+    Las IPs de `a_sondear` solo se consultan por HTTP si antes aceptan una conexión TCP.
+    `snmp` es {modelo: (índice tóner, kit, unidad)} de los modelos con backend SNMP.
+    """
+    semaforo = asyncio.Semaphore(max(1, concurrencia))
+    snmp     = snmp or {}
+
+    async def _una(imp):
+        async with semaforo:
+            if imp["modelo"] in snmp:
+                return (imp,) + await _obtener_status_snmp_async(
+                    imp["ip"], imp["modelo"], snmp[imp["modelo"]], evento_cancelar)
+            if (imp["ip"] in a_sondear and imp["modelo"] in MODELOS_CONFIG
+                    and not await _puerto_abierto(
+                        imp["ip"], 80, min(_latencias.timeout(imp["ip"]), TIMEOUT_SONDEO_TCP))):
+                return imp, (None, None, None), False
+            return (imp,) + await _obtener_status_async(imp["ip"], imp["modelo"], evento_cancelar)
+
+    pendientes = {asyncio.ensure_future(_una(imp)) for imp in impresoras}
+    while pendientes:
+        hechas, pendientes = await asyncio.wait(
+            pendientes, timeout=0.2, return_when=asyncio.FIRST_COMPLETED)
+        for tarea in hechas:
+            entregar(tarea.result())
+        if evento_cancelar.is_set():
+            for tarea in pendientes:
+                tarea.cancel()
+            await asyncio.gather(*pendientes, return_exceptions=True)
+            return
+
+
+async def _puerto_abierto(host, port, timeout):
+    """True si host acepta una conexión TCP en `timeout` segundos. La conexión queda
+    en el pool para la consulta HTTP que sigue."""
+    try:
+        reader, writer, _ = await _pool.obtener(host, port, timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    _pool.devolver(host, port, reader, writer)
+    return True
+
+
+async def _presondeo_tcp(ips, timeout, concurrencia):
+    """Barrido previo: intenta conectar al puerto 80 de todas las IPs a la vez, con
+    plazo `timeout` cada una. Retorna el conjunto de IPs que aceptaron la conexión.
+    """
+    semaforo = asyncio.Semaphore(max(1, concurrencia))
+
+    async def _una(ip):
+        async with semaforo:
+            return ip, await _puerto_abierto(ip, 80, timeout)
+
+    return {ip for ip, ok in await asyncio.gather(*(_una(ip) for ip in ips)) if ok}
+
+
+async def _leer_respuesta_http(reader):
+    """Lee una respuesta HTTP/1.x.
+    Retorna (status, headers, cuerpo en bytes, reutilizable) donde reutilizable
+    indica si la conexión puede volver al pool.
+    """
+    linea  = await reader.readline()
+    partes = linea.decode("latin-1").split(None, 2)
+    if len(partes) < 2 or not partes[0].startswith("HTTP/"):
+        raise ValueError(f"Respuesta HTTP inválida: {linea[:40]!r}")
+    version = partes[0]
+    status  = int(partes[1])
+    headers = {}
+    while True:
+        linea = await reader.readline()
+        if linea in (b"\r\n", b"\n", b""):
+            break
+        clave, _, valor = linea.decode("latin-1").partition(":")
+        headers[clave.strip().lower()] = valor.strip()
+
+    conexion     = headers.get("connection", "").lower()
+    reutilizable = conexion != "close" and (version != "HTTP/1.0" or conexion == "keep-alive")
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        cuerpo = bytearray()
+        while True:
+            tam = int(((await reader.readline()).split(b";")[0].strip() or b"0"), 16)
+            if tam == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            cuerpo += await reader.readexactly(tam)
+            await reader.readline()
+        return status, headers, bytes(cuerpo), reutilizable
+    if "content-length" in headers:
+        cuerpo = await reader.readexactly(int(headers["content-length"]))
+        return status, headers, cuerpo, reutilizable
+    return status, headers, await reader.read(), False
+
+
+async def _http_get(host, port, ruta, timeout=TIMEOUT_HTTP):
+    """GET HTTP/1.1 keep-alive usando el pool de conexiones. Retorna (status, headers, cuerpo).
+    `timeout` se aplica por separado a la conexión y a la lectura de la respuesta.
+    Si una conexión reutilizada resulta cerrada por la impresora, reintenta una vez
+    con una conexión nueva.
+    """
+    for intento in range(2):
+        reader, writer, reutilizada = await _pool.obtener(host, port, timeout)
+        try:
+            writer.write(
+                f"GET {ruta} HTTP/1.1\r\nHost: {host}\r\n"
+                f"Accept: text/html\r\nConnection: keep-alive\r\n\r\n".encode("latin-1"))
+            await writer.drain()
+            status, headers, cuerpo, reutilizable = await asyncio.wait_for(
+                _leer_respuesta_http(reader), timeout)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            writer.close()
+            if reutilizada and intento == 0:
+                _pool.fallo_reuso()
+                continue
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        if reutilizable:
+            _pool.devolver(host, port, reader, writer)
+        else:
+            writer.close()
+        return status, headers, cuerpo
+
+
+async def _descargar_status(ip, timeout=TIMEOUT_HTTP):
+    """Descarga la página de estado siguiendo hasta 3 redirecciones.
+    Retorna el HTML decodificado. Lanza excepción ante HTTP >= 400.
+    """
+    host, port, ruta = ip, 80, RUTA_STATUS
+    for _ in range(4):
+        status, headers, cuerpo = await _http_get(host, port, ruta, timeout)
+        if status in (301, 302, 303, 307, 308) and headers.get("location"):
+            destino = urlsplit(urljoin(f"http://{host}:{port}{ruta}", headers["location"]))
+            if destino.scheme != "http":
+                raise ValueError(f"Redirección no soportada: {headers['location']}")
+            host, port = destino.hostname, destino.port or 80
+            ruta = (destino.path or "/") + (f"?{destino.query}" if destino.query else "")
+            continue
+        if status >= 400:
+            raise ValueError(f"HTTP {status}")
+        charset = re.search(r"charset=([\w-]+)", headers.get("content-type", ""))
+        try:
+            return cuerpo.decode(charset.group(1) if charset else "iso-8859-1", errors="replace")
+        except LookupError:
+            return cuerpo.decode("iso-8859-1")
+    raise ValueError("Demasiadas redirecciones")
+
+
+_RE_PORCENTAJE = re.compile(r'\b\d+%|\b\d+\.\d+%')
+
+# Marcado que BeautifulSoup (html.parser) no incluye en get_text(): comentarios,
+# script/style/template, declaraciones y etiquetas. El grupo "cdata" sí es texto.
+# El grupo "abierto" marca un comentario, CDATA o script/style/template sin cierre.
+_RE_MARCADO = re.compile(
+    r'<!--.*?-->'
+    r'|<(script|style|template)\b.*?</\1\s*>'
+    r'|<!\[CDATA\[(?P<cdata>.*?)\]\]>'
+    r'|(?P<abierto><(?:!--|!\[CDATA\[|(?:script|style|template)\b))'
+    r'|<[!?][^>]*>'
+    r'|</?[a-zA-Z][^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>',
+    re.S | re.I)
+
+# Lo que html.parser interpreta distinto según el resto del documento: un "<" que
+# abre algo que no es una etiqueta válida y un "&#" que no forma una referencia.
+_RE_IRREGULAR = re.compile(
+    r'<[a-zA-Z/!?]'
+    r'|&#(?![0-9]+(?:[^0-9a-fA-F]|\Z)|[xX][0-9a-fA-F]+(?:[^0-9a-fA-F]|\Z))')
+
+# Referencias de carácter tal como las reconoce html.parser: el nombre o número debe
+# ir seguido de otro carácter (el ";" se consume). Al final del documento quedan literales.
+_RE_REFERENCIA = re.compile(
+    r'&(?:#(?P<num>[0-9]+|[xX][0-9a-fA-F]+)(?=[^0-9a-fA-F]|(?P<fin_num>\Z))'
+    r'|(?P<nombre>[a-zA-Z][-.a-zA-Z0-9]*)(?=[^a-zA-Z0-9]|(?P<fin_nombre>\Z)));?')
+
+
+def _desescapar(trozo, final):
+    """Reemplaza las referencias &...; de `trozo` igual que BeautifulSoup con html.parser.
+    `final` indica que el trozo termina el documento (y no antes de una etiqueta).
+    """
+    def reemplazo(m):
+        if final and (m.group("fin_num") is not None or m.group("fin_nombre") is not None):
+            return m.group()
+        if m.group("nombre"):
+            caracter = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(m.group("nombre"))
+            return caracter if caracter is not None else "&" + m.group("nombre")
+        num = m.group("num")
+        n   = int(num[1:], 16) if num[0] in "xX" else int(num)
+        if n < 256:
+            try:
+                return bytes([n]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        try:
+            return chr(n)
+        except (ValueError, OverflowError):
+            return "\N{REPLACEMENT CHARACTER}"
+    return _RE_REFERENCIA.sub(reemplazo, trozo)
+
+
+def _porcentajes_bs(texto_html):
+    """Todos los tokens NN% del texto visible, armando el árbol completo con BeautifulSoup."""
+    return _RE_PORCENTAJE.findall(BeautifulSoup(texto_html, 'html.parser').get_text())
+
+
+def _porcentajes_rapido(texto_html, necesarios):
+    """Extrae los primeros `necesarios` tokens NN% recorriendo el HTML una sola vez,
+    sin construir el árbol. Equivale a _RE_PORCENTAJE sobre soup.get_text(), pero se
+    detiene apenas tiene los valores pedidos. Puede devolver menos si la página no
+    tiene suficientes, y devuelve None si antes de llegar a ellos encuentra marcado
+    mal formado que html.parser resolvería de otra manera.
+    """
+    encontrados = []
+    pendiente   = ""
+    pos         = 0
+    marcas      = _RE_MARCADO.finditer(texto_html)
+    while True:
+        m     = next(marcas, None)
+        trozo = texto_html[pos:m.start() if m else len(texto_html)]
+        if m is not None and (m.group("abierto")
+                              or m.group(1) == "template" and "<" in m.group()[1:-2]):
+            return None
+        if ("<" in trozo or "&#" in trozo) and _RE_IRREGULAR.search(trozo):
+            return None
+        if "&" in trozo:
+            trozo = _desescapar(trozo, final=m is None)
+        if m is not None:
+            pos = m.end()
+            trozo += m.group("cdata") or ""
+        pendiente += trozo
+        if "%" in trozo:
+            ultimo = 0
+            for p in _RE_PORCENTAJE.finditer(pendiente):
+                encontrados.append(p.group())
+                if len(encontrados) >= necesarios:
+                    return encontrados
+                ultimo = p.end()
+            pendiente = pendiente[ultimo:]
+        # Solo los dígitos finales (y el carácter previo, por el \b) pueden
+        # formar parte de un token que se complete en el próximo trozo.
+        i = len(pendiente)
+        while i and pendiente[i - 1] in "0123456789.":
+            i -= 1
+        pendiente = pendiente[max(0, i - 1):]
+        if m is None:
+            return encontrados
+
+
+def _extraer_consumibles(texto_html, modelo):
+    """Extrae (toner, kit, unidad) como decimales 0-1 de la página de estado.
+    Usa el extractor rápido y recurre a BeautifulSoup si encuentra menos valores
+    de los que el modelo necesita o marcado mal formado.
+    """
+    indices     = MODELOS_CONFIG[modelo]
+    necesarios  = max(i for i in indices if i is not None) + 1
+    porcentajes = _porcentajes_rapido(texto_html, necesarios)
+    if porcentajes is None or len(porcentajes) < necesarios:
+        porcentajes = _porcentajes_bs(texto_html)
+
+    def extraer(idx):
+        if idx is None or len(porcentajes) <= idx:
+            return None
+        return float(porcentajes[idx].replace('%', '')) / 100
+
+    return extraer(indices[0]), extraer(indices[1]), extraer(indices[2])
+
+
+async def _obtener_status_async(ip, modelo, evento_cancelar):
+    """Versión asíncrona de obtener_status; corre dentro del loop del motor.
+    Retorna ((toner, kit, unidad), alcanzable): alcanzable es False si no se pudo
+    conectar o venció el plazo, True si la impresora respondió (aunque la página no
+    tenga los valores) y None si no se consultó (cancelada o modelo no soportado).
+    """
+    if evento_cancelar.is_set() or modelo not in MODELOS_CONFIG:
+        return (None, None, None), None
+    timeout = _latencias.timeout(ip)
+    inicio  = time.monotonic()
+    try:
+        texto = await asyncio.wait_for(_descargar_status(ip, timeout), 2 * timeout)
+        _latencias.registrar(ip, time.monotonic() - inicio)
+        return _extraer_consumibles(texto, modelo), True
+    except asyncio.TimeoutError:
+        if evento_cancelar.is_set():
+            return (None, None, None), None
+        _latencias.registrar_timeout(ip, timeout)
+        _log.error("IP %-15s  modelo %-22s  error: timeout (%.1f s)", ip, modelo, timeout)
+        return (None, None, None), False
+    except Exception as e:
+        if evento_cancelar.is_set():
+            return (None, None, None), None
+        _log.error("IP %-15s  modelo %-22s  error: %s", ip, modelo, str(e) or type(e).__name__)
+        return (None, None, None), not isinstance(e, OSError)
+
+
+def obtener_status(ip, modelo, evento_cancelar):
+    """Consulta una impresora por HTTP. Retorna (toner, kit, unidad) como
+    decimales 0-1, o (None, None, None) si no se puede obtener el dato."""
+    return _motor.ejecutar(_obtener_status_async(ip, modelo, evento_cancelar))[0]
+
+
+# ---------------------------------------------------------------------------
+# Backend SNMP (Printer-MIB, RFC 3805)
+# ---------------------------------------------------------------------------
+# Alternativa al scraping de PrinterStatus.html, seleccionable por modelo en la
+# tabla modelos (columna backend). Un único GetRequest SNMPv2c pide nivel y
+# capacidad de los tres insumos: un datagrama de ida y uno de vuelta por impresora.
+
+OID_SUPPLIES_MAX   = "1.3.6.1.2.1.43.11.1.1.8.1"   # prtMarkerSuppliesMaxCapacity.1.N
+OID_SUPPLIES_LEVEL = "1.3.6.1.2.1.43.11.1.1.9.1"   # prtMarkerSuppliesLevel.1.N
+
+# Puerto y comunidad; ejecutar_monitoreo los actualiza desde config.json en cada corrida
+_snmp_cfg = SimpleNamespace(puerto=SNMP_PUERTO_DEFAULT, comunidad=SNMP_COMUNIDAD_DEFAULT)
+
+
+def _parsear_indices_snmp(texto):
+    """'1,2,3' -> (1, 2, 3). Un índice vacío o '-' indica que el modelo no tiene ese insumo."""
+    partes = [p.strip() for p in (texto or SNMP_INDICES_DEFAULT).split(",")]
+    partes = (partes + ["", "", ""])[:3]
+    return tuple(int(p) if p.isdigit() else None for p in partes)
+
+
+def _ber_tlv(tag, contenido):
+    n = len(contenido)
+    if n < 0x80:
+        return bytes((tag, n)) + contenido
+    largo = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    return bytes((tag, 0x80 | len(largo))) + largo + contenido
+
+
+def _ber_entero(valor):
+    return _ber_tlv(0x02, valor.to_bytes(max(1, (valor.bit_length() + 8) // 8), "big", signed=True))
+
+
+def _ber_oid(oid):
+    nums   = [int(x) for x in oid.split(".")]
+    cuerpo = bytearray((40 * nums[0] + nums[1],))
+    for n in nums[2:]:
+        trozo = [n & 0x7F]
+        while n > 0x7F:
+            n >>= 7
+            trozo.append(0x80 | (n & 0x7F))
+        cuerpo += bytes(reversed(trozo))
+    return _ber_tlv(0x06, bytes(cuerpo))
+
+
+def _ber_leer(datos, pos):
+    """Lee un TLV en `pos`. Retorna (tag, contenido, posición siguiente)."""
+    tag, n = datos[pos], datos[pos + 1]
+    pos += 2
+    if n & 0x80:
+        k = n & 0x7F
+        n = int.from_bytes(datos[pos:pos + k], "big")
+        pos += k
+    if pos + n > len(datos):
+        raise ValueError("Respuesta SNMP truncada")
+    return tag, datos[pos:pos + n], pos + n
+
+
+def _ber_oid_texto(contenido):
+    nums, n = [], 0
+    for b in contenido:
+        n = (n << 7) | (b & 0x7F)
+        if not b & 0x80:
+            nums.append(n)
+            n = 0
+    primero = min(nums[0] // 40, 2)
+    return ".".join(map(str, [primero, nums[0] - 40 * primero] + nums[1:]))
+
+
+def _snmp_get_pdu(comunidad, request_id, oids):
+    """Arma un GetRequest SNMPv2c con un varbind por OID."""
+    varbinds = b"".join(_ber_tlv(0x30, _ber_oid(o) + b"\x05\x00") for o in oids)
+    pdu = _ber_tlv(0xA0, _ber_entero(request_id) + _ber_entero(0) + _ber_entero(0)
+                   + _ber_tlv(0x30, varbinds))
+    return _ber_tlv(0x30, _ber_entero(1) + _ber_tlv(0x04, comunidad.encode()) + pdu)
+
+
+def _snmp_respuesta(datos):
+    """Decodifica un GetResponse. Retorna (request_id, error_status, {oid: valor}).
+    Los valores no enteros y las excepciones noSuchObject/noSuchInstance quedan como None.
+    """
+    _, mensaje, _ = _ber_leer(datos, 0)
+    _, _, pos     = _ber_leer(mensaje, 0)                  # versión
+    _, _, pos     = _ber_leer(mensaje, pos)                # comunidad
+    tag, pdu, _   = _ber_leer(mensaje, pos)
+    if tag != 0xA2:
+        raise ValueError(f"PDU SNMP inesperada: 0x{tag:02X}")
+    _, rid, pos    = _ber_leer(pdu, 0)
+    _, estado, pos = _ber_leer(pdu, pos)
+    _, _, pos      = _ber_leer(pdu, pos)                   # error-index
+    _, varbinds, _ = _ber_leer(pdu, pos)
+    valores, pos = {}, 0
+    while pos < len(varbinds):
+        _, vb, pos      = _ber_leer(varbinds, pos)
+        _, oid, p2      = _ber_leer(vb, 0)
+        tag, valor, _   = _ber_leer(vb, p2)
+        if tag == 0x02:                                    # INTEGER
+            valores[_ber_oid_texto(oid)] = int.from_bytes(valor, "big", signed=True)
+        elif tag in (0x41, 0x42):                          # Counter32 / Gauge32
+            valores[_ber_oid_texto(oid)] = int.from_bytes(valor, "big")
+        else:
+            valores[_ber_oid_texto(oid)] = None
+    return (int.from_bytes(rid, "big", signed=True),
+            int.from_bytes(estado, "big", signed=True), valores)
 
 
-def db_cargar_ultimo_monitoreo(umbral_bajo, umbral_medio):
-    """Retorna (filas, fecha_str) del monitoreo más reciente para poblar la tabla al inicio.
-    filas: lista de tuplas (sucursal, ip, modelo, toner_str, unidad_str, kit_str, tag).
-    """
-    with db_connect() as conn:
-        row_fecha = conn.execute("SELECT MAX(fecha) FROM monitoreos").fetchone()
-        if not row_fecha or row_fecha[0] is None:
-            return [], None
-        ultima_fecha = row_fecha[0]
-        rows = conn.execute("""
-            SELECT COALESCE(i.sucursal, '') AS sucursal,
-                   m.ip,
-                   COALESCE(i.modelo, '')   AS modelo,
-                   m.toner, m.unidad_imagen, m.kit_mantenimiento,
-                   (SELECT MAX(fecha) FROM monitoreos WHERE ip = m.ip) AS ult_fecha
-            FROM monitoreos m
-            LEFT JOIN impresoras i ON m.ip = i.ip
-            WHERE m.fecha = ?
-            ORDER BY sucursal, m.ip
-        """, (ultima_fecha,)).fetchall()
+class _ProtocoloSNMP(asyncio.DatagramProtocol):
+    """Entrega al futuro la primera respuesta con el request-id esperado."""
 
-    filas = []
-    for r in rows:
+    def __init__(self, request_id, futuro):
+        self.request_id = request_id
+        self.futuro     = futuro
+
+    def datagram_received(self, datos, addr):
         try:
-            fecha_ult = datetime.strptime(r[6], "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y %H:%M")
-        except (ValueError, TypeError):
-            fecha_ult = str(r[6] or "")
-        toner  = r[3]
-        unidad = r[4]
-        kit    = r[5]
-        toner_str  = f"{toner*100:.1f}%"  if toner  is not None else "—"
-        unidad_str = f"{unidad*100:.1f}%" if unidad is not None else "—"
-        kit_str    = f"{kit*100:.1f}%"    if kit    is not None else "—"
-        valores = [v for v in (toner, kit, unidad) if v is not None]
-        tag     = clasificar_nivel(valores, umbral_bajo, umbral_medio)
-        filas.append((r[0], r[1], r[2], fecha_ult, toner_str, unidad_str, kit_str, tag))
-    return filas, ultima_fecha
+            rid, estado, valores = _snmp_respuesta(datos)
+        except (ValueError, IndexError):
+            return
+        if rid == self.request_id and not self.futuro.done():
+            self.futuro.set_result((estado, valores))
+
+    def error_received(self, exc):
+        if not self.futuro.done():
+            self.futuro.set_exception(exc)
+
+
+async def _snmp_get(host, port, comunidad, oids, timeout, reintentos=1):
+    """GetRequest SNMPv2c por UDP. Retorna {oid: valor}; reenvía el datagrama
+    `reintentos` veces si no llega respuesta en `timeout` segundos."""
+    loop       = asyncio.get_running_loop()
+    request_id = int.from_bytes(os.urandom(3), "big")
+    futuro     = loop.create_future()
+    transporte, _ = await loop.create_datagram_endpoint(
+        lambda: _ProtocoloSNMP(request_id, futuro), remote_addr=(host, port))
+    try:
+        pdu = _snmp_get_pdu(comunidad, request_id, oids)
+        for intento in range(reintentos + 1):
+            transporte.sendto(pdu)
+            try:
+                estado, valores = await asyncio.wait_for(asyncio.shield(futuro), timeout)
+                break
+            except asyncio.TimeoutError:
+                if intento == reintentos:
+                    raise
+        if estado:
+            raise ValueError(f"SNMP error-status {estado}")
+        return valores
+    finally:
+        transporte.close()
 
-# ---------------------------------------------------------------------------
-# Lógica de negocio — monitoreo
-# ---------------------------------------------------------------------------
 
-def obtener_status(ip, modelo, evento_cancelar):
-    """Consulta una impresora por HTTP. Retorna (toner, kit, unidad) como
-    decimales 0-1, o (None, None, None) si no se puede obtener el dato."""
-    if evento_cancelar.is_set():
+async def _consumibles_snmp(ip, indices, timeout):
+    """(toner, kit, unidad) como decimales 0-1 leídos de prtMarkerSuppliesLevel/MaxCapacity.
+    Niveles negativos (-2 desconocido, -3 'queda algo') o capacidad no positiva dan None.
+    """
+    oids = [f"{base}.{i}" for i in indices if i is not None
+            for base in (OID_SUPPLIES_LEVEL, OID_SUPPLIES_MAX)]
+    if not oids:
         return None, None, None
-    try:
-        url = f"http://{ip}/cgi-bin/dynamic/printer/PrinterStatus.html"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        porcentajes = re.findall(r'\b\d+%|\b\d+\.\d+%', soup.get_text())
+    valores = await _snmp_get(ip, _snmp_cfg.puerto, _snmp_cfg.comunidad, oids, timeout)
 
-        if modelo not in MODELOS_CONFIG:
-            return None, None, None
+    def extraer(idx):
+        if idx is None:
+            return None
+        nivel  = valores.get(f"{OID_SUPPLIES_LEVEL}.{idx}")
+        maximo = valores.get(f"{OID_SUPPLIES_MAX}.{idx}")
+        if nivel is None or maximo is None or nivel < 0 or maximo <= 0:
+            return None
+        return min(nivel / maximo, 1.0)
 
-        indices = MODELOS_CONFIG[modelo]
+    return extraer(indices[0]), extraer(indices[1]), extraer(indices[2])
 
-        def extraer(idx):
-            if idx is None or len(porcentajes) <= idx:
-                return None
-            return float(porcentajes[idx].replace('%', '')) / 100
 
-        return extraer(indices[0]), extraer(indices[1]), extraer(indices[2])
+async def _obtener_status_snmp_async(ip, modelo, indices, evento_cancelar):
+    """Versión SNMP de _obtener_status_async, con el mismo timeout adaptativo y el
+    mismo resultado ((toner, kit, unidad), alcanzable)."""
+    if evento_cancelar.is_set():
+        return (None, None, None), None
+    timeout = _latencias.timeout(ip)
+    inicio  = time.monotonic()
+    try:
+        res = await _consumibles_snmp(ip, indices, timeout)
+        _latencias.registrar(ip, time.monotonic() - inicio)
+        return res, True
+    except asyncio.TimeoutError:
+        if evento_cancelar.is_set():
+            return (None, None, None), None
+        _latencias.registrar_timeout(ip, timeout)
+        _log.error("IP %-15s  modelo %-22s  error: SNMP timeout (%.1f s)", ip, modelo, timeout)
+        return (None, None, None), False
     except Exception as e:
-        if not evento_cancelar.is_set():
-            _log.error("IP %-15s  modelo %-22s  error: %s", ip, modelo, e)
-        return None, None, None
+        if evento_cancelar.is_set():
+            return (None, None, None), None
+        _log.error("IP %-15s  modelo %-22s  error SNMP: %s", ip, modelo, str(e) or type(e).__name__)
+        return (None, None, None), not isinstance(e, OSError)
+
+
+def obtener_status_snmp(ip, modelo, indices, evento_cancelar):
+    """Consulta una impresora por SNMP. Retorna (toner, kit, unidad) como en obtener_status."""
+    return _motor.ejecutar(_obtener_status_snmp_async(ip, modelo, indices, evento_cancelar))[0]
+
 
+# ---------------------------------------------------------------------------
+# Clasificación y pronóstico de niveles
+# ---------------------------------------------------------------------------
 
 def clasificar_nivel(valores, umbral_bajo, umbral_medio):
     """Clasifica consumibles según umbrales.
@@ -672,6 +2949,48 @@ def predecir_agotamiento(fechas, valores):
 
     return fecha_pred
 
+
+def _pronosticar(ids, ts, valores, ahora):
+    """Ajusta una recta por mínimos cuadrados a cada impresora y consumible a la vez.
+
+    ids, ts: arrays de n lecturas ordenadas por (id, ts); valores: array (n, 3) de
+    tóner, unidad y kit en milésimas (NaN = sin dato). Solo cuenta el tramo desde la
+    última suba de más de PRONOSTICO_SALTO (recambio). Retorna (grupos, fechas): los
+    ids distintos y un array (len(grupos), 3) con el ts epoch en que cada recta llega
+    a cero, o NaN si no baja, tiene menos de PRONOSTICO_MIN_LECTURAS lecturas o el
+    cero no cae entre ahora y PRONOSTICO_MAX_DIAS días.
+    """
+    grupos, g = np.unique(ids, return_inverse=True)
+    k = len(grupos)
+    x = (ts - ahora) / 86400.0          # días respecto de ahora: números chicos
+    fechas = np.full((k, 3), np.nan)
+    for c in range(3):
+        y = valores[:, c]
+        validos = ~np.isnan(y)
+        gv, xv, yv = g[validos], x[validos], y[validos]
+        pos  = np.arange(len(yv))
+        suba = np.zeros(len(yv), dtype=bool)
+        suba[1:] = (gv[1:] == gv[:-1]) & (yv[1:] - yv[:-1] > PRONOSTICO_SALTO)
+        inicio = np.zeros(k, dtype=np.int64)
+        np.maximum.at(inicio, gv[suba], pos[suba])
+        tramo = pos >= inicio[gv]
+        gv, xv, yv = gv[tramo], xv[tramo], yv[tramo]
+
+        n   = np.bincount(gv, minlength=k)
+        sx  = np.bincount(gv, xv, k)
+        sy  = np.bincount(gv, yv, k)
+        sxx = np.bincount(gv, xv * xv, k)
+        sxy = np.bincount(gv, xv * yv, k)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            den       = n * sxx - sx * sx
+            pendiente = (n * sxy - sx * sy) / den
+            ordenada  = (sy - pendiente * sx) / n
+            cero      = -ordenada / pendiente
+            ok = ((n >= PRONOSTICO_MIN_LECTURAS) & (den > 1e-9 * n * sxx) & (pendiente < 0)
+                  & (cero > 0) & (cero <= PRONOSTICO_MAX_DIAS))
+        fechas[ok, c] = ahora + cero[ok] * 86400
+    return grupos, fechas
+
 # ---------------------------------------------------------------------------
 # Ventana de stock de depósito
 # ---------------------------------------------------------------------------
@@ -914,23 +3233,14 @@ def abrir_stock_deposito():
             defaultextension=".xlsx", filetypes=[("Excel", "*.xlsx")],
             initialfile=f"stock_{datetime.now().strftime('%Y%m%d')}.xlsx", parent=win)
         if not ruta: return
-        wb = Workbook(); ws = wb.active; ws.title = "Stock"
-        headers = list(cols_stock); widths = [14, 26, 12, 8, 8]
-        hf = PatternFill("solid", fgColor="4472C4"); hfont = Font(bold=True, color="FFFFFF")
-        for col, (h, w) in enumerate(zip(headers, widths), 1):
-            c = ws.cell(row=1, column=col, value=h); c.fill = hf; c.font = hfont
-            c.alignment = Alignment(horizontal="center")
-            ws.column_dimensions[c.column_letter].width = w
-        fills = {"critico": PatternFill("solid", fgColor="FFCDD2"),
-                 "bajo":    PatternFill("solid", fgColor="FFF9C4")}
+        # Los valores se copian de la tabla acá: el hilo de exportación no toca widgets
+        filas = []
         for item in items:
-            ws.append(list(tree_stock.item(item, "values")))
             tag = (tree_stock.item(item, "tags") or ("",))[0]
-            if tag in fills:
-                for col in range(1, len(headers)+1):
-                    ws.cell(row=ws.max_row, column=col).fill = fills[tag]
-        wb.save(ruta)
-        messagebox.showinfo("Exportado", f"Stock guardado:\n{ruta}", parent=win)
+            filas.append((list(tree_stock.item(item, "values")),
+                          f"stock_{tag}" if tag in ("critico", "bajo") else None))
+        _exportar_excel_en_hilo(win, ruta, [_hoja_excel(
+            "Stock", list(cols_stock), [14, 26, 12, 8, 8], filas, "encabezado_azul")])
 
     def _registrar_entrada():
         tipo, modelo = var_tipo_ent.get().strip(), var_modelo_ent.get().strip()
@@ -1026,28 +3336,17 @@ def abrir_stock_deposito():
             defaultextension=".xlsx", filetypes=[("Excel", "*.xlsx")],
             initialfile=f"movimientos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx", parent=win)
         if not ruta: return
-        wb = Workbook(); ws = wb.active; ws.title = "Movimientos"
-        headers = list(cols_hist); widths = [17, 10, 14, 24, 8, 30]
-        hf = PatternFill("solid", fgColor="CCCCCC"); hfont = Font(bold=True)
-        for col, (h, w) in enumerate(zip(headers, widths), 1):
-            c = ws.cell(row=1, column=col, value=h); c.fill = hf; c.font = hfont
-            c.alignment = Alignment(horizontal="center")
-            ws.column_dimensions[c.column_letter].width = w
-        fills = {"entrada": PatternFill("solid", fgColor="C8E6C9"),
-                 "salida":  PatternFill("solid", fgColor="FFCDD2"),
-                 "ajuste":  PatternFill("solid", fgColor="BBDEFB")}
-        for r in all_movs:
-            try:
-                fecha_str = datetime.strptime(r[0], "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y %H:%M")
-            except (ValueError, TypeError):
-                fecha_str = str(r[0] or "")
-            tipo_label = {"entrada": "Entrada", "salida": "Salida", "ajuste": "Ajuste"}.get(r[1], r[1].capitalize())
-            ws.append([fecha_str, tipo_label, r[2], r[3], r[4], r[5] or ""])
-            if r[1] in fills:
-                for col in range(1, len(headers)+1):
-                    ws.cell(row=ws.max_row, column=col).fill = fills[r[1]]
-        wb.save(ruta)
-        messagebox.showinfo("Exportado", f"Movimientos guardados:\n{ruta}", parent=win)
+        def filas(movs):
+            for r in movs:
+                try:
+                    fecha_str = datetime.strptime(r[0], "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y %H:%M")
+                except (ValueError, TypeError):
+                    fecha_str = str(r[0] or "")
+                tipo_label = {"entrada": "Entrada", "salida": "Salida", "ajuste": "Ajuste"}.get(r[1], r[1].capitalize())
+                yield ([fecha_str, tipo_label, r[2], r[3], r[4], r[5] or ""],
+                       f"mov_{r[1]}" if r[1] in ("entrada", "salida", "ajuste") else None)
+        _exportar_excel_en_hilo(win, ruta, [_hoja_excel(
+            "Movimientos", list(cols_hist), [17, 10, 14, 24, 8, 30], filas(list(all_movs)))])
 
     def _pag_mov(delta):
         nonlocal mov_cur_page
@@ -1557,7 +3856,13 @@ def abrir_historial():
     win.resizable(True, True)
 
     # ── Estado ──────────────────────────────────────────────────────────────
-    all_filas    = []
+    # Solo se guarda la página visible; filtros y orden se resuelven en SQL
+    filtros      = {}
+    conteos      = {}             # tag -> lecturas que cumplen los filtros
+    total_filas  = 0
+    total_dias   = 0
+    limites      = [None, None]   # cursores de la primera y la última fila (o día) visibles
+    dia_de_nodo  = {}             # vista árbol: iid de grupo sin expandir -> 'YYYY-MM-DD'
     page_size    = 200
     current_page = 0
     sort_col     = None
@@ -1608,6 +3913,21 @@ def abrir_historial():
     Combobox(row1, textvariable=var_alerta, values=["Todos", "Bajo", "Medio", "Sin datos", "Normal"],
              state="readonly", width=10, font=FONT_UI).pack(side="left", padx=(0, 10))
 
+    tk.Label(row1, text="Corrida:", **lbl_kw).pack(side="left", padx=(0, 4))
+    var_corrida = tk.StringVar(value="Todas")
+    corridas_h  = {}
+    for c in db_corridas_listar():
+        try:
+            etiqueta = datetime.strptime(c["inicio"], "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y %H:%M")
+        except (ValueError, TypeError):
+            etiqueta = str(c["inicio"])
+        etiqueta += " (auto)" if c["automatico"] else ""
+        if c["estado"] != "completa":
+            etiqueta += f" [{c['estado']}]"
+        corridas_h[etiqueta] = c["id"]
+    Combobox(row1, textvariable=var_corrida, values=["Todas"] + list(corridas_h),
+             state="readonly", width=24, font=FONT_UI).pack(side="left", padx=(0, 10))
+
     btn_filtrar_h = tk.Button(row1, text="Filtrar")
     btn_filtrar_h.pack(side="left", padx=(0, 4))
     btn_todos_h   = tk.Button(row1, text="Ver todos")
@@ -1673,75 +3993,81 @@ def abrir_historial():
         except ValueError:
             return None
 
-    def mostrar_pagina():
+    def mostrar_pagina(cursor=None, atras=False):
         tree_h.delete(*tree_h.get_children())
+        dia_de_nodo.clear()
         if modo_arbol:
-            _mostrar_arbol()
+            _mostrar_arbol(cursor, atras)
         else:
-            _mostrar_plano()
+            _mostrar_plano(cursor, atras)
 
-    def _mostrar_plano():
-        inicio = current_page * page_size
-        pagina = all_filas[inicio:inicio + page_size]
+    def _mostrar_plano(cursor, atras):
+        pagina, primero, ultimo = db_historial_pagina(filtros, sort_col, sort_asc,
+                                                      cursor, atras, page_size)
+        limites[:] = [primero, ultimo]
         for f in pagina:
             tree_h.insert("", "end", values=f[:7], tags=(f[7],))
-        total = len(all_filas)
-        pag_tot = max(1, (total + page_size - 1) // page_size)
+        inicio  = current_page * page_size
+        pag_tot = max(1, (total_filas + page_size - 1) // page_size)
         lbl_pag.config(text=f"Pág. {current_page + 1} / {pag_tot}")
         btn_prev.config(state="normal" if current_page > 0 else "disabled")
-        btn_next.config(state="normal" if inicio + page_size < total else "disabled")
-        lbl_total_h.config(text=f"Total: {total} registro{'s' if total != 1 else ''}")
-
-    def _mostrar_arbol():
-        nonlocal sort_col, sort_asc
-        grupos = {}
-        for f in all_filas:
-            dia = f[0].split(" ")[0]
-            grupos.setdefault(dia, []).append(f)
-        try:
-            fechas_ord = sorted(grupos.keys(),
-                                key=lambda d: datetime.strptime(d, "%d/%m/%Y"),
-                                reverse=not sort_asc if sort_col == 0 else False)
-        except (ValueError, TypeError):
-            fechas_ord = sorted(grupos.keys(), reverse=not sort_asc if sort_col == 0 else False)
-        total_grupos = len(fechas_ord)
-        inicio = current_page * grupos_por_pagina
-        pagina = fechas_ord[inicio:inicio + grupos_por_pagina]
-        for dia in pagina:
-            regs = grupos[dia]
-            n = len(regs)
-            padre = tree_h.insert("", "end", text=f"  {dia}",
+        btn_next.config(state="normal" if inicio + page_size < total_filas else "disabled")
+        lbl_total_h.config(text=f"Total: {total_filas} registro{'s' if total_filas != 1 else ''}"
+                                f"  |  Bajo: {conteos.get('bajo', 0)}  Medio: {conteos.get('medio', 0)}"
+                                f"  Sin datos: {conteos.get('sin_datos', 0)}")
+
+    def _mostrar_arbol(cursor, atras):
+        nonlocal total_dias
+        descendente = sort_col == 0 and not sort_asc
+        dias, total_dias = db_historial_dias(filtros, descendente, cursor, atras, grupos_por_pagina)
+        limites[:] = [dias[0][0], dias[-1][0]] if dias else [None, None]
+        for dia, n in dias:
+            etiqueta = datetime.strptime(dia, "%Y-%m-%d").strftime("%d/%m/%Y")
+            padre = tree_h.insert("", "end", text=f"  {etiqueta}",
                                   values=("", "", "", f"{n} registro{'s' if n!=1 else ''}", "", "", ""),
                                   tags=("fecha_grupo",), open=False)
-            for f in regs:
-                tree_h.insert(padre, "end", text="", values=f[:7], tags=(f[7],))
-        pag_tot = max(1, (total_grupos + grupos_por_pagina - 1) // grupos_por_pagina)
-        lbl_pag.config(text=f"Pág. {current_page+1}/{pag_tot} ({total_grupos} fechas)")
+            # Las lecturas del día se consultan al expandir el grupo
+            tree_h.insert(padre, "end", text="", values=("", "", "", "Cargando\u2026", "", "", ""))
+            dia_de_nodo[padre] = dia
+        inicio  = current_page * grupos_por_pagina
+        pag_tot = max(1, (total_dias + grupos_por_pagina - 1) // grupos_por_pagina)
+        lbl_pag.config(text=f"Pág. {current_page+1}/{pag_tot} ({total_dias} fechas)")
         btn_prev.config(state="normal" if current_page > 0 else "disabled")
-        btn_next.config(state="normal" if inicio + grupos_por_pagina < total_grupos else "disabled")
-        lbl_total_h.config(text=f"Total: {len(all_filas)} regs, {total_grupos} fechas")
+        btn_next.config(state="normal" if inicio + grupos_por_pagina < total_dias else "disabled")
+        lbl_total_h.config(text=f"Total: {total_filas} regs, {total_dias} fechas")
+
+    def _expandir_dia(_=None):
+        padre = tree_h.focus()
+        dia   = dia_de_nodo.pop(padre, None)
+        if dia is None:
+            return
+        tree_h.delete(*tree_h.get_children(padre))
+        filas, _, _ = db_historial_pagina({**filtros, "desde": dia, "hasta": dia}, limite=None)
+        for f in filas:
+            tree_h.insert(padre, "end", text="", values=f[:7], tags=(f[7],))
 
     def cargar():
-        nonlocal all_filas, current_page, sort_col, sort_asc
+        nonlocal total_filas, current_page, sort_col, sort_asc
         current_page = 0
         sort_col = None
         sort_asc = True
         for i, col in enumerate(cols_hist):
             tree_h.heading(col, text=col)
 
-        filas = db_cargar_historial(
-            desde    = _fecha_a_db(var_desde.get()),
-            hasta    = _fecha_a_db(var_hasta.get()),
-            sucursal = var_suc.get(),
-            modelo   = var_modelo.get(),
-            ip       = var_ip.get(),
+        tag_map = {"Bajo": "bajo", "Medio": "medio", "Sin datos": "sin_datos", "Normal": ""}
+        filtros.clear()
+        filtros.update(
+            desde      = _fecha_a_db(var_desde.get()),
+            hasta      = _fecha_a_db(var_hasta.get()),
+            sucursal   = var_suc.get(),
+            modelo     = var_modelo.get(),
+            ip         = var_ip.get(),
+            corrida_id = corridas_h.get(var_corrida.get()),
+            alerta     = tag_map.get(var_alerta.get()),
         )
-        alerta_filtro = var_alerta.get()
-        if alerta_filtro != "Todos":
-            tag_map = {"Bajo": "bajo", "Medio": "medio", "Sin datos": "sin_datos", "Normal": ""}
-            target_tag = tag_map.get(alerta_filtro, "")
-            filas = [f for f in filas if f[7] == target_tag]
-        all_filas = filas
+        conteos.clear()
+        conteos.update(db_historial_contar_niveles(**filtros))
+        total_filas = sum(conteos.values())
         mostrar_pagina()
 
     def filtrar_h():
@@ -1754,34 +4080,27 @@ def abrir_historial():
         var_modelo.set("Todos")
         var_ip.set("Todas")
         var_alerta.set("Todos")
+        var_corrida.set("Todas")
         cargar()
 
-    def grafico_h():
+    def _ip_seleccionada():
         sel = tree_h.selection()
         if sel and not tree_h.get_children(sel[0]):
-            mostrar_grafico(tree_h.item(sel[0], "values")[2])
+            return tree_h.item(sel[0], "values")[2] or None
+        return None
 
-    def ver_en_catalogo_h():
-        sel = tree_h.selection()
-        if sel and not tree_h.get_children(sel[0]):
-            abrir_catalogo_impresoras(seleccionar_ip=tree_h.item(sel[0], "values")[2])
+    def grafico_h():
+        ip = _ip_seleccionada()
+        if ip:
+            mostrar_grafico(ip)
 
-    def _sort_key(fila, col_idx):
-        val = fila[col_idx]
-        if col_idx == 0:
-            try:
-                return datetime.strptime(val, "%d/%m/%Y %H:%M")
-            except (ValueError, TypeError):
-                return datetime.min
-        if col_idx in (4, 5, 6):
-            try:
-                return float(val.replace("%", "").replace(",", "."))
-            except (ValueError, TypeError):
-                return -1.0
-        return val.lower()
+    def ver_en_catalogo_h():
+        ip = _ip_seleccionada()
+        if ip:
+            abrir_catalogo_impresoras(seleccionar_ip=ip)
 
     def ordenar_por_columna(col_idx):
-        nonlocal sort_col, sort_asc
+        nonlocal sort_col, sort_asc, current_page
         if modo_arbol and col_idx != 0:
             return
         if sort_col == col_idx:
@@ -1789,37 +4108,30 @@ def abrir_historial():
         else:
             sort_col = col_idx
             sort_asc = True
-        if not modo_arbol:
-            all_filas.sort(key=lambda f: _sort_key(f, col_idx), reverse=not sort_asc)
+        current_page = 0
         for i, col in enumerate(cols_hist):
             arrow = " ▲" if sort_asc else " ▼"
             tree_h.heading(col, text=col + (arrow if i == col_idx else ""))
         mostrar_pagina()
 
-    def _total_items():
-        if modo_arbol:
-            if not all_filas:
-                return 0
-            dias = {f[0].split(" ")[0] for f in all_filas}
-            return len(dias)
-        return len(all_filas)
-
     def pagina_siguiente():
         nonlocal current_page
-        paso = grupos_por_pagina if modo_arbol else page_size
-        items = _total_items()
+        paso, items = (grupos_por_pagina, total_dias) if modo_arbol else (page_size, total_filas)
         if (current_page + 1) * paso < items:
             current_page += 1
-            mostrar_pagina()
+            mostrar_pagina(limites[1])
 
     def pagina_anterior():
         nonlocal current_page
         if current_page > 0:
             current_page -= 1
-            mostrar_pagina()
+            if current_page == 0:
+                mostrar_pagina()
+            else:
+                mostrar_pagina(limites[0], atras=True)
 
     def exportar_hist():
-        if not all_filas:
+        if not total_filas:
             messagebox.showwarning("Sin datos", "No hay filas para exportar.", parent=win)
             return
         ruta = filedialog.asksaveasfilename(
@@ -1828,26 +4140,11 @@ def abrir_historial():
             parent=win)
         if not ruta:
             return
-        wb = Workbook(); ws = wb.active; ws.title = "Historial"
-        headers = list(cols_hist)
-        widths  = [17, 18, 14, 24, 11, 16, 14]
-        hdr_fill = PatternFill("solid", fgColor="CCCCCC")
-        for col, (h, w) in enumerate(zip(headers, widths), 1):
-            c = ws.cell(row=1, column=col, value=h)
-            c.fill = hdr_fill; c.font = Font(bold=True)
-            c.alignment = Alignment(horizontal="center")
-            ws.column_dimensions[c.column_letter].width = w
-        fills = {"bajo":     PatternFill("solid", fgColor="FF9999"),
-                 "medio":    PatternFill("solid", fgColor="FFFF99"),
-                 "sin_datos":PatternFill("solid", fgColor="D0D0D0")}
-        for f in all_filas:
-            ws.append(list(f[:7]))
-            tag = f[7]
-            if tag in fills:
-                for col in range(1, 8):
-                    ws.cell(row=ws.max_row, column=col).fill = fills[tag]
-        wb.save(ruta)
-        messagebox.showinfo("Exportado", f"Historial guardado:\n{ruta}", parent=win)
+        # Las filas salen de un cursor con el mismo orden que la tabla, en el hilo de exportación
+        filas = ((f[:7], f[7] or None)
+                 for f in db_historial_filas(dict(filtros), sort_col, sort_asc))
+        _exportar_excel_en_hilo(win, ruta, [_hoja_excel(
+            "Historial", list(cols_hist), [17, 18, 14, 24, 11, 16, 14], filas)])
 
     # ── Comandos ───────────────────────────────────────────────────────────
     btn_filtrar_h.config(command=filtrar_h)
@@ -1872,6 +4169,7 @@ def abrir_historial():
 
     # ── Doble clic → gráfico ──────────────────────────────────────────────
     tree_h.bind("<<TreeviewDoubleClick>>", lambda _: grafico_h())
+    tree_h.bind("<<TreeviewOpen>>", _expandir_dia)
 
     # ── Selección → habilitar botones ─────────────────────────────────────
     def _on_select_h(_=None):
@@ -1966,19 +4264,26 @@ def _dialogo_impresora(parent, titulo, valores_iniciales=None):
 
 
 def abrir_gestion_modelos(parent=None):
-    """Ventana para gestionar (agregar, renombrar, eliminar) modelos de impresoras."""
+    """Ventana para gestionar (agregar, renombrar, eliminar) modelos de impresoras
+    y elegir cómo se consulta cada uno (página de estado HTTP o SNMP)."""
     win = tk.Toplevel(parent)
     win.title("Gestionar Modelos")
-    win.geometry("420x320")
+    win.geometry("460x320")
     win.resizable(False, False)
     if parent:
         win.transient(parent)
     win.grab_set()
 
+    modelos = []
+
     def refrescar():
         lb.delete(0, "end")
-        for mid, mnombre in db_modelos_listar():
-            lb.insert("end", mnombre)
+        modelos[:] = db_modelos_consulta()
+        for mid, mnombre, backend, indices in modelos:
+            if backend == "snmp":
+                lb.insert("end", f"{mnombre}    [SNMP {indices or SNMP_INDICES_DEFAULT}]")
+            else:
+                lb.insert("end", mnombre)
 
     frame_top = tk.Frame(win)
     frame_top.pack(fill="x", padx=10, pady=(10, 4))
@@ -2008,7 +4313,7 @@ def abrir_gestion_modelos(parent=None):
         if not sel:
             messagebox.showinfo("Sin selección", "Seleccione un modelo.", parent=win)
             return
-        nombre_actual = lb.get(sel[0])
+        nombre_actual = modelos[sel[0]][1]
         nuevo = simpledialog.askstring("Renombrar Modelo",
                                        f"Nuevo nombre para '{nombre_actual}':",
                                        parent=win, initialvalue=nombre_actual)
@@ -2017,7 +4322,6 @@ def abrir_gestion_modelos(parent=None):
         nuevo = nuevo.strip()
         if not nuevo or nuevo == nombre_actual:
             return
-        modelos = db_modelos_listar()
         mid = modelos[sel[0]][0]
         try:
             db_modelo_renombrar(mid, nuevo)
@@ -2030,12 +4334,11 @@ def abrir_gestion_modelos(parent=None):
         if not sel:
             messagebox.showinfo("Sin selección", "Seleccione un modelo.", parent=win)
             return
-        nombre = lb.get(sel[0])
+        nombre = modelos[sel[0]][1]
         if not messagebox.askyesno("Confirmar",
                                    f"¿Eliminar modelo '{nombre}'?\nSolo se eliminará si ninguna impresora lo usa.",
                                    parent=win):
             return
-        modelos = db_modelos_listar()
         mid = modelos[sel[0]][0]
         try:
             db_modelo_eliminar(mid)
@@ -2043,11 +4346,78 @@ def abrir_gestion_modelos(parent=None):
         except ValueError as e:
             messagebox.showwarning("En uso", str(e), parent=win)
 
+    def configurar_consulta():
+        sel = lb.curselection()
+        if not sel:
+            messagebox.showinfo("Sin selección", "Seleccione un modelo.", parent=win)
+            return
+        mid, nombre, backend, indices = modelos[sel[0]]
+
+        dlg = tk.Toplevel(win)
+        dlg.title(f"Consulta \u2014 {nombre}")
+        dlg.resizable(False, False)
+        dlg.transient(win)
+        dlg.grab_set()
+        f = tk.Frame(dlg, padx=12, pady=10)
+        f.pack(fill="both", expand=True)
+
+        var_backend = tk.StringVar(value=backend or "http")
+        var_indices = tk.StringVar(value=indices or SNMP_INDICES_DEFAULT)
+        var_ip      = tk.StringVar()
+
+        tk.Label(f, text="Backend:").grid(row=0, column=0, sticky="w", pady=3)
+        Combobox(f, textvariable=var_backend, values=["http", "snmp"],
+                 state="readonly", width=8).grid(row=0, column=1, sticky="w", pady=3)
+        tk.Label(f, text="Índices SNMP (tóner, kit, unidad):").grid(row=1, column=0, sticky="w", pady=3)
+        tk.Entry(f, textvariable=var_indices, width=12).grid(row=1, column=1, sticky="w", pady=3)
+        tk.Label(f, text="prtMarkerSuppliesIndex de cada insumo; '-' si el modelo no lo tiene.",
+                 font=("Segoe UI", 7), fg="#888888").grid(row=2, column=0, columnspan=2, sticky="w")
+
+        tk.Label(f, text="Probar con IP:").grid(row=3, column=0, sticky="w", pady=(10, 3))
+        tk.Entry(f, textvariable=var_ip, width=16).grid(row=3, column=1, sticky="w", pady=(10, 3))
+        lbl_prueba = tk.Label(f, text="", font=("Segoe UI", 8), fg="#555555")
+        lbl_prueba.grid(row=4, column=0, columnspan=2, sticky="w")
+
+        def probar():
+            ip = var_ip.get().strip()
+            if not ip:
+                return
+            lbl_prueba.config(text="Consultando\u2026", fg="#555555")
+            cfg = cargar_config()
+            _snmp_cfg.puerto    = cfg.get("snmp_puerto", SNMP_PUERTO_DEFAULT)
+            _snmp_cfg.comunidad = cfg.get("snmp_comunidad", SNMP_COMUNIDAD_DEFAULT)
+
+            def _consultar():
+                evento = threading.Event()
+                if var_backend.get() == "snmp":
+                    res = obtener_status_snmp(ip, nombre, _parsear_indices_snmp(var_indices.get()), evento)
+                else:
+                    res = obtener_status(ip, nombre, evento)
+                texto = "  ".join(f"{et}: {v*100:.1f}%" if v is not None else f"{et}: \u2014"
+                                  for et, v in zip(("Tóner", "Kit", "Unidad"), res))
+                dlg.after(0, lambda: lbl_prueba.config(
+                    text=texto, fg="green" if any(v is not None for v in res) else "red"))
+
+            threading.Thread(target=_consultar, daemon=True).start()
+
+        def guardar():
+            db_modelo_configurar_consulta(mid, var_backend.get(), var_indices.get())
+            refrescar()
+            dlg.destroy()
+
+        fb = tk.Frame(f)
+        fb.grid(row=5, column=0, columnspan=2, pady=(10, 0), sticky="w")
+        for texto, cmd in (("Probar", probar), ("Guardar", guardar), ("Cancelar", dlg.destroy)):
+            b = tk.Button(fb, text=texto, command=cmd)
+            _estilo_btn(b, primario=(texto == "Guardar"))
+            b.pack(side="left", padx=4)
+
     btn_agregar   = tk.Button(frame_btns, text="Agregar",   command=agregar)
     btn_renombrar = tk.Button(frame_btns, text="Renombrar", command=renombrar)
     btn_eliminar  = tk.Button(frame_btns, text="Eliminar",  command=eliminar)
+    btn_consulta  = tk.Button(frame_btns, text="Consulta\u2026", command=configurar_consulta)
     btn_cerrar    = tk.Button(frame_btns, text="Cerrar",    command=win.destroy)
-    for b in (btn_agregar, btn_renombrar, btn_eliminar, btn_cerrar):
+    for b in (btn_agregar, btn_renombrar, btn_eliminar, btn_consulta, btn_cerrar):
         b.pack(side="left", padx=4)
         _estilo_btn(b, primario=False)
 
@@ -2055,8 +4425,56 @@ def abrir_gestion_modelos(parent=None):
     parent.wait_window(win)
 
 
+# Encabezados reconocidos al importar el catálogo -> campo de db_impresoras_importar()
+_ENCABEZADOS_IMPORTACION = {
+    "estado": "activa", "sucursal": "sucursal", "ubicación": "ubicacion", "ubicacion": "ubicacion",
+    "ip": "ip", "modelo": "modelo", "nombre": "nombre",
+    "n° serie": "sn", "nº serie": "sn", "serie": "sn", "sn": "sn",
+}
+# Sin encabezados reconocibles: orden de columnas de la exportación del catálogo
+_COLUMNAS_CATALOGO = ("activa", "sucursal", "ubicacion", "ip", "modelo", "nombre", "sn")
+
+
+def _texto_celda(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def _leer_catalogo_excel(archivo):
+    """Recorre la hoja activa en modo read_only y produce (numero_fila, dict) para
+    db_impresoras_importar(). Las columnas se toman de los encabezados de la primera
+    fila o, si no los tiene, del orden de la exportación del catálogo (D=IP, E=Modelo).
+    """
+    wb = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        filas = wb.active.iter_rows(values_only=True)
+        encabezado = [_texto_celda(v).lower() for v in next(filas, ())]
+        if "ip" in encabezado:
+            columnas = [_ENCABEZADOS_IMPORTACION.get(h) for h in encabezado]
+        else:
+            columnas = list(_COLUMNAS_CATALOGO)
+        for numero, valores in enumerate(filas, start=2):
+            datos = {}
+            for campo, valor in zip(columnas, valores):
+                if campo is None:
+                    continue
+                texto = _texto_celda(valor)
+                if campo == "activa":
+                    datos[campo] = {"activa": 1, "baja": 0}.get(texto.lower())
+                else:
+                    datos[campo] = texto
+            if any(datos.values()):
+                yield numero, datos
+    finally:
+        wb.close()
+
+
 def _importar_desde_excel(parent):
-    """Importa impresoras desde un Excel (columnas D=IP, E=Modelo)."""
+    """Importa o actualiza impresoras desde un Excel con las columnas de la exportación
+    del catálogo (o encabezados IP, Modelo, Sucursal, Ubicación, Nombre, N° Serie, Estado)."""
     archivo = filedialog.askopenfilename(
         parent=parent,
         filetypes=[("Archivos Excel", "*.xlsx")],
@@ -2066,32 +4484,25 @@ def _importar_desde_excel(parent):
         return
 
     try:
-        wb = load_workbook(archivo, data_only=True)
-        ws = wb.active
+        reporte = db_impresoras_importar(_leer_catalogo_excel(archivo))
+    except sqlite3.Error as e:
+        _log.error("Error al importar impresoras desde %s: %s", archivo, e)
+        messagebox.showerror("Error", f"No se pudo importar el catálogo:\n{e}", parent=parent)
+        return
     except Exception as e:
         messagebox.showerror("Error", f"No se pudo abrir el archivo:\n{e}", parent=parent)
         return
 
-    importadas = 0
-    omitidas   = 0
-    for row in ws.iter_rows(min_row=2, max_col=5, values_only=True):
-        if len(row) < 5:
-            continue
-        ip     = str(row[3]).strip() if row[3] else ""
-        modelo = str(row[4]).strip() if row[4] else ""
-        if not ip or not modelo:
-            continue
-        try:
-            db_impresora_agregar(ip, modelo, sucursal="")
-            importadas += 1
-        except sqlite3.IntegrityError:
-            omitidas += 1
-
-    messagebox.showinfo(
-        "Importación completada",
-        f"Impresoras importadas: {importadas}\nOmitidas (IP duplicada): {omitidas}",
-        parent=parent,
-    )
+    omitidas = reporte["omitidas"]
+    texto = (f"Impresoras nuevas: {reporte['insertadas']}\n"
+             f"Actualizadas: {reporte['actualizadas']}\n"
+             f"Sin cambios: {reporte['sin_cambios']}\n"
+             f"Filas omitidas: {len(omitidas)}")
+    if omitidas:
+        texto += "\n\n" + "\n".join(f"Fila {n}: {motivo}" for n, motivo in omitidas[:10])
+        if len(omitidas) > 10:
+            texto += f"\n\u2026 y {len(omitidas) - 10} más"
+    messagebox.showinfo("Importación completada", texto, parent=parent)
 
 
 def abrir_catalogo_impresoras(seleccionar_ip=None):
@@ -2108,16 +4519,17 @@ def abrir_catalogo_impresoras(seleccionar_ip=None):
     # Estado de ordenamiento
     sort_col = None
     sort_asc = True
-    # Cache de último tóner
+    # Cache de último tóner y fecha de agotamiento pronosticada
     toner_cache = {}
+    agota_cache = {}
 
     def _cargar_toner_cache():
         toner_cache.clear()
-        todas = db_impresoras_todas()
-        for imp in todas:
-            nivel = db_ultimo_toner(imp["ip"])
-            if nivel is not None:
-                toner_cache[imp["ip"]] = f"{nivel*100:.0f}%"
+        for ip, (toner, _, _) in db_ultimos_niveles().items():
+            if toner is not None:
+                toner_cache[ip] = f"{toner*100:.0f}%"
+        agota_cache.clear()
+        agota_cache.update((ip, _texto_agota(ts)) for ip, ts in db_pronosticos().items())
 
     _cargar_toner_cache()
 
@@ -2156,8 +4568,9 @@ def abrir_catalogo_impresoras(seleccionar_ip=None):
     # ------------------------------------------------------------------
     # Fila 1: Tabla
     # ------------------------------------------------------------------
-    cols_cat   = ("Estado", "Sucursal", "Ubicación", "IP", "Modelo", "Nombre", "N° Serie", "Tóner")
-    col_widths = (55, 110, 90, 110, 130, 95, 85, 55)
+    cols_cat   = ("Estado", "Sucursal", "Ubicación", "IP", "Modelo", "Nombre", "N° Serie", "Tóner",
+                  "Agota el")
+    col_widths = (55, 110, 90, 110, 130, 95, 85, 55, 80)
 
     frame_tree = tk.Frame(win)
     frame_tree.pack(fill="both", expand=True, padx=10, pady=(4, 0))
@@ -2166,7 +4579,8 @@ def abrir_catalogo_impresoras(seleccionar_ip=None):
                         height=12, selectmode="extended")
     for col, w in zip(cols_cat, col_widths):
         tree_cat.heading(col, text=col)
-        tree_cat.column(col, anchor="center" if col in ("Estado", "IP", "N° Serie", "Tóner") else "w", width=w)
+        tree_cat.column(col, anchor="center" if col in ("Estado", "IP", "N° Serie", "Tóner", "Agota el") else "w",
+                        width=w)
     tree_cat.tag_configure("baja", foreground="#999999")
     sb_cat = Scrollbar(frame_tree, orient="vertical", command=tree_cat.yview)
     tree_cat.configure(yscroll=sb_cat.set)
@@ -2236,7 +4650,7 @@ def abrir_catalogo_impresoras(seleccionar_ip=None):
             iid = tree_cat.insert("", "end", values=(
                 estado_str, imp["sucursal"], imp.get("ubicacion", "") or "",
                 imp["ip"], imp["modelo"], imp["nombre"] or "",
-                imp.get("sn", "") or "", toner_str
+                imp.get("sn", "") or "", toner_str, agota_cache.get(imp["ip"], "—")
             ), tags=tags)
             id_map[iid] = imp["id"]
             ip_to_iid[imp["ip"]] = iid
@@ -2270,11 +4684,15 @@ def abrir_catalogo_impresoras(seleccionar_ip=None):
             sort_col = col_idx
             sort_asc = True
         items = [(tree_cat.set(iid, col_idx), iid) for iid in tree_cat.get_children("")]
-        try:
-            items.sort(key=lambda x: (x[0] == "—", float(x[0].replace("%", "")) if x[0].replace("%", "").replace(".", "").isdigit() else x[0].lower()),
-                       reverse=not sort_asc)
-        except (ValueError, TypeError):
-            items.sort(key=lambda x: x[0].lower(), reverse=not sort_asc)
+        if cols_cat[col_idx] == "Agota el":
+            items.sort(key=lambda x: datetime.strptime(x[0], "%d/%m/%Y") if x[0] != "—"
+                       else datetime.max, reverse=not sort_asc)
+        else:
+            try:
+                items.sort(key=lambda x: (x[0] == "—", float(x[0].replace("%", "")) if x[0].replace("%", "").replace(".", "").isdigit() else x[0].lower()),
+                           reverse=not sort_asc)
+            except (ValueError, TypeError):
+                items.sort(key=lambda x: x[0].lower(), reverse=not sort_asc)
         for idx, (_, iid) in enumerate(items):
             tree_cat.move(iid, "", idx)
         for i, col in enumerate(cols_cat):
@@ -2386,29 +4804,19 @@ def abrir_catalogo_impresoras(seleccionar_ip=None):
             parent=win)
         if not ruta:
             return
-        wb = Workbook(); ws = wb.active; ws.title = "Catálogo"
-        headers = list(cols_cat)
-        widths  = [10, 18, 14, 15, 24, 20, 14, 8]
-        hdr_fill = PatternFill("solid", fgColor="4472C4")
-        hdr_font = Font(bold=True, color="FFFFFF")
-        align_center = Alignment(horizontal="center")
-        for col, (h, w) in enumerate(zip(headers, widths), 1):
-            c = ws.cell(row=1, column=col, value=h)
-            c.fill = hdr_fill; c.font = hdr_font
-            c.alignment = align_center
-            ws.column_dimensions[c.column_letter].width = w
-        baja_fill = PatternFill("solid", fgColor="D9D9D9")
-        for imp in db_impresoras_todas():
-            estado = "Activa" if imp["activa"] else "Baja"
-            toner_str = toner_cache.get(imp["ip"], "—")
-            ws.append([estado, imp["sucursal"], imp.get("ubicacion", "") or "",
-                       imp["ip"], imp["modelo"], imp["nombre"] or "",
-                       imp.get("sn", "") or "", toner_str])
-            if not imp["activa"]:
-                for col in range(1, len(headers) + 1):
-                    ws.cell(row=ws.max_row, column=col).fill = baja_fill
-        wb.save(ruta)
-        messagebox.showinfo("Exportado", f"Catálogo guardado:\n{ruta}", parent=win)
+        toner, agota = dict(toner_cache), dict(agota_cache)
+
+        def filas():
+            for imp in db_impresoras_todas():
+                estado = "Activa" if imp["activa"] else "Baja"
+                yield ([estado, imp["sucursal"], imp.get("ubicacion", "") or "",
+                        imp["ip"], imp["modelo"], imp["nombre"] or "",
+                        imp.get("sn", "") or "", toner.get(imp["ip"], "—"),
+                        agota.get(imp["ip"], "—")],
+                       None if imp["activa"] else "baja")
+        _exportar_excel_en_hilo(win, ruta, [_hoja_excel(
+            "Catálogo", list(cols_cat), [10, 18, 14, 15, 24, 20, 14, 8, 12], filas(),
+            "encabezado_azul")])
 
     # ── Asignar comandos ─────────────────────────────────────────────
     btn_filtrar_cat.config(command=filtrar_cat)
@@ -2461,7 +4869,7 @@ def aplicar_filtro(ctx):
     visible_idx = 0
     for fila in ctx.filas_tabla:
         sucursal, ip, modelo = fila[0], fila[1], fila[2]
-        tag                  = fila[6]
+        tag                  = fila[8]
         if texto and texto not in sucursal.lower() \
                  and texto not in ip.lower() \
                  and texto not in modelo.lower():
@@ -2470,7 +4878,7 @@ def aplicar_filtro(ctx):
             continue
         parity = "par" if visible_idx % 2 == 0 else "impar"
         tags   = (tag,) if tag else (parity,)
-        ctx.tree.insert("", "end", values=fila[:6], tags=tags)
+        ctx.tree.insert("", "end", values=fila[:8], tags=tags)
         visible_idx += 1
 
 
@@ -2484,12 +4892,18 @@ def ordenar_por_columna(ctx, col_idx):
 
     def clave(fila):
         val = fila[col_idx]
+        if col_idx == 7:
+            # Agota el: las que no tienen pronóstico, al final
+            try:
+                return datetime.strptime(val, "%d/%m/%Y")
+            except (ValueError, TypeError):
+                return datetime.max
         if isinstance(val, str) and val.endswith('%'):
             try:
                 return float(val[:-1])
             except ValueError:
                 return -1.0
-        if val == "-":
+        if val in ("-", "—"):
             return -1.0
         if col_idx == 3:
             try:
@@ -2543,19 +4957,28 @@ def _tick_auto(ctx, restantes):
 # Helpers de UI  (siempre se ejecutan en el hilo principal vía ventana.after)
 # ---------------------------------------------------------------------------
 
-def _actualizar_progreso(ctx, sucursal, ip, modelo, toner, kit, unidad, progreso, umbral_bajo, umbral_medio):
-    """Actualiza barra de progreso, etiqueta de estado e inserta la fila respetando el filtro."""
+def _actualizar_progreso(ctx, sucursal, ip, modelo, toner, kit, unidad, progreso,
+                         umbral_bajo, umbral_medio, fecha, en_espera=False):
+    """Actualiza barra de progreso, etiqueta de estado e inserta la fila respetando el filtro.
+    Con en_espera=True la impresora no se consultó (circuito abierto)."""
     ctx.resultado_label.config(text=f"Monitoreando: {ip} ({progreso}%)")
     ctx.barra_progreso.config(value=progreso)
 
     valores = [v for v in (toner, kit, unidad) if v is not None]
     tag     = clasificar_nivel(valores, umbral_bajo, umbral_medio)
+    try:
+        fecha_ult = datetime.strptime(fecha, "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y %H:%M")
+    except (ValueError, TypeError):
+        fecha_ult = str(fecha or "")
+    if en_espera:
+        fecha_ult = TEXTO_EN_ESPERA
 
     toner_str  = f"{toner*100:.1f}%"  if toner  is not None else "—"
     unidad_str = f"{unidad*100:.1f}%" if unidad is not None else "—"
     kit_str    = f"{kit*100:.1f}%"    if kit    is not None else "—"
 
-    fila = (sucursal, ip, modelo, fecha_ult, toner_str, unidad_str, kit_str, tag)
+    fila = (sucursal, ip, modelo, fecha_ult, toner_str, unidad_str, kit_str,
+            _texto_agota(ctx.pronosticos.get(ip)), tag)
     ctx.filas_tabla.append(fila)
 
     texto        = ctx.entrada_busqueda.get().strip().lower()
@@ -2564,7 +4987,15 @@ def _actualizar_progreso(ctx, sucursal, ip, modelo, toner, kit, unidad, progreso
        (not solo_alertas or tag in ("bajo", "medio", "sin_datos")):
         parity = "par" if (len(ctx.filas_tabla) - 1) % 2 == 0 else "impar"
         tags   = (tag,) if tag else (parity,)
-        ctx.tree.insert("", "end", values=fila[:6], tags=tags)
+        ctx.tree.insert("", "end", values=fila[:8], tags=tags)
+
+
+def _aplicar_pronosticos(ctx, pronosticos):
+    """Actualiza la columna Agota el con los pronósticos recalculados al final de la corrida."""
+    ctx.pronosticos = pronosticos
+    ctx.filas_tabla[:] = [f[:7] + (_texto_agota(pronosticos.get(f[1])), f[8])
+                          for f in ctx.filas_tabla]
+    aplicar_filtro(ctx)
 
 
 def _finalizar(ctx, mensaje, tipo):
@@ -2678,7 +5109,7 @@ def abrir_configuracion():
     cfg = cargar_config()
     win = tk.Toplevel()
     win.title("Configuración")
-    win.geometry("520x480")
+    win.geometry("520x620")
     win.resizable(True, True)
     win.grab_set()
 
@@ -2749,6 +5180,103 @@ def abrir_configuracion():
     _estilo_btn(btn_probar_db, primario=False)
     btn_probar_db.pack(anchor="w", pady=(2, 0))
 
+    var_archivo_dias = tk.IntVar(value=cfg.get("archivo_dias", ARCHIVO_DIAS_DEFAULT))
+    f_archivo = tk.Frame(nf_bd, bg=BG_MAIN)
+    f_archivo.pack(fill="x", pady=(10, 0))
+    tk.Label(f_archivo, text="Archivar lecturas de más de", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    Spinbox(f_archivo, from_=0, to=3650, increment=30, width=5,
+            textvariable=var_archivo_dias, font=FONT_UI).pack(side="left", padx=(6, 6))
+    tk.Label(f_archivo, text="días (0 = no archivar)", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+
+    def archivar_ahora():
+        try:
+            dias = var_archivo_dias.get()
+        except tk.TclError:
+            return
+        if dias <= 0:
+            return
+        if not messagebox.askyesno(
+                "Archivar lecturas",
+                f"¿Mover las lecturas de más de {dias} días a los archivos anuales "
+                f"({os.path.splitext(os.path.basename(DB_PATH))[0]}_AAAA.db)?\n"
+                "Siguen disponibles en el historial y los gráficos.", parent=win):
+            return
+        btn_archivar.config(state="disabled", text="Archivando\u2026")
+
+        def _correr():
+            try:
+                n = db_archivar_lecturas(dias)
+                texto, error = f"Se archivaron {n} lecturas.", False
+            except sqlite3.Error as e:
+                _log.error("Error al archivar lecturas: %s", e)
+                texto, error = f"No se pudo archivar:\n{e}", True
+
+            def _fin():
+                if not btn_archivar.winfo_exists():
+                    return
+                btn_archivar.config(state="normal", text="Archivar ahora\u2026")
+                (messagebox.showerror if error else messagebox.showinfo)(
+                    "Archivar lecturas", texto, parent=win)
+            win.after(0, _fin)
+
+        threading.Thread(target=_correr, daemon=True).start()
+
+    btn_archivar = tk.Button(f_archivo, text="Archivar ahora\u2026", command=archivar_ahora)
+    _estilo_btn(btn_archivar, primario=False)
+    btn_archivar.pack(side="left", padx=(14, 0))
+
+    var_solo_cambios = tk.BooleanVar(value=bool(cfg.get("lecturas_solo_cambios", False)))
+    var_latido_h     = tk.IntVar(value=cfg.get("lecturas_latido_seg", LECTURAS_LATIDO_DEFAULT) // 3600)
+    f_cambios = tk.Frame(nf_bd, bg=BG_MAIN)
+    f_cambios.pack(fill="x", pady=(6, 0))
+    tk.Checkbutton(f_cambios, text="Guardar solo los cambios de nivel; control cada",
+                   variable=var_solo_cambios, bg=BG_MAIN, font=FONT_UI,
+                   activebackground=BG_MAIN).pack(side="left")
+    Spinbox(f_cambios, from_=1, to=168, width=4,
+            textvariable=var_latido_h, font=FONT_UI).pack(side="left", padx=(6, 6))
+    tk.Label(f_cambios, text="h", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+
+    def compactar_historial():
+        try:
+            latido = max(1, var_latido_h.get()) * 3600
+        except tk.TclError:
+            return
+        if not messagebox.askyesno(
+                "Compactar historial",
+                "¿Borrar del historial las lecturas iguales a la anterior de la misma impresora "
+                f"tomadas dentro de las {latido // 3600} horas siguientes?\n"
+                "Los gráficos y los resúmenes no cambian; el historial muestra solo los "
+                "cambios y una lectura de control por intervalo.", parent=win):
+            return
+        btn_compactar.config(state="disabled", text="Compactando\u2026")
+
+        def _correr():
+            try:
+                n = db_compactar_lecturas(latido)
+                texto, error = f"Se borraron {n} lecturas repetidas.", False
+            except sqlite3.Error as e:
+                _log.error("Error al compactar el historial: %s", e)
+                texto, error = f"No se pudo compactar:\n{e}", True
+
+            def _fin():
+                if not btn_compactar.winfo_exists():
+                    return
+                btn_compactar.config(state="normal", text="Compactar historial\u2026")
+                (messagebox.showerror if error else messagebox.showinfo)(
+                    "Compactar historial", texto, parent=win)
+            win.after(0, _fin)
+
+        threading.Thread(target=_correr, daemon=True).start()
+
+    btn_compactar = tk.Button(f_cambios, text="Compactar historial\u2026", command=compactar_historial)
+    _estilo_btn(btn_compactar, primario=False)
+    btn_compactar.pack(side="left", padx=(14, 0))
+
+    btn_exportar_datos = tk.Button(nf_bd, text="Exportar datos (CSV / NDJSON)\u2026",
+                                   command=lambda: _ventana_exportar_tabla(win))
+    _estilo_btn(btn_exportar_datos, primario=False)
+    btn_exportar_datos.pack(anchor="w", pady=(8, 0))
+
     tk.Label(nf_bd,
              text="\u2139 Para compartir la BD entre PCs, apuntá a una carpeta de red.\n"
                   "  Ej: \\\\servidor\\share\\impresoras.db\n"
@@ -2822,7 +5350,15 @@ def abrir_configuracion():
 
     var_umbral_bajo  = tk.IntVar(value=cfg.get("umbral_bajo", 10))
     var_umbral_medio = tk.IntVar(value=cfg.get("umbral_medio", 25))
-    var_max_workers  = tk.IntVar(value=cfg.get("max_workers", 20))
+    var_concurrencia = tk.IntVar(value=cfg.get("max_concurrencia", MAX_CONCURRENCIA_DEFAULT))
+    var_timeout_min  = tk.DoubleVar(value=cfg.get("timeout_min", TIMEOUT_MIN_DEFAULT))
+    var_timeout_max  = tk.DoubleVar(value=cfg.get("timeout_max", TIMEOUT_MAX_DEFAULT))
+    var_circ_fallos  = tk.IntVar(value=cfg.get("circuito_fallos", CIRCUITO_FALLOS_DEFAULT))
+    var_circ_espera  = tk.IntVar(value=cfg.get("circuito_espera_seg", CIRCUITO_ESPERA_DEFAULT) // 60)
+    var_presondeo    = tk.BooleanVar(value=bool(cfg.get("presondeo_tcp", False)))
+    var_presondeo_to = tk.DoubleVar(value=cfg.get("presondeo_timeout", PRESONDEO_TIMEOUT_DEFAULT))
+    var_snmp_com     = tk.StringVar(value=cfg.get("snmp_comunidad", SNMP_COMUNIDAD_DEFAULT))
+    var_snmp_puerto  = tk.IntVar(value=cfg.get("snmp_puerto", SNMP_PUERTO_DEFAULT))
     var_intervalo    = tk.StringVar(value=cfg.get("intervalo_auto", "1 hora"))
 
     tk.Label(nf_mon, text="Umbrales de alerta (porcentaje de vida útil):",
@@ -2841,6 +5377,45 @@ def abrir_configuracion():
     s_medio.pack(side="left", padx=(4, 6))
     tk.Label(f_umbrales, text="%", bg=BG_MAIN, font=FONT_UI).pack(side="left")
 
+    def recalcular_niveles():
+        try:
+            bajo, medio = var_umbral_bajo.get(), var_umbral_medio.get()
+        except tk.TclError:
+            return
+        if bajo >= medio:
+            messagebox.showwarning("Umbrales inválidos",
+                                   "El nivel bajo debe ser menor que el nivel medio.", parent=win)
+            return
+        if not messagebox.askyesno(
+                "Recalcular historial",
+                f"¿Reclasificar todas las lecturas guardadas con bajo < {bajo}% y medio < {medio}%?\n"
+                "Los filtros de alerta del historial y los totales de las corridas usarán "
+                "estos umbrales en lugar de los vigentes en cada monitoreo.", parent=win):
+            return
+        btn_recalcular.config(state="disabled", text="Recalculando\u2026")
+
+        def _correr():
+            try:
+                n = db_recalcular_niveles(bajo, medio)
+                texto, error = f"Se reclasificaron {n} lecturas.", False
+            except sqlite3.Error as e:
+                _log.error("Error al recalcular niveles: %s", e)
+                texto, error = f"No se pudo recalcular:\n{e}", True
+
+            def _fin():
+                if not btn_recalcular.winfo_exists():
+                    return
+                btn_recalcular.config(state="normal", text="Recalcular historial\u2026")
+                (messagebox.showerror if error else messagebox.showinfo)(
+                    "Recalcular historial", texto, parent=win)
+            win.after(0, _fin)
+
+        threading.Thread(target=_correr, daemon=True).start()
+
+    btn_recalcular = tk.Button(f_umbrales, text="Recalcular historial\u2026", command=recalcular_niveles)
+    _estilo_btn(btn_recalcular, primario=False)
+    btn_recalcular.pack(side="left", padx=(14, 0))
+
     # Separador
     tk.Frame(nf_mon, bg="#DDDDDD", height=1, bd=0, highlightthickness=0).pack(
         fill="x", pady=(0, 10))
@@ -2849,12 +5424,61 @@ def abrir_configuracion():
 
     f_workers = tk.Frame(nf_mon, bg=BG_MAIN)
     f_workers.pack(fill="x", pady=(0, 8))
-    tk.Label(f_workers, text="Máx. hilos simultáneos:", bg=BG_MAIN, font=FONT_UI).pack(side="left")
-    s_workers = Spinbox(f_workers, from_=1, to=100, width=4, textvariable=var_max_workers, font=FONT_UI)
+    tk.Label(f_workers, text="Máx. consultas simultáneas:", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    s_workers = Spinbox(f_workers, from_=1, to=5000, width=5, textvariable=var_concurrencia, font=FONT_UI)
     s_workers.pack(side="left", padx=(6, 0))
-    tk.Label(f_workers, text="  (más hilos = más velocidad, más CPU)",
+    tk.Label(f_workers, text="  (conexiones abiertas a la vez, en un solo hilo)",
+             bg=BG_MAIN, font=("Segoe UI", 7), fg="#999999").pack(side="left")
+
+    f_timeout = tk.Frame(nf_mon, bg=BG_MAIN)
+    f_timeout.pack(fill="x", pady=(0, 8))
+    tk.Label(f_timeout, text="Timeout por impresora: mín.", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    Spinbox(f_timeout, from_=0.1, to=60, increment=0.5, width=4,
+            textvariable=var_timeout_min, font=FONT_UI).pack(side="left", padx=(6, 6))
+    tk.Label(f_timeout, text="máx.", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    Spinbox(f_timeout, from_=0.5, to=120, increment=1, width=4,
+            textvariable=var_timeout_max, font=FONT_UI).pack(side="left", padx=(6, 0))
+    tk.Label(f_timeout, text="  s (se ajusta según la latencia de cada IP)",
+             bg=BG_MAIN, font=("Segoe UI", 7), fg="#999999").pack(side="left")
+
+    f_circ = tk.Frame(nf_mon, bg=BG_MAIN)
+    f_circ.pack(fill="x", pady=(0, 8))
+    tk.Label(f_circ, text="Poner en espera tras", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    Spinbox(f_circ, from_=1, to=50, width=3,
+            textvariable=var_circ_fallos, font=FONT_UI).pack(side="left", padx=(6, 6))
+    tk.Label(f_circ, text="fallos; reintentar a los", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    Spinbox(f_circ, from_=1, to=1440, width=4,
+            textvariable=var_circ_espera, font=FONT_UI).pack(side="left", padx=(6, 0))
+    tk.Label(f_circ, text="  min (se duplica en cada fallo)",
              bg=BG_MAIN, font=("Segoe UI", 7), fg="#999999").pack(side="left")
 
+    f_presondeo = tk.Frame(nf_mon, bg=BG_MAIN)
+    f_presondeo.pack(fill="x", pady=(0, 8))
+    tk.Checkbutton(f_presondeo, text="Verificar conexión TCP antes de consultar; plazo",
+                   variable=var_presondeo, bg=BG_MAIN, font=FONT_UI,
+                   activebackground=BG_MAIN).pack(side="left")
+    Spinbox(f_presondeo, from_=0.1, to=10, increment=0.5, width=4,
+            textvariable=var_presondeo_to, font=FONT_UI).pack(side="left", padx=(6, 0))
+    tk.Label(f_presondeo, text="  s", bg=BG_MAIN, font=("Segoe UI", 7),
+             fg="#999999").pack(side="left")
+
+    f_snmp = tk.Frame(nf_mon, bg=BG_MAIN)
+    f_snmp.pack(fill="x", pady=(0, 8))
+    tk.Label(f_snmp, text="SNMP: comunidad", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    tk.Entry(f_snmp, textvariable=var_snmp_com, width=12, font=FONT_UI).pack(side="left", padx=(6, 6))
+    tk.Label(f_snmp, text="puerto", bg=BG_MAIN, font=FONT_UI).pack(side="left")
+    Spinbox(f_snmp, from_=1, to=65535, width=6,
+            textvariable=var_snmp_puerto, font=FONT_UI).pack(side="left", padx=(6, 0))
+    tk.Label(f_snmp, text="  (modelos con backend SNMP)",
+             bg=BG_MAIN, font=("Segoe UI", 7), fg="#999999").pack(side="left")
+
+    st_pool = _pool.estadisticas()
+    tk.Label(nf_mon,
+             text=f"Conexiones HTTP: {st_pool['nuevas']} nuevas, "
+                  f"{st_pool['reutilizadas']} reutilizadas ({st_pool['tasa_reuso']:.0%}), "
+                  f"{st_pool['en_reposo']} en reposo",
+             bg=BG_MAIN, font=("Segoe UI", 7), fg="#999999").pack(anchor="w", pady=(0, 8))
+
     # Separador
     tk.Frame(nf_mon, bg="#DDDDDD", height=1, bd=0, highlightthickness=0).pack(
         fill="x", pady=(0, 10))
@@ -2882,8 +5506,37 @@ def abrir_configuracion():
             puerto = int(var_puerto.get().strip() or 587)
         except ValueError:
             puerto = 587
+        try:
+            t_min = max(0.1, float(var_timeout_min.get()))
+            t_max = max(t_min, float(var_timeout_max.get()))
+        except (tk.TclError, ValueError):
+            t_min, t_max = TIMEOUT_MIN_DEFAULT, TIMEOUT_MAX_DEFAULT
+        try:
+            c_fallos = max(1, var_circ_fallos.get())
+            c_espera = max(1, var_circ_espera.get()) * 60
+        except tk.TclError:
+            c_fallos, c_espera = CIRCUITO_FALLOS_DEFAULT, CIRCUITO_ESPERA_DEFAULT
+        try:
+            p_timeout = max(0.1, float(var_presondeo_to.get()))
+        except (tk.TclError, ValueError):
+            p_timeout = PRESONDEO_TIMEOUT_DEFAULT
+        try:
+            snmp_puerto = var_snmp_puerto.get()
+        except tk.TclError:
+            snmp_puerto = SNMP_PUERTO_DEFAULT
+        try:
+            archivo_dias = max(0, var_archivo_dias.get())
+        except tk.TclError:
+            archivo_dias = ARCHIVO_DIAS_DEFAULT
+        try:
+            latido = max(1, var_latido_h.get()) * 3600
+        except tk.TclError:
+            latido = LECTURAS_LATIDO_DEFAULT
         guardar_config(
             db_path             = nueva_ruta if nueva_ruta != _DB_PATH_DEFAULT else "",
+            archivo_dias        = archivo_dias,
+            lecturas_solo_cambios = var_solo_cambios.get(),
+            lecturas_latido_seg = latido,
             email_habilitado    = var_hab.get(),
             email_remitente     = var_remitente.get().strip(),
             email_password      = var_password.get(),
@@ -2892,7 +5545,15 @@ def abrir_configuracion():
             email_puerto        = puerto,
             umbral_bajo         = var_umbral_bajo.get(),
             umbral_medio        = var_umbral_medio.get(),
-            max_workers         = var_max_workers.get(),
+            max_concurrencia    = var_concurrencia.get(),
+            timeout_min         = t_min,
+            timeout_max         = t_max,
+            circuito_fallos     = c_fallos,
+            circuito_espera_seg = c_espera,
+            presondeo_tcp       = var_presondeo.get(),
+            presondeo_timeout   = p_timeout,
+            snmp_comunidad      = var_snmp_com.get().strip() or SNMP_COMUNIDAD_DEFAULT,
+            snmp_puerto         = snmp_puerto,
             intervalo_auto      = var_intervalo.get(),
         )
         _inicializar_db_path()
@@ -2959,6 +5620,130 @@ def abrir_configuracion():
 # ---------------------------------------------------------------------------
 # Exportar a Excel
 # ---------------------------------------------------------------------------
+# Todas las exportaciones pasan por _escribir_excel: libro en modo write_only (cada
+# fila se vuelca al archivo al agregarla, así que la memoria no depende de la
+# cantidad de filas) y estilos con nombre registrados una vez por libro.
+
+# nombre -> (relleno, negrita, color de letra, centrado)
+_ESTILOS_EXCEL = {
+    "encabezado":      ("CCCCCC", True,  None,     True),
+    "encabezado_azul": ("4472C4", True,  "FFFFFF", True),
+    "bajo":            ("FF9999", False, None,     False),
+    "medio":           ("FFFF99", False, None,     False),
+    "sin_datos":       ("D0D0D0", False, None,     False),
+    "baja":            ("D9D9D9", False, None,     False),
+    "stock_critico":   ("FFCDD2", False, None,     False),
+    "stock_bajo":      ("FFF9C4", False, None,     False),
+    "mov_entrada":     ("C8E6C9", False, None,     False),
+    "mov_salida":      ("FFCDD2", False, None,     False),
+    "mov_ajuste":      ("BBDEFB", False, None,     False),
+    "total":           ("E3F2FD", True,  None,     False),
+}
+EXPORTAR_PROGRESO_FILAS = 1000   # filas entre avisos de progreso
+
+
+def _hoja_excel(titulo, encabezados, anchos, filas, estilo_encabezado="encabezado"):
+    """Describe una hoja para _escribir_excel. filas: iterable (puede ser un generador
+    que lee de la DB) de (valores, estilo), donde estilo es el nombre de un estilo de
+    _ESTILOS_EXCEL para toda la fila, una lista con uno por celda (None = sin estilo)
+    o None."""
+    return SimpleNamespace(titulo=titulo, encabezados=encabezados, anchos=anchos,
+                           filas=filas, estilo_encabezado=estilo_encabezado)
+
+
+def _escribir_excel(ruta, hojas, progreso=None, cancelar=None):
+    """Escribe las hojas en `ruta`. Llama a progreso(filas_escritas) cada
+    EXPORTAR_PROGRESO_FILAS filas. Retorna la cantidad de filas escritas, o None si
+    `cancelar` (threading.Event) se activó; el archivo solo se escribe al final."""
+    wb = Workbook(write_only=True)
+    for nombre, (relleno, negrita, color, centrado) in _ESTILOS_EXCEL.items():
+        wb.add_named_style(NamedStyle(
+            name=nombre, fill=PatternFill("solid", fgColor=relleno),
+            font=Font(bold=negrita, color=color),
+            alignment=Alignment(horizontal="center" if centrado else None)))
+
+    def celdas(ws, valores, estilo):
+        if estilo is None:
+            return list(valores)
+        estilos = [estilo] * len(valores) if isinstance(estilo, str) else estilo
+        fila = []
+        for valor, est in zip(valores, estilos):
+            if est is None:
+                fila.append(valor)
+            else:
+                celda = WriteOnlyCell(ws, value=valor)
+                celda.style = est
+                fila.append(celda)
+        return fila
+
+    escritas = 0
+    for hoja in hojas:
+        ws = wb.create_sheet(hoja.titulo)
+        for i, ancho in enumerate(hoja.anchos, 1):
+            ws.column_dimensions[get_column_letter(i)].width = ancho
+        ws.append(celdas(ws, hoja.encabezados, hoja.estilo_encabezado))
+        try:
+            for valores, estilo in hoja.filas:
+                if cancelar is not None and cancelar.is_set():
+                    for abierta in wb.worksheets:
+                        abierta.close()
+                    return None
+                ws.append(celdas(ws, valores, estilo))
+                escritas += 1
+                if progreso and escritas % EXPORTAR_PROGRESO_FILAS == 0:
+                    progreso(escritas)
+        finally:
+            if hasattr(hoja.filas, "close"):
+                hoja.filas.close()
+    wb.save(ruta)
+    return escritas
+
+
+def _exportar_excel_en_hilo(parent, ruta, hojas, titulo="Exportado"):
+    """Ejecuta _escribir_excel en un hilo con una ventana de progreso y botón Cancelar.
+    Las filas de las hojas se leen en ese hilo: no deben tocar widgets de Tk."""
+    _exportar_en_hilo(parent, ruta,
+                      lambda progreso, cancelar: _escribir_excel(ruta, hojas, progreso, cancelar),
+                      titulo)
+
+
+def _exportar_en_hilo(parent, ruta, tarea, titulo="Exportado"):
+    """Ejecuta tarea(progreso, cancelar) en un hilo con una ventana de progreso y botón
+    Cancelar. tarea retorna la cantidad de filas escritas en `ruta`, o None si se canceló."""
+    dlg = tk.Toplevel(parent)
+    dlg.title("Exportando")
+    dlg.resizable(False, False)
+    dlg.transient(parent)
+    lbl = tk.Label(dlg, text="Exportando\u2026", font=FONT_UI, width=34, anchor="w")
+    lbl.pack(padx=14, pady=(12, 6))
+    cancelar = threading.Event()
+    btn = tk.Button(dlg, text="Cancelar", command=cancelar.set)
+    _estilo_btn(btn, primario=False)
+    btn.pack(pady=(0, 12))
+    dlg.protocol("WM_DELETE_WINDOW", cancelar.set)
+
+    def _progreso(n):
+        dlg.after(0, lambda: dlg.winfo_exists() and lbl.config(text=f"Exportando\u2026 {n:,} filas"))
+
+    def _correr():
+        try:
+            n, error = tarea(_progreso, cancelar), None
+        except Exception as e:
+            _log.error("Error al exportar %s: %s", ruta, e)
+            n, error = None, e
+
+        def _fin():
+            if dlg.winfo_exists():
+                dlg.destroy()
+            if error is not None:
+                messagebox.showerror("Error al guardar", str(error), parent=parent)
+            elif n is not None:
+                messagebox.showinfo(titulo, f"Archivo guardado ({n:,} filas):\n{ruta}",
+                                    parent=parent)
+        parent.after(0, _fin)
+
+    threading.Thread(target=_correr, name="exportar", daemon=True).start()
+
 
 def exportar_excel(ctx):
     """Exporta la tabla actual (ctx.filas_tabla) a un .xlsx con 2 hojas."""
@@ -2977,58 +5762,22 @@ def exportar_excel(ctx):
     if not ruta:
         return
 
-    wb = Workbook()
-
-    # ── Hoja 1: detalle del monitoreo ─────────────────────────────────────
-    ws = wb.active
-    ws.title = "Monitoreo"
-
-    fill_header    = PatternFill("solid", fgColor="CCCCCC")
-    fill_bajo      = PatternFill("solid", fgColor="FF9999")
-    fill_medio     = PatternFill("solid", fgColor="FFFF99")
-    fill_sin_datos = PatternFill("solid", fgColor="D0D0D0")
-    font_bold      = Font(bold=True)
-    align_center   = Alignment(horizontal="center")
-
+    filas = list(ctx.filas_tabla)
     nivel_texto = {"bajo": "Bajo", "medio": "Medio", "sin_datos": "Sin datos", "": "OK"}
-    nivel_fill  = {"bajo": fill_bajo, "medio": fill_medio,
-                   "sin_datos": fill_sin_datos, "": None}
-
-    cabeceras = ["Sucursal", "IP", "Modelo",
-                 "Tóner (%)", "Unidad Imagen (%)", "Kit Mantenimiento (%)", "Nivel"]
-    ws.append(cabeceras)
-    for cell in ws[1]:
-        cell.font      = font_bold
-        cell.fill      = fill_header
-        cell.alignment = align_center
 
-    for fila in ctx.filas_tabla:
-        tag  = fila[7]
-        row  = list(fila[:7]) + [nivel_texto.get(tag, tag)]
-        ws.append(row)
-        fill = nivel_fill.get(tag)
-        if fill:
-            for cell in ws[ws.max_row]:
-                cell.fill = fill
-
-    # Ajustar anchos
-    anchos = [16, 14, 22, 12, 18, 20, 10]
-    for i, ancho in enumerate(anchos, 1):
-        ws.column_dimensions[ws.cell(1, i).column_letter].width = ancho
+    # ── Hoja 1: detalle del monitoreo ─────────────────────────────────────
+    detalle = _hoja_excel(
+        "Monitoreo",
+        ["Sucursal", "IP", "Modelo", "Fecha",
+         "Tóner (%)", "Unidad Imagen (%)", "Kit Mantenimiento (%)", "Agota el", "Nivel"],
+        [16, 14, 22, 16, 12, 18, 20, 12, 10],
+        ((list(f[:8]) + [nivel_texto.get(f[8], f[8])], f[8] or None) for f in filas))
 
     # ── Hoja 2: resumen por sucursal ──────────────────────────────────────
-    ws2 = wb.create_sheet("Por Sucursal")
-    cab2 = ["Sucursal", "Total", "OK", "Nivel medio", "Nivel bajo", "Sin datos"]
-    ws2.append(cab2)
-    for cell in ws2[1]:
-        cell.font      = font_bold
-        cell.fill      = fill_header
-        cell.alignment = align_center
-
     conteo = {}
-    for fila in ctx.filas_tabla:
+    for fila in filas:
         suc = fila[0] or "(sin sucursal)"
-        tag = fila[6]
+        tag = fila[8]
         if suc not in conteo:
             conteo[suc] = {"total": 0, "": 0, "medio": 0, "bajo": 0, "sin_datos": 0}
         conteo[suc]["total"] += 1
@@ -3037,22 +5786,212 @@ def exportar_excel(ctx):
     # Ordenar: mayor nivel bajo primero, luego nivel medio
     filas_suc = sorted(conteo.items(),
                        key=lambda x: (-x[1]["bajo"], -x[1]["medio"]))
-    for suc, c in filas_suc:
-        row2 = [suc, c["total"], c[""], c["medio"], c["bajo"], c["sin_datos"]]
-        ws2.append(row2)
-        r = ws2.max_row
-        if c["bajo"]      > 0: ws2.cell(r, 5).fill = fill_bajo
-        if c["medio"]     > 0: ws2.cell(r, 4).fill = fill_medio
-        if c["sin_datos"] > 0: ws2.cell(r, 6).fill = fill_sin_datos
+    resumen = _hoja_excel(
+        "Por Sucursal",
+        ["Sucursal", "Total", "OK", "Nivel medio", "Nivel bajo", "Sin datos"],
+        [20, 8, 8, 12, 12, 12],
+        (([suc, c["total"], c[""], c["medio"], c["bajo"], c["sin_datos"]],
+          [None, None, None,
+           "medio" if c["medio"] else None, "bajo" if c["bajo"] else None,
+           "sin_datos" if c["sin_datos"] else None])
+         for suc, c in filas_suc))
 
-    for i, ancho in enumerate([20, 8, 8, 12, 12, 12], 1):
-        ws2.column_dimensions[ws2.cell(1, i).column_letter].width = ancho
+    _exportar_excel_en_hilo(ctx.ventana, ruta, [detalle, resumen])
 
+
+# ---------------------------------------------------------------------------
+# Exportar a CSV / NDJSON
+# ---------------------------------------------------------------------------
+# Para BI y scripts: las filas se escriben a medida que salen del cursor de la DB, así
+# que el tiempo y la memoria no dependen del tamaño de la tabla. También se puede
+# ejecutar sin interfaz: python impresoras.py exportar --help
+
+FORMATOS_EXPORTACION = ("csv", "ndjson")
+CURSOR_EXPORTACION_DEFAULT = "bi"   # consumidor de las exportaciones incrementales
+
+
+def exportar_tabla(tabla, formato, ruta, desde=None, hasta=None, cursor=None,
+                   progreso=None, cancelar=None):
+    """Escribe las filas de db_exportacion_filas() en `ruta` como CSV (con encabezado)
+    o NDJSON (un objeto JSON por línea). ruta '-' escribe en la salida estándar.
+
+    cursor: nombre del consumidor para exportar solo las filas nuevas desde su
+    exportación anterior; el cursor avanza recién cuando el archivo quedó completo.
+    No se combina con desde/hasta: la fecha de envíos y movimientos la carga el
+    usuario y no sigue el orden del id, así que el cursor saltaría filas fuera del
+    rango que todavía no se exportaron (ValueError).
+    El archivo se escribe en ruta.tmp y se renombra al final. Retorna la cantidad de
+    filas, o None si `cancelar` (threading.Event) se activó.
+    """
+    if cursor and (desde or hasta):
+        raise ValueError("La exportación incremental no admite rango de fechas.")
+    columnas = _EXPORTACIONES[tabla][0]
+    despues_de = db_cursor_exportacion(tabla, cursor) if cursor else None
+    temporal = None if ruta == "-" else ruta + ".tmp"
+    salida = sys.stdout if temporal is None else open(temporal, "w", encoding="utf-8", newline="")
+    n, ultimo_id, completo = 0, None, False
     try:
-        wb.save(ruta)
-        messagebox.showinfo("Exportado", f"Archivo guardado:\n{ruta}", parent=ctx.ventana)
-    except Exception as e:
-        messagebox.showerror("Error al guardar", str(e), parent=ctx.ventana)
+        if formato == "csv":
+            escritor = csv.writer(salida)
+            escritor.writerow(columnas)
+            escribir = escritor.writerow
+        else:
+            def escribir(fila):
+                salida.write(json.dumps(dict(zip(columnas, fila)), ensure_ascii=False) + "\n")
+        filas = db_exportacion_filas(tabla, desde, hasta, despues_de)
+        try:
+            for fila in filas:
+                if cancelar is not None and cancelar.is_set():
+                    return None
+                escribir(fila)
+                ultimo_id = fila[0]
+                n += 1
+                if progreso and n % EXPORTAR_PROGRESO_FILAS == 0:
+                    progreso(n)
+        finally:
+            filas.close()
+        completo = True
+    finally:
+        if temporal is not None:
+            salida.close()
+            if not completo:
+                os.remove(temporal)
+    if temporal is not None:
+        os.replace(temporal, ruta)
+    else:
+        salida.flush()
+    if cursor and ultimo_id is not None:
+        db_guardar_cursor_exportacion(tabla, cursor, ultimo_id)
+    return n
+
+
+def _ventana_exportar_tabla(parent):
+    """Diálogo para exportar monitoreos, envíos o movimientos de stock a CSV o NDJSON,
+    por rango de fechas y/o solo lo nuevo desde la exportación anterior."""
+    dlg = tk.Toplevel(parent)
+    dlg.title("Exportar datos")
+    dlg.resizable(False, False)
+    dlg.transient(parent)
+
+    var_tabla   = tk.StringVar(value="monitoreos")
+    var_formato = tk.StringVar(value="csv")
+    var_desde   = tk.StringVar()
+    var_hasta   = tk.StringVar()
+    var_nuevo   = tk.BooleanVar(value=False)
+    var_cursor  = tk.StringVar(value=CURSOR_EXPORTACION_DEFAULT)
+
+    tk.Label(dlg, text="Tabla:", anchor="e", width=12).grid(row=0, column=0, padx=10, pady=4, sticky="e")
+    Combobox(dlg, textvariable=var_tabla, values=list(_EXPORTACIONES), state="readonly",
+             width=20).grid(row=0, column=1, padx=(0, 10), sticky="w")
+    tk.Label(dlg, text="Formato:", anchor="e", width=12).grid(row=1, column=0, padx=10, pady=4, sticky="e")
+    Combobox(dlg, textvariable=var_formato, values=list(FORMATOS_EXPORTACION), state="readonly",
+             width=20).grid(row=1, column=1, padx=(0, 10), sticky="w")
+    tk.Label(dlg, text="Desde:", anchor="e", width=12).grid(row=2, column=0, padx=10, pady=4, sticky="e")
+    tk.Entry(dlg, textvariable=var_desde, width=12).grid(row=2, column=1, padx=(0, 10), sticky="w")
+    tk.Label(dlg, text="Hasta:", anchor="e", width=12).grid(row=3, column=0, padx=10, pady=4, sticky="e")
+    tk.Entry(dlg, textvariable=var_hasta, width=12).grid(row=3, column=1, padx=(0, 10), sticky="w")
+    tk.Label(dlg, text="Fechas dd/mm/aaaa; vacío = sin límite.", font=("Segoe UI", 7),
+             fg="#888888").grid(row=4, column=0, columnspan=2, padx=10, sticky="w")
+    tk.Checkbutton(dlg, text="Solo lo nuevo desde la última exportación de",
+                   variable=var_nuevo).grid(row=5, column=0, columnspan=2, padx=10, pady=(8, 0), sticky="w")
+    tk.Entry(dlg, textvariable=var_cursor, width=12).grid(row=6, column=1, padx=(0, 10), sticky="w")
+    lbl_cursor = tk.Label(dlg, text="", font=("Segoe UI", 7), fg="#888888")
+    lbl_cursor.grid(row=7, column=0, columnspan=2, padx=10, sticky="w")
+
+    def _mostrar_cursor(*_):
+        nombre = var_cursor.get().strip()
+        ultimo = db_cursor_exportacion(var_tabla.get(), nombre) if nombre else None
+        lbl_cursor.config(text="Sin exportaciones anteriores." if ultimo is None
+                          else f"Última exportación hasta el id {ultimo}.")
+
+    var_tabla.trace_add("write", _mostrar_cursor)
+    var_cursor.trace_add("write", _mostrar_cursor)
+    _mostrar_cursor()
+
+    def exportar():
+        fechas = []
+        for var in (var_desde, var_hasta):
+            texto = var.get().strip()
+            try:
+                fechas.append(datetime.strptime(texto, "%d/%m/%Y").strftime("%Y-%m-%d")
+                              if texto else None)
+            except ValueError:
+                messagebox.showwarning("Fecha inválida", f"Fecha inválida: {texto}\n"
+                                       "Use el formato dd/mm/aaaa.", parent=dlg)
+                return
+        cursor = var_cursor.get().strip() if var_nuevo.get() else None
+        if var_nuevo.get() and not cursor:
+            messagebox.showwarning("Campo requerido", "Indique el nombre de la exportación.",
+                                   parent=dlg)
+            return
+        if cursor and any(fechas):
+            messagebox.showwarning("Exportación incremental",
+                                   "Solo lo nuevo no se puede combinar con un rango de fechas:\n"
+                                   "deje Desde y Hasta vacíos.", parent=dlg)
+            return
+        tabla, formato = var_tabla.get(), var_formato.get()
+        ruta = filedialog.asksaveasfilename(
+            defaultextension=f".{formato}",
+            filetypes=[(formato.upper(), f"*.{formato}"), ("Todos", "*.*")],
+            initialfile=f"{tabla}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{formato}",
+            title="Guardar exportación", parent=dlg)
+        if not ruta:
+            return
+        dlg.destroy()
+        _exportar_en_hilo(parent, ruta, lambda progreso, cancelar: exportar_tabla(
+            tabla, formato, ruta, *fechas, cursor, progreso, cancelar))
+
+    frame_btns = tk.Frame(dlg)
+    frame_btns.grid(row=8, column=0, columnspan=2, pady=10)
+    tk.Button(frame_btns, text="Exportar\u2026", width=10, command=exportar).pack(side="left", padx=6)
+    tk.Button(frame_btns, text="Cerrar", width=10, command=dlg.destroy).pack(side="left", padx=6)
+
+
+def _fecha_argumento(texto):
+    """Tipo de argparse para fechas YYYY-MM-DD."""
+    try:
+        return datetime.strptime(texto, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"fecha inválida: {texto} (use AAAA-MM-DD)")
+
+
+def main_consola(argv):
+    """Comandos sin interfaz gráfica. Retorna el código de salida."""
+    ap  = argparse.ArgumentParser(prog="impresoras.py",
+                                  description="Monitor de Impresoras sin interfaz gráfica")
+    ap.add_argument("--db", help="Base de datos a usar (por defecto, la de config.json)")
+    sub = ap.add_subparsers(dest="comando", required=True)
+
+    p_exp = sub.add_parser("exportar", help="Exportar una tabla a CSV o NDJSON")
+    p_exp.add_argument("tabla", choices=list(_EXPORTACIONES))
+    p_exp.add_argument("-f", "--formato", choices=FORMATOS_EXPORTACION, default="csv")
+    p_exp.add_argument("-o", "--salida", default="-",
+                       help="Archivo de salida ('-' = salida estándar)")
+    p_exp.add_argument("--desde", type=_fecha_argumento, help="Fecha inicial AAAA-MM-DD")
+    p_exp.add_argument("--hasta", type=_fecha_argumento, help="Fecha final AAAA-MM-DD (inclusive)")
+    p_exp.add_argument("--incremental", action="store_true",
+                       help="Solo las filas nuevas desde la exportación anterior")
+    p_exp.add_argument("--cursor", default=CURSOR_EXPORTACION_DEFAULT,
+                       help="Nombre de la exportación incremental (un cursor por consumidor)")
+
+    args = ap.parse_args(argv)
+    if args.incremental and (args.desde or args.hasta):
+        p_exp.error("--incremental no se puede combinar con --desde/--hasta")
+    global DB_PATH
+    if args.db:
+        DB_PATH = os.path.abspath(args.db)
+    init_db()
+    t0 = time.perf_counter()
+    try:
+        n = exportar_tabla(args.tabla, args.formato, args.salida, args.desde, args.hasta,
+                           args.cursor if args.incremental else None)
+    except (sqlite3.Error, OSError) as e:
+        _log.error("Error al exportar %s: %s", args.tabla, e)
+        print(f"Error al exportar {args.tabla}: {e}", file=sys.stderr)
+        return 1
+    print(f"{n} filas de {args.tabla} exportadas en {time.perf_counter() - t0:.1f} s",
+          file=sys.stderr)
+    return 0
 
 
 # ---------------------------------------------------------------------------
@@ -3061,42 +6000,24 @@ def exportar_excel(ctx):
 
 def mostrar_grafico(ip):
     """Abre una ventana Toplevel con gráfico embebido en tkinter y controles interactivos."""
-    # ── Carga de datos ──────────────────────────────────────────────────────
+    # ── Verificar que haya historial ─────────────────────────────────────────
+    # Los datos se leen por rango en _dibujar (lecturas crudas o resúmenes)
     with db_connect() as conn:
-        rows = conn.execute(
-            "SELECT fecha, toner, unidad_imagen, kit_mantenimiento "
-            "FROM monitoreos WHERE ip=? ORDER BY fecha",
-            (ip,),
-        ).fetchall()
-
-    if not rows:
+        hay = conn.execute("""
+            SELECT 1 FROM resumen_semanal r
+            JOIN impresoras i ON i.id = r.impresora_id
+            WHERE i.ip=? LIMIT 1
+        """, (ip,)).fetchone()
+        imp = conn.execute("SELECT modelo, sucursal FROM impresoras WHERE ip=?", (ip,)).fetchone()
+
+    if not hay:
         messagebox.showinfo("Sin datos", f"No hay historial para la IP {ip}.")
         return
 
-    all_fechas, all_toner, all_unidad, all_kit = [], [], [], []
-    for r in rows:
-        try:
-            fecha_dt = datetime.strptime(r[0], "%Y-%m-%d %H:%M:%S")
-        except (ValueError, TypeError):
-            continue
-        all_fechas.append(fecha_dt)
-        all_toner.append(r[1] * 100 if r[1] is not None else float('nan'))
-        all_unidad.append(r[2] * 100 if r[2] is not None else float('nan'))
-        all_kit.append(r[3]   * 100 if r[3] is not None else float('nan'))
-
-    if not all_fechas:
-        messagebox.showinfo("Sin datos", f"No hay historial válido para la IP {ip}.")
-        return
-
-    # Título: obtener modelo/sucursal del catálogo
+    # Título: modelo/sucursal del catálogo
     titulo = ip
-    todas = db_impresoras_todas()
-    for imp in todas:
-        if imp["ip"] == ip:
-            modelo   = imp["modelo"]   or ""
-            sucursal = imp["sucursal"] or ""
-            titulo   = f"{ip} — {modelo} | {sucursal}" if modelo else ip
-            break
+    if imp and imp["modelo"]:
+        titulo = f"{ip} — {imp['modelo']} | {imp['sucursal'] or ''}"
 
     # ── Ventana Toplevel ─────────────────────────────────────────────────────
     win = tk.Toplevel()
@@ -3123,16 +6044,20 @@ def mostrar_grafico(ip):
     lbl_pred = tk.Label(win, text="", bg=BG_MAIN, font=("Segoe UI", 8),
                         fg="#555555", anchor="w")
 
+    cache = {}
+    cfg = cargar_config()
+    umbrales = [cfg.get("umbral_bajo", 10), cfg.get("umbral_medio", 25)]
+
     def _dibujar(desde_dt=None, hasta_dt=None):
         ax.clear()
 
-        pares = list(zip(all_fechas, all_toner, all_unidad, all_kit))
-        if desde_dt:
-            pares = [(f, t, u, k) for f, t, u, k in pares if f >= desde_dt]
-        if hasta_dt:
-            pares = [(f, t, u, k) for f, t, u, k in pares if f <= hasta_dt]
+        # Los checkboxes redibujan el mismo rango: reutilizar la última consulta
+        if cache.get("rango") != (desde_dt, hasta_dt):
+            cache["rango"] = (desde_dt, hasta_dt)
+            cache["datos"] = db_serie_impresora(ip, desde_dt, hasta_dt)
+        resolucion, fechas, series = cache["datos"]
 
-        if not pares:
+        if not fechas:
             ax.text(0.5, 0.5, "Sin datos en el rango seleccionado",
                     ha="center", va="center", transform=ax.transAxes,
                     fontsize=11, color="#888888")
@@ -3140,32 +6065,39 @@ def mostrar_grafico(ip):
             lbl_pred.config(text="")
             return
 
-        fechas, toner_v, unidad_v, kit_v = zip(*pares)
-
         # Estilo área
         ax.set_facecolor("#FAFAFA")
         ax.grid(True, alpha=0.25, linestyle="--", color="#AAAAAA")
         ax.spines[["top", "right"]].set_visible(False)
         ax.spines[["left", "bottom"]].set_color("#CCCCCC")
-        ax.set_title(titulo, fontsize=10, color="#333333", pad=8)
+        if resolucion == "lecturas":
+            ax.set_title(titulo, fontsize=10, color="#333333", pad=8)
+        else:
+            ax.set_title(f"{titulo}  (resumen {resolucion}: último valor y rango mín.–máx.)",
+                         fontsize=10, color="#333333", pad=8)
 
         mostrar_labels = len(fechas) <= 20
 
         series_def = [
-            ("Tóner",         toner_v,   "#2196F3", var_toner),
-            ("Unidad Imagen", unidad_v,  "#FF9800", var_unidad),
-            ("Kit Mant.",     kit_v,     "#4CAF50", var_kit),
+            ("Tóner",         "toner",  "#2196F3", var_toner),
+            ("Unidad Imagen", "unidad", "#FF9800", var_unidad),
+            ("Kit Mant.",     "kit",    "#4CAF50", var_kit),
         ]
         pred_textos = []
-        for label, vals, color, var in series_def:
+        for label, consumible, color, var in series_def:
             if not var.get():
                 continue
-            vals_list = list(vals)
+            vals_list, minimos, maximos = series[consumible]
             if not any(v == v for v in vals_list):
                 continue
 
-            ax.plot(fechas, vals_list, marker='o', markersize=5,
-                    linewidth=2, label=label, color=color, zorder=3)
+            # Lecturas crudas en escalera: cada valor vale hasta la lectura siguiente
+            ax.plot(fechas, vals_list, marker='o' if len(fechas) <= 200 else None,
+                    markersize=5, linewidth=2, label=label, color=color, zorder=3,
+                    drawstyle="steps-post" if resolucion == "lecturas" else "default")
+            if minimos is not None:
+                ax.fill_between(fechas, minimos, maximos, color=color, alpha=0.15,
+                                linewidth=0, zorder=2)
 
             if mostrar_labels:
                 for f, v in zip(fechas, vals_list):
@@ -3175,7 +6107,7 @@ def mostrar_grafico(ip):
                                     ha="center", fontsize=7, color=color,
                                     fontweight="bold")
 
-            fecha_pred = predecir_agotamiento(list(fechas), vals_list)
+            fecha_pred = predecir_agotamiento(fechas, vals_list)
             if fecha_pred:
                 ax.axvline(x=fecha_pred, color=color, linestyle=":", alpha=0.7,
                            linewidth=1.5,
@@ -3185,9 +6117,7 @@ def mostrar_grafico(ip):
                 pred_textos.append(f"{label}: —")
 
         # Umbrales
-        cfg = cargar_config()
-        ubajo  = cfg.get("umbral_bajo",  10)
-        umedio = cfg.get("umbral_medio", 25)
+        ubajo, umedio = umbrales
         ax.axhline(y=ubajo,  color="#E53935", linestyle="--", alpha=0.4,
                    linewidth=1, label=f"Umbral bajo ({ubajo}%)")
         ax.axhline(y=umedio, color="#FB8C00", linestyle="--", alpha=0.4,
@@ -3302,8 +6232,23 @@ def mostrar_grafico(ip):
     # ── Row 4: Panel de predicciones ─────────────────────────────────────────
     lbl_pred.grid(row=4, column=0, sticky="ew", padx=12, pady=(2, 8))
 
+    # ── Umbrales: se actualizan al guardarlos, sin releer config.json ──────────
+    def _umbrales_cambiados(cambios):
+        if "umbral_bajo" not in cambios and "umbral_medio" not in cambios:
+            return
+        nuevos = [cambios.get("umbral_bajo", umbrales[0]) or 10,
+                  cambios.get("umbral_medio", umbrales[1]) or 25]
+
+        def _aplicar_umbrales():
+            if win.winfo_exists():
+                umbrales[:] = nuevos
+                _redibujar()
+        win.after(0, _aplicar_umbrales)
+
+    desuscribir = _config.suscribir(_umbrales_cambiados)
+
     # ── Cierre seguro ─────────────────────────────────────────────────────────
-    win.protocol("WM_DELETE_WINDOW", lambda: (plt.close(fig), win.destroy()))
+    win.protocol("WM_DELETE_WINDOW", lambda: (desuscribir(), plt.close(fig), win.destroy()))
 
     # ── Rango predeterminado: últimos 30 días ─────────────────────────────────
     _hoy   = datetime.now()
@@ -3318,8 +6263,136 @@ def mostrar_grafico(ip):
 # Orquestador principal  (corre en hilo secundario)
 # ---------------------------------------------------------------------------
 
+LOTE_FILAS_DEFAULT    = 50    # lecturas por transacción al guardar una corrida
+LOTE_SEGUNDOS_DEFAULT = 2     # tiempo máximo que una lectura espera para guardarse
+LECTURAS_LATIDO_DEFAULT = 43200  # guardado solo de cambios: fila de control cada 12 horas
+
+# Suma a los resúmenes una lectura omitida (impresora_id, ts, toner, unidad, kit): el
+# trigger lecturas_resumen solo ve las filas insertadas en lecturas
+_SQL_RESUMEN_OMITIDA = [
+    _sql_acumular_resumen(tabla, "", "FROM (SELECT ? AS impresora_id, ? AS ts, "
+                                     "? AS toner, ? AS unidad, ? AS kit)")
+    for tabla in _SQL_PERIODO_RESUMEN]
+
+
+class _EscritorMonitoreos:
+    """Guarda las lecturas de una corrida a medida que llegan, en lotes.
+
+    Un hilo propio vuelca las filas pendientes con un executemany en una
+    transacción corta cada `lote` filas o cada `segundos`, lo que ocurra
+    primero. Si la aplicación se cierra a mitad de corrida se pierde a lo sumo
+    el lote pendiente, y el lock de escritura de la DB compartida nunca se
+    retiene más que lo que tarda un lote.
+
+    Con `latido` (guardado solo de cambios), una lectura igual a la última fila
+    guardada de la impresora (`previas`, de db_ultimas_filas()) y con menos de
+    `latido` segundos no agrega fila: actualiza la fecha de ultima_lectura, la suma
+    a los resúmenes diario y semanal y la registra en lecturas_omitidas.
+    """
+
+    def __init__(self, corrida_id, ts, umbral_bajo, umbral_medio,
+                 lote=LOTE_FILAS_DEFAULT, segundos=LOTE_SEGUNDOS_DEFAULT,
+                 previas=None, latido=None):
+        self.corrida_id  = corrida_id
+        self.ts          = ts
+        self.umbrales    = (umbral_bajo, umbral_medio)
+        self.lote        = max(1, lote)
+        self.segundos    = segundos
+        self.previas     = previas or {}
+        self.latido      = latido
+        self.guardadas   = 0
+        self.omitidas    = 0
+        self._pendientes = []
+        self._vigentes   = []
+        self._cond       = threading.Condition()
+        self._cerrado    = False
+        self._error      = None
+        self._hilo       = threading.Thread(target=self._correr, name="escritor-monitoreos",
+                                            daemon=True)
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+    def agregar(self, impresora_id, toner, unidad, kit):
+        niveles = (_a_milesimos(toner), _a_milesimos(unidad), _a_milesimos(kit))
+        previa  = self.previas.get(impresora_id)
+        if (self.latido and previa is not None and previa[1:] == niveles
+                and self.ts - previa[0] < self.latido):
+            # Guardado solo de cambios: sin fila nueva en lecturas
+            with self._cond:
+                self._vigentes.append((impresora_id,) + niveles)
+                if len(self._pendientes) + len(self._vigentes) >= self.lote:
+                    self._cond.notify()
+            return
+        fila = ((impresora_id, self.ts, self.corrida_id) + niveles
+                + _nivel_lectura(*niveles, *self.umbrales))
+        with self._cond:
+            self._pendientes.append(fila)
+            if len(self._pendientes) + len(self._vigentes) >= self.lote:
+                self._cond.notify()
+
+    def cerrar(self):
+        """Vuelca lo pendiente y detiene el hilo. Relanza el último error de escritura."""
+        with self._cond:
+            self._cerrado = True
+            self._cond.notify()
+        self._hilo.join()
+        if self._error is not None:
+            raise self._error
+
+    def _correr(self):
+        while True:
+            with self._cond:
+                if not self._cerrado and len(self._pendientes) + len(self._vigentes) < self.lote:
+                    self._cond.wait(self.segundos)
+                filas, self._pendientes = self._pendientes, []
+                vigentes, self._vigentes = self._vigentes, []
+                cerrado = self._cerrado
+            if filas or vigentes:
+                try:
+                    with db_connect() as conn:
+                        conn.executemany(
+                            "INSERT INTO lecturas "
+                            "(impresora_id, ts, corrida_id, toner, unidad, kit, nivel_min, nivel) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", filas)
+                        conn.executemany("""
+                            UPDATE ultima_lectura SET ts = ?, corrida_id = ?, ts_ok = COALESCE(?, ts_ok)
+                            WHERE impresora_id = ? AND ts <= ?
+                        """, [(self.ts, self.corrida_id,
+                               self.ts if any(v is not None for v in niveles) else None,
+                               id_, self.ts) for id_, *niveles in vigentes])
+                        conn.executemany(
+                            "INSERT OR IGNORE INTO lecturas_omitidas "
+                            "(corrida_id, impresora_id, nivel_min) VALUES (?, ?, ?)",
+                            [(self.corrida_id, id_, _nivel_lectura(*niveles, *self.umbrales)[0])
+                             for id_, *niveles in vigentes])
+                        for sql in _SQL_RESUMEN_OMITIDA:
+                            conn.executemany(sql, [(id_, self.ts, *niveles)
+                                                   for id_, *niveles in vigentes])
+                    self.guardadas += len(filas)
+                    self.omitidas  += len(vigentes)
+                    self._error = None
+                except sqlite3.Error as e:
+                    _log.error("No se pudo guardar un lote de %d lecturas: %s",
+                               len(filas) + len(vigentes), e)
+                    self._error = e
+                    with self._cond:
+                        self._pendientes[:0] = filas
+                        self._vigentes[:0]   = vigentes
+                    if not cerrado:
+                        time.sleep(self.segundos)
+                        continue
+            if cerrado:
+                return
+
+
 def ejecutar_monitoreo(ctx, umbral_bajo, umbral_medio, es_automatico=False):
     """Consulta todas las impresoras activas en paralelo y guarda resultados en la DB."""
+    corrida_id = None
     try:
         impresoras = db_impresoras_todas(activas_solo=True)
 
@@ -3330,47 +6403,113 @@ def ejecutar_monitoreo(ctx, umbral_bajo, umbral_medio, es_automatico=False):
             return
 
         total_impresoras = len(impresoras)
-        fecha_actual     = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        inicio           = datetime.now()
+        fecha_actual     = inicio.strftime("%Y-%m-%d %H:%M:%S")
+        corrida_id       = int(inicio.timestamp() * 1000)
         resultados       = {}
+        db_corrida_iniciar(corrida_id, fecha_actual, es_automatico, umbral_bajo, umbral_medio)
         completados      = 0
 
-        with ThreadPoolExecutor(max_workers=cargar_config().get("max_workers", 20)) as executor:
-            future_to_info = {
-                executor.submit(obtener_status, imp["ip"], imp["modelo"], ctx.evento_cancelar):
-                    (imp["ip"], imp["modelo"], imp["sucursal"])
-                for imp in impresoras
-            }
-
-            for future in as_completed(future_to_info):
+        cfg              = cargar_config()
+        concurrencia     = cfg.get("max_concurrencia", MAX_CONCURRENCIA_DEFAULT)
+        _pool.max_total   = cfg.get("pool_max_conexiones", POOL_MAX_DEFAULT)
+        _pool.inactividad = cfg.get("pool_inactividad_seg", POOL_INACTIVIDAD_DEFAULT)
+        _latencias.minimo = cfg.get("timeout_min", TIMEOUT_MIN_DEFAULT)
+        _latencias.maximo = cfg.get("timeout_max", TIMEOUT_MAX_DEFAULT)
+        _latencias.cargar(db_latencias_cargar())
+        _circuitos.umbral     = cfg.get("circuito_fallos", CIRCUITO_FALLOS_DEFAULT)
+        _circuitos.espera     = cfg.get("circuito_espera_seg", CIRCUITO_ESPERA_DEFAULT)
+        _circuitos.espera_max = cfg.get("circuito_espera_max_seg", CIRCUITO_ESPERA_MAX_DEFAULT)
+        _circuitos.cargar(db_circuitos_cargar())
+        _snmp_cfg.puerto    = cfg.get("snmp_puerto", SNMP_PUERTO_DEFAULT)
+        _snmp_cfg.comunidad = cfg.get("snmp_comunidad", SNMP_COMUNIDAD_DEFAULT)
+        modelos_snmp        = db_modelos_snmp()
+
+        # Circuito abierto: no se consultan ni se guarda una fila vacía para ellas
+        estados      = {imp["ip"]: _circuitos.estado(imp["ip"], fecha_actual) for imp in impresoras}
+        en_espera    = {ip for ip, e in estados.items() if e == "abierto"}
+        semiabiertas = {ip for ip, e in estados.items() if e == "semiabierto"}
+        # Las SNMP no se sondean por TCP: el GET por UDP ya es una sola ida y vuelta
+        ips_snmp     = {imp["ip"] for imp in impresoras if imp["modelo"] in modelos_snmp}
+        a_sondear    = semiabiertas - ips_snmp
+        for imp in impresoras:
+            if imp["ip"] in en_espera:
+                completados += 1
+                ctx.ventana.after(0, _actualizar_progreso,
+                                  ctx, imp["sucursal"], imp["ip"], imp["modelo"], None, None, None,
+                                  int((completados / total_impresoras) * 100),
+                                  umbral_bajo, umbral_medio, fecha_actual, True)
+        a_consultar = [imp for imp in impresoras if imp["ip"] not in en_espera]
+
+        # Barrido TCP previo (opcional): las que no aceptan conexión quedan sin datos
+        # sin pasar por la descarga HTTP; las que sí, ya no necesitan otro sondeo.
+        inalcanzables = []
+        http_consultar = [imp for imp in a_consultar if imp["ip"] not in ips_snmp]
+        if cfg.get("presondeo_tcp", False) and http_consultar:
+            ctx.ventana.after(0, lambda: ctx.resultado_label.config(
+                text=f"Verificando conexión con {len(http_consultar)} impresoras\u2026"))
+            alcanzables = _motor.ejecutar(_presondeo_tcp(
+                [imp["ip"] for imp in http_consultar],
+                cfg.get("presondeo_timeout", PRESONDEO_TIMEOUT_DEFAULT), concurrencia)) | ips_snmp
+            inalcanzables = [imp for imp in a_consultar if imp["ip"] not in alcanzables]
+            a_consultar   = [imp for imp in a_consultar if imp["ip"] in alcanzables]
+            a_sondear     = set()
+
+        # Las lecturas se guardan a medida que llegan; cancelar conserva las ya obtenidas
+        sondeo = _motor.sondear(a_consultar, ctx.evento_cancelar, concurrencia, a_sondear,
+                                modelos_snmp)
+        solo_cambios = cfg.get("lecturas_solo_cambios", False)
+        with _EscritorMonitoreos(corrida_id, int(inicio.timestamp()), umbral_bajo, umbral_medio,
+                                 cfg.get("lote_filas", LOTE_FILAS_DEFAULT),
+                                 cfg.get("lote_segundos", LOTE_SEGUNDOS_DEFAULT),
+                                 db_ultimas_filas() if solo_cambios else None,
+                                 cfg.get("lecturas_latido_seg", LECTURAS_LATIDO_DEFAULT)
+                                 if solo_cambios else None) as escritor:
+            for imp, (toner, kit, unidad), alcanzable in itertools.chain(
+                    ((imp, (None, None, None), False if imp["modelo"] in MODELOS_CONFIG else None)
+                     for imp in inalcanzables), sondeo):
                 if ctx.evento_cancelar.is_set():
                     break
 
-                ip, modelo, sucursal = future_to_info[future]
-                toner, kit, unidad   = future.result()
+                ip, modelo, sucursal = imp["ip"], imp["modelo"], imp["sucursal"]
                 resultados[ip]       = (ip, modelo, sucursal, toner, kit, unidad)
+                # Solo las fallas de conexión abren el circuito: una página sin valores o
+                # un modelo no soportado no indican que la impresora esté desconectada
+                if alcanzable is not None:
+                    _circuitos.registrar(ip, alcanzable, fecha_actual)
+                sigue_en_espera = ip in semiabiertas and _circuitos.estado(ip, fecha_actual) != "cerrado"
+                # Sin filas vacías de las que siguen con circuito abierto
+                if not sigue_en_espera:
+                    escritor.agregar(imp["id"], toner, unidad, kit)
 
                 completados += 1
                 progreso     = int((completados / total_impresoras) * 100)
 
                 ctx.ventana.after(0, _actualizar_progreso,
                                   ctx, sucursal, ip, modelo, toner, kit, unidad,
-                                  progreso, umbral_bajo, umbral_medio, fecha_actual)
+                                  progreso, umbral_bajo, umbral_medio, fecha_actual, sigue_en_espera)
+
+        db_latencias_guardar(_latencias.exportar(), fecha_actual)
+        db_circuitos_guardar(*_circuitos.exportar())
+
+        # Pronósticos de toda la flota con las lecturas recién guardadas
+        try:
+            db_pronosticos_actualizar()
+            ctx.ventana.after(0, _aplicar_pronosticos, ctx, db_pronosticos())
+        except sqlite3.Error as e:
+            _log.error("Error al actualizar los pronósticos: %s", e)
 
         if ctx.evento_cancelar.is_set():
-            ctx.ventana.after(0, _finalizar, ctx, "Monitoreo cancelado.", "cancelado")
+            leidas = escritor.guardadas + escritor.omitidas
+            db_corrida_finalizar(corrida_id, "cancelada", total=leidas)
+            ctx.ventana.after(0, _finalizar, ctx,
+                              f"Monitoreo cancelado. Se guardaron {leidas} lecturas.",
+                              "cancelado")
             return
 
-        # Guardar resultados en la DB
-        with db_connect() as conn:
-            for ip, modelo, sucursal, toner, kit, unidad in resultados.values():
-                conn.execute(
-                    "INSERT INTO monitoreos (fecha, ip, toner, unidad_imagen, kit_mantenimiento) "
-                    "VALUES (?, ?, ?, ?, ?)",
-                    (fecha_actual, ip, toner, unidad, kit),
-                )
-
-        # Calcular estadísticas
-        n_bajo = n_medio = n_sin_datos = 0
+        # Calcular estadísticas (las que están en espera cuentan como sin datos)
+        n_bajo = n_medio = 0
+        n_sin_datos = len(en_espera)
         for ip, modelo, sucursal, toner, kit, unidad in resultados.values():
             valores = [v for v in (toner, kit, unidad) if v is not None]
             nivel   = clasificar_nivel(valores, umbral_bajo, umbral_medio)
@@ -3378,11 +6517,13 @@ def ejecutar_monitoreo(ctx, umbral_bajo, umbral_medio, es_automatico=False):
             elif nivel == "bajo":      n_bajo      += 1
             elif nivel == "medio":     n_medio     += 1
 
-        total        = len(resultados)
+        total        = len(resultados) + len(en_espera)
         respondieron = total - n_sin_datos
+        db_corrida_finalizar(corrida_id, "completa", total, respondieron - n_bajo - n_medio,
+                             n_bajo, n_medio, n_sin_datos)
         ctx.ventana.after(0, _actualizar_resumen, ctx, total, respondieron, n_sin_datos, n_bajo, n_medio, fecha_actual)
 
-        mensaje = f"Monitoreo completado. {total} impresoras consultadas."
+        mensaje = f"Monitoreo completado. {len(resultados)} impresoras consultadas."
         tipo    = "exito"
         if n_bajo > 0 or n_medio > 0 or n_sin_datos > 0:
             mensaje += (
@@ -3391,6 +6532,8 @@ def ejecutar_monitoreo(ctx, umbral_bajo, umbral_medio, es_automatico=False):
                 f"\n  Nivel medio (<{umbral_medio}%): {n_medio}"
                 f"\n  Sin datos: {n_sin_datos}"
             )
+            if en_espera:
+                mensaje += f" ({len(en_espera)} en espera, no consultadas)"
             if n_bajo > 0:
                 tipo = "alerta"
 
@@ -3410,6 +6553,11 @@ def ejecutar_monitoreo(ctx, umbral_bajo, umbral_medio, es_automatico=False):
         ctx.ventana.after(0, _finalizar, ctx, mensaje, tipo)
 
     except Exception as e:
+        if corrida_id is not None:
+            try:
+                db_corrida_finalizar(corrida_id, "error")
+            except sqlite3.Error:
+                pass
         ctx.ventana.after(0, _finalizar, ctx, f"Error: {e}", "error")
 
 # ---------------------------------------------------------------------------
@@ -3436,6 +6584,7 @@ def iniciar_monitoreo(ctx, es_automatico=False):
 
     ctx.evento_cancelar.clear()
     ctx.filas_tabla.clear()
+    ctx.pronosticos = db_pronosticos()
     ctx.sort_col = None
     ctx.sort_asc = True
     ctx.tree.delete(*ctx.tree.get_children())
@@ -3727,22 +6876,10 @@ def abrir_estadisticas_consumo():
             defaultextension=".xlsx", filetypes=[("Excel", "*.xlsx")],
             initialfile=f"consumo_{datetime.now().strftime('%Y%m%d')}.xlsx", parent=win)
         if not ruta: return
-        wb = Workbook(); ws = wb.active; ws.title = "Consumo"
-        headers = list(cols_res); widths = [28, 10, 14, 8]
-        hf = PatternFill("solid", fgColor="4472C4"); hfont = Font(bold=True, color="FFFFFF")
-        for col, (h, w) in enumerate(zip(headers, widths), 1):
-            c = ws.cell(row=1, column=col, value=h); c.fill = hf; c.font = hfont
-            c.alignment = Alignment(horizontal="center")
-            ws.column_dimensions[c.column_letter].width = w
-        for it in items:
-            ws.append(list(tree_res.item(it, "values")))
-            if tree_res.item(it, "values")[0] == "TOTAL":
-                for col in range(1, len(headers)+1):
-                    c = ws.cell(row=ws.max_row, column=col)
-                    c.font = Font(bold=True)
-                    c.fill = PatternFill("solid", fgColor="E3F2FD")
-        wb.save(ruta)
-        messagebox.showinfo("Exportado", f"Consumo guardado:\n{ruta}", parent=win)
+        filas = [(list(v), "total" if v[0] == "TOTAL" else None)
+                 for v in (tree_res.item(it, "values") for it in items)]
+        _exportar_excel_en_hilo(win, ruta, [_hoja_excel(
+            "Consumo", list(cols_res), [28, 10, 14, 8], filas, "encabezado_azul")])
 
     def _cargar_detalle(sucursal):
         tree_det.delete(*tree_det.get_children())
@@ -3793,6 +6930,15 @@ def crear_interfaz():
     ventana.geometry("960x720")
     ventana.config(bg=BG_MAIN)
 
+    # Un error de la DB en un callback (p. ej. un archivo de lecturas que no se pudo
+    # adjuntar) se informa en lugar de dejar la ventana con datos incompletos
+    def _error_en_callback(tipo, valor, tb):
+        _log.error("Error en la interfaz: %s", valor, exc_info=(tipo, valor, tb))
+        if issubclass(tipo, sqlite3.Error):
+            messagebox.showerror("Error de base de datos", str(valor))
+
+    ventana.report_callback_exception = _error_en_callback
+
     # Estilo global ttk
     style = Style()
     style.theme_use("clam")
@@ -3825,6 +6971,17 @@ def crear_interfaz():
     spinbox_medio.delete(0, tk.END)
     spinbox_medio.insert(0, config.get("umbral_medio", 25))
     spinbox_medio.pack(side="left")
+
+    # Umbrales guardados desde Configuración: sin esto el próximo monitoreo guardaría
+    # los valores viejos de los spinbox
+    def _umbrales_cambiados(cambios):
+        for clave, spin in (("umbral_bajo", spinbox_bajo), ("umbral_medio", spinbox_medio)):
+            valor = cambios.get(clave)
+            if valor is not None:
+                ventana.after(0, lambda spin=spin, valor=valor: spin.get() != str(valor) and (
+                    spin.delete(0, tk.END), spin.insert(0, valor)))
+
+    _config.suscribir(_umbrales_cambiados)
     tk.Label(frame_umbrales, text="%", bg=BG_MAIN, font=FONT_UI).pack(side="left", padx=(2, 0))
     tk.Label(frame_umbrales, text="  |  ", fg="#aaaaaa", bg=BG_MAIN).pack(side="left")
     var_auto = tk.BooleanVar(value=False)
@@ -3879,6 +7036,7 @@ def crear_interfaz():
     col_widths_tree = {
         "Sucursal": 110, "IP": 120, "Modelo": 140, "Último Monitoreo": 130,
         "Tóner (%)": 90, "Unidad Imagen (%)": 110, "Kit Mantenimiento (%)": 125,
+        "Agota el": 90,
     }
     tree = Treeview(frame_tree, columns=COLUMNAS_TREE, show="headings", height=10)
     for col in COLUMNAS_TREE:
@@ -3996,6 +7154,7 @@ def crear_interfaz():
         lbl_proximo=lbl_proximo,
         after_id=None,
         filas_tabla=[],
+        pronosticos={},
         sort_col=None,
         sort_asc=True,
         var_suc_filtro=var_suc_filtro,
@@ -4108,13 +7267,13 @@ def crear_interfaz():
             ctx.filas_tabla.extend(filas)
             for idx, fila in enumerate(filas):
                 parity = "par" if idx % 2 == 0 else "impar"
-                tags   = (fila[7],) if fila[7] else (parity,)
-                ctx.tree.insert("", "end", values=fila[:7], tags=tags)
+                tags   = (fila[8],) if fila[8] else (parity,)
+                ctx.tree.insert("", "end", values=fila[:8], tags=tags)
             n_bajo = n_medio = n_sin_datos = 0
             for f in filas:
-                if   f[7] == "sin_datos": n_sin_datos += 1
-                elif f[7] == "bajo":      n_bajo      += 1
-                elif f[7] == "medio":     n_medio     += 1
+                if   f[8] == "sin_datos": n_sin_datos += 1
+                elif f[8] == "bajo":      n_bajo      += 1
+                elif f[8] == "medio":     n_medio     += 1
             total = len(filas)
             respondieron = total - n_sin_datos
             _actualizar_resumen(ctx, total, respondieron, n_sin_datos, n_bajo, n_medio, fecha)
@@ -4162,13 +7321,13 @@ def crear_interfaz():
         ctx.filas_tabla.extend(filas_inicio)
         for idx, fila in enumerate(filas_inicio):
             parity = "par" if idx % 2 == 0 else "impar"
-            tags   = (fila[7],) if fila[7] else (parity,)
-            tree.insert("", "end", values=fila[:7], tags=tags)
+            tags   = (fila[8],) if fila[8] else (parity,)
+            tree.insert("", "end", values=fila[:8], tags=tags)
         n_bajo = n_medio = n_sin_datos = 0
         for fila in filas_inicio:
-            if   fila[7] == "sin_datos": n_sin_datos += 1
-            elif fila[7] == "bajo":      n_bajo      += 1
-            elif fila[7] == "medio":     n_medio     += 1
+            if   fila[8] == "sin_datos": n_sin_datos += 1
+            elif fila[8] == "bajo":      n_bajo      += 1
+            elif fila[8] == "medio":     n_medio     += 1
         total        = len(filas_inicio)
         respondieron = total - n_sin_datos
         _actualizar_resumen(ctx, total, respondieron, n_sin_datos, n_bajo, n_medio, fecha_inicio)
@@ -4186,6 +7345,28 @@ def crear_interfaz():
     ventana.mainloop()
 
 
-_inicializar_db_path()
-init_db()
-crear_interfaz()
+def _archivar_al_iniciar():
+    """Archiva las lecturas viejas en segundo plano (conexión propia del hilo)."""
+    try:
+        db_archivar_lecturas()
+    except sqlite3.Error as e:
+        _log.error("Error al archivar lecturas: %s", e)
+
+
+if __name__ == "__main__":
+    _inicializar_db_path()
+    if len(sys.argv) > 1:
+        sys.exit(main_consola(sys.argv[1:]))
+    try:
+        init_db()
+    except sqlite3.Error as e:
+        _log.error("No se pudo actualizar la base de datos %s: %s", DB_PATH, e)
+        raiz = tk.Tk()
+        raiz.withdraw()
+        messagebox.showerror("Base de datos",
+                             f"No se pudo actualizar la base de datos:\n{DB_PATH}\n\n{e}\n\n"
+                             f"Detalles en {LOG_PATH}")
+        raiz.destroy()
+        sys.exit(1)
+    threading.Thread(target=_archivar_al_iniciar, name="archivo-lecturas", daemon=True).start()
+    crear_interfaz()